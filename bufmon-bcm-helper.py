@@ -1,9 +1,16 @@
 #!/usr/bin/python
 
 import sys, getopt
+import itertools
+import multiprocessing
+import os
+import re
+import tempfile
 import yaml
 import decorator
 
+from bufmon_registry import CounterRegistry
+
 file_header = """
 # Copyright (C) 2014-2015 Hewlett-Packard Development Company, L.P.
 # All Rights Reserved.
@@ -27,18 +34,23 @@ file_header = """
 
 
 
-# Default values for ASIC specific constants
-NUM_PORTS = 104
-NUM_UC_QUEUE = 2960
-NUM_UC_QUEUE_GRP = 128
-NUM_MC_QUEUE = 1040
-NUM_SP = 4
-NUM_COMMON_SP = 1
-NUM_RQE = 11
-NUM_RQE_POOL = 4
-NUM_PG = 8
-SUPPORT_1588 = 1
-CPU_COSQ = 8
+# ASIC specific constants per chip family, NUM_PORTS is given by the user.
+CHIP_PROFILES = {
+    "trident": {
+        "NUM_UC_QUEUE": 2960,
+        "NUM_UC_QUEUE_GRP": 128,
+        "NUM_MC_QUEUE": 1040,
+        "NUM_SP": 4,
+        "NUM_COMMON_SP": 1,
+        "NUM_RQE": 11,
+        "NUM_RQE_POOL": 4,
+        "NUM_PG": 8,
+        "SUPPORT_1588": 1,
+        "CPU_COSQ": 48,
+    },
+}
+
+DEFAULT_OUTPUT = "bufmond.yaml"
 
 COUNTER_UNIQUE_ID = "name"
 HW_UNIT = "hw_unit_id"
@@ -49,10 +61,51 @@ PORT = "port"
 QUEUE = "queue"
 PG = "priority-group"
 SP = "service-pool"
-
-
-counter_vendor_specific_info = { STATS_NAME: ""}
-counter_info = {HW_UNIT: 0, COUNTER_UNIQUE_ID: "", VENDOR_INFO: {}}
+COUNTER_RANGES = "counter_ranges"
+COUNTER_NAMES = "counter_names"
+INDEXES = "indexes"
+
+
+NONE_INDEX = "NONE"
+
+# Realms description, in the order the counters are written to the YAML.
+# Each realm counter is generated for every combination of its index
+# ranges, the statistics being the innermost loop:
+#   (realm, [statistics], [(vendor info key, number of indexes), ...])
+# EXPECTED YAML FORMAT:
+#   name: ingress-port-priority-group/um-share-buffer-count/port/pg
+#       counter_vendor_specific_info:
+#         counter_name: um-share-buffer-count
+#         port: "1"
+#         priority-group: "1"
+#         realm: ingress-port-priority-group
+#   Missing indexes are named NONE: device/data/NONE/NONE
+REALMS = [
+    ("device", ["data"], []),
+    ("ingress-port-priority-group",
+        ["um-share-buffer-count", "um-headroom-buffer-count"],
+        [(PORT, "NUM_PORTS"), (PG, "NUM_PG")]),
+    ("ingress-port-service-pool", ["um-share-buffer-count"],
+        [(PORT, "NUM_PORTS"), (SP, "NUM_SP")]),
+    ("ingress-service-pool", ["um-share-buffer-count"],
+        [(SP, "NUM_SP")]),
+    ("egress-port-service-pool",
+        ["uc-share-buffer-count", "um-share-buffer-count"],
+        [(PORT, "NUM_PORTS"), (SP, "NUM_SP")]),
+    ("egress-service-pool",
+        ["um-share-buffer-count", "mc-share-buffer-count"],
+        [(SP, "NUM_SP")]),
+    ("egress-uc-queue", ["uc-buffer-count"],
+        [(QUEUE, "NUM_UC_QUEUE")]),
+    ("egress-uc-queue-group", ["uc-buffer-count"],
+        [(QUEUE, "NUM_UC_QUEUE_GRP")]),
+    ("egress-mc-queue", ["mc-buffer-count"],
+        [(QUEUE, "NUM_MC_QUEUE")]),
+    ("egress-cpu-queue", ["cpu-buffer-count"],
+        [(QUEUE, "CPU_COSQ")]),
+    ("egress-rqe-queue", ["rqe-buffer-count"],
+        [(QUEUE, "NUM_RQE")]),
+]
 
 bufmon_template = {
   'cap_mode_peak': True,
@@ -62,388 +115,296 @@ bufmon_template = {
   'counters': []
 }
 
-global_counter_list = []
-
-def assignOrder(order):
-  def do_assignment(to_func):
-    to_func.order = order
-    return to_func
-  return do_assignment
-
-class realm:
-    #------------------ device_data_stats() ----------------
-    @assignOrder(1)
-    def device_data_stats(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: device/data/NONE/NONE
-            counter_vendor_specific_info:
-              counter_name: data
-        '''
-        counter_vendor_specific_info = { STATS_NAME: ""}
-        counter_info[HW_UNIT] = 0
-        counter_info[COUNTER_UNIQUE_ID] = "device/data/NONE/NONE"
-        counter_vendor_specific_info[STATS_NAME] = "data"
-        counter_vendor_specific_info[REALM] = "device"
-        counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-        global_counter_list.append(counter_info.copy())
-        return counter_info
-
-    #------------------ ingress_port_priority_group ----------------
-    @assignOrder(2)
-    def ingress_port_priority_group(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: ingress-port-priority-group/um-share-buffer-count/port/pg
-            counter_vendor_specific_info:
-              counter_name: um-share-buffer-count
-              port: "1"
-              priority-group: "1"
-        '''
-        global NUM_PORTS
-        global NUM_PG
-        
-        for index1 in range(1, NUM_PORTS + 1):
-            for index2 in range(1, NUM_PG + 1):
-                counter_vendor_specific_info = { STATS_NAME: ""}
-                counter_info[HW_UNIT] = 0
-                counter_info[COUNTER_UNIQUE_ID] = "ingress-port-priority-group/um-share-buffer-count/" \
-                            + str(index1)+"/" + str(index2)
-                counter_vendor_specific_info[STATS_NAME] = "um-share-buffer-count"
-                counter_vendor_specific_info[REALM] = "ingress-port-priority-group"
-                counter_vendor_specific_info[PORT] = str(index1)
-                counter_vendor_specific_info[PG] = str(index2)
-                counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-                global_counter_list.append(counter_info.copy())
-
-                counter_vendor_specific_info = { STATS_NAME: ""}
-                counter_info[HW_UNIT] = 0
-                counter_info[COUNTER_UNIQUE_ID] = "ingress-port-priority-group/um-headroom-buffer-count/" \
-                                + str(index1)+"/" + str(index2)
-                counter_vendor_specific_info[STATS_NAME] = "um-headroom-buffer-count"
-                counter_vendor_specific_info[REALM] = "ingress-port-priority-group"
-                counter_vendor_specific_info[PORT] = str(index1)
-                counter_vendor_specific_info[PG] = str(index2)
-                counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-                global_counter_list.append(counter_info.copy())
-
-
-    #------------------ ingress_port_service_pool ----------------
-    @assignOrder(3)
-    def ingress_port_service_pool(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: ingress-port-service-pool/um-share-buffer-count/port/service-pool
-            counter_vendor_specific_info:
-              counter_name: um-share-buffer-count
-              port: "1"
-              service-pool: "1"
-        '''
-        global NUM_PORTS
-        global NUM_SP
-
-        for index1 in range(1, NUM_PORTS + 1):
-            for index2 in range(1, NUM_SP + 1):
-                counter_vendor_specific_info = { STATS_NAME: ""}
-                counter_info[HW_UNIT] = 0
-                counter_info[COUNTER_UNIQUE_ID] = "ingress-port-service-pool/um-share-buffer-count/" \
-                            + str(index1)+"/" + str(index2)
-                counter_vendor_specific_info[STATS_NAME] = "um-share-buffer-count"
-                counter_vendor_specific_info[REALM] = "ingress-port-service-pool"
-                counter_vendor_specific_info[PORT] = str(index1)
-                counter_vendor_specific_info[SP] = str(index2)
-                counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-                global_counter_list.append(counter_info.copy())
-
-        #------------------ ingress_service_pool ----------------
-    @assignOrder(4)
-    def ingress_service_pool(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: ingress-service-pool/um-share-buffer-count/service-pool/NONE
-            counter_vendor_specific_info:
-              counter_name: um-share-buffer-count
-              service-pool: "1"
-        '''
-        global NUM_PG
-
-        for index1 in range(1, NUM_SP + 1):
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "ingress-service-pool/um-share-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "um-share-buffer-count"
-            counter_vendor_specific_info[REALM] = "ingress-service-pool"
-            counter_vendor_specific_info[SP] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_port_service_pool ----------------
-    @assignOrder(5)
-    def egress_port_service_pool(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-port-service-pool/uc-share-buffer-count/port/service-pool
-            counter_vendor_specific_info:
-              counter_name: uc-share-buffer-count
-              port: "1"
-              service-pool: "1"
-        '''
-        global NUM_PORTS
-        global NUM_SP
-
-        for index1 in range(1, NUM_PORTS + 1):
-            for index2 in range(1, NUM_SP + 1):
-                #uc-share-buffer-count counter
-                counter_vendor_specific_info = { STATS_NAME: ""}
-                counter_info[HW_UNIT] = 0
-                counter_info[COUNTER_UNIQUE_ID] = "egress-port-service-pool/uc-share-buffer-count/" \
-                            + str(index1)+"/" + str(index2)
-                counter_vendor_specific_info[STATS_NAME] = "uc-share-buffer-count"
-                counter_vendor_specific_info[REALM] = "egress-port-service-pool"
-                counter_vendor_specific_info[PORT] = str(index1)
-                counter_vendor_specific_info[SP] = str(index2)
-                counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-                global_counter_list.append(counter_info.copy())
-
-                #um-share-buffer-count counter
-                counter_vendor_specific_info = { STATS_NAME: ""}
-                counter_info[HW_UNIT] = 0
-                counter_info[COUNTER_UNIQUE_ID] = "egress-port-service-pool/um-share-buffer-count/" \
-                                  + str(index1)+"/" + str(index2)
-                counter_vendor_specific_info[STATS_NAME] = "um-share-buffer-count"
-                counter_vendor_specific_info[REALM] = "egress-port-service-pool"
-                counter_vendor_specific_info[PORT] = str(index1)
-                counter_vendor_specific_info[SP] = str(index2)
-                counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-                global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_service_pool ----------------
-    @assignOrder(6)
-    def egress_service_pool(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-service-pool/uc-share-buffer-count/service-pool/NONE
-            counter_vendor_specific_info:
-              counter_name: data
-              service-pool: "1"
-        '''
-        global NUM_SP
-
-        for index1 in range(1, NUM_SP + 1):
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-service-pool/um-share-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "um-share-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-service-pool"
-            counter_vendor_specific_info[SP] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-service-pool/mc-share-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "mc-share-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-service-pool"
-            counter_vendor_specific_info[SP] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_uc_queue ----------------
-    @assignOrder(7)
-    def egress_uc_queue(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-uc-queue/uc-buffer-count/queue/NONE
-            counter_vendor_specific_info:
-              counter_name: uc-buffer-count
-              queue: "1"
-        '''
-        global NUM_UC_QUEUE
-
-        for index1 in range(1, NUM_UC_QUEUE + 1):
-            #um-share-buffer-count counter
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-uc-queue/uc-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "uc-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-uc-queue"
-            counter_vendor_specific_info[QUEUE] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_uc_queue_group ----------------
-    @assignOrder(8)
-    def egress_uc_queue_group(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-uc-queue-group/uc-buffer-count/queue/NONE
-            counter_vendor_specific_info:
-              counter_name: uc-buffer-count
-              queue: "1"
-        '''
-        global NUM_UC_QUEUE_GRP
-
-        for index1 in range(1, NUM_UC_QUEUE_GRP + 1):
-            #um-share-buffer-count counter
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-uc-queue-group/uc-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "uc-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-uc-queue-group"
-            counter_vendor_specific_info[QUEUE] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_mc_queue ----------------
-    @assignOrder(9)
-    def egress_mc_queue(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-mc-queue/mc-buffer-count/queue/NONE
-            counter_vendor_specific_info:
-              counter_name: mc-buffer-count
-              queue: "1"
-        '''
-        global NUM_MC_QUEUE
-
-        for index1 in range(1, NUM_MC_QUEUE + 1):
-            #um-share-buffer-count counter
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-mc-queue/mc-buffer-count/" \
-                          + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "mc-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-mc-queue"
-            counter_vendor_specific_info[QUEUE] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_cpu_queue ----------------
-    @assignOrder(10)
-    def egress_cpu_queue(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-cpu-queue/cpu-buffer-count/queue/NONE
-            counter_vendor_specific_info:
-              counter_name: mc-buffer-count
-              queue: "1"
-        '''
-        global CPU_COSQ
-
-        for index1 in range(1, CPU_COSQ + 1):
-            #um-share-buffer-count counter
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-cpu-queue/cpu-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "cpu-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-cpu-queue"
-            counter_vendor_specific_info[QUEUE] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
-    #------------------ egress_rqe_queue ----------------
-    @assignOrder(11)
-    def egress_rqe_queue(self):
-        '''
-        EXPECTED YAML FORMAT:
-        name: egress-rqe-queue/rqe-buffer-count/queue/NONE
-            counter_vendor_specific_info:
-              counter_name: mc-buffer-count
-              queue: "1"
-        '''
-        global NUM_RQE
-
-        for index1 in range(1, NUM_RQE + 1):
-            #um-share-buffer-count counter
-            counter_vendor_specific_info = { STATS_NAME: ""}
-            counter_info[HW_UNIT] = 0
-            counter_info[COUNTER_UNIQUE_ID] = "egress-rqe-queue/rqe-buffer-count/" \
-                        + str(index1)+"/NONE"
-            counter_vendor_specific_info[STATS_NAME] = "rqe-buffer-count"
-            counter_vendor_specific_info[REALM] = "egress-rqe-queue"
-            counter_vendor_specific_info[QUEUE] = str(index1)
-            counter_info[VENDOR_INFO] = counter_vendor_specific_info.copy()
-            global_counter_list.append(counter_info.copy())
-
- 
-def create_bufmond_yaml():
-    bufmon_template["counters"] = global_counter_list
-    ff = open('bufmond.yaml', 'wb')
-    ff.write(file_header)
-    yaml.dump(bufmon_template, ff, default_flow_style=False)
-    ff.close()
-
-
-def trident(ports):
+# Strings the fast emitter writes as plain (or single quoted) scalars.
+PLAIN_SCALAR = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_./-]*$')
+YAML_STR_TAG = u'tag:yaml.org,2002:str'
+
+
+def realm_counters(registry, realm, stats, indexes, limits, hw_unit):
     '''
-    Initialize Trident specific constants
-    Call the realm function and populate the counters list
+    Registers the counters of one realm over the cartesian product of its
+    index ranges. The registry interns the name components and vendor
+    info strings, the counter dicts are only built again when written.
     '''
-    global NUM_PORTS
-    global NUM_UC_QUEUE
-    global NUM_UC_QUEUE_GRP
-    global NUM_MC_QUEUE
-    global NUM_SP
-    global NUM_COMMON_SP
-    global NUM_RQE
-    global NUM_RQE_POOL
-    global NUM_PG
-    global CPU_COSQ
-
-    NUM_PORTS = int(ports)
-    NUM_UC_QUEUE = 2960
-    NUM_UC_QUEUE_GRP = 128
-    NUM_MC_QUEUE = 1040
-    NUM_SP = 4
-    NUM_COMMON_SP = 1
-    NUM_RQE = 11
-    NUM_RQE_POOL = 4
-    NUM_PG = 8
-    CPU_COSQ = 48
-
-    #create the realm class object
-    realm_obj = realm()
-
-    #Get all the realms functions in the class
-    relams_functions_list =  sorted(
-             #get a list of fields that have the order set
-             [
-               getattr(realm_obj, field) for field in dir(realm_obj)
-               if hasattr(getattr(realm_obj, field), "order")
-             ],
-             #sort them by their order
-             key = (lambda field: field.order)
-            )
-
-
-    for realm_func in relams_functions_list:
-        realm_func()
-    #Writing the counters list to the YAML file
-    create_bufmond_yaml()
+    keys = [key for key, limit in indexes]
+    ranges = [[str(index) for index in range(1, limits[limit] + 1)]
+              for key, limit in indexes]
+    padding = [NONE_INDEX] * (2 - len(indexes))
+    prefixes = [(stat, realm + "/" + stat + "/") for stat in stats]
+    add = registry.add
+
+    for combination in itertools.product(*ranges):
+        suffix = "/".join(list(combination) + padding)
+        location = dict(zip(keys, combination))
+        for stat, prefix in prefixes:
+            info = {STATS_NAME: stat, REALM: realm}
+            info.update(location)
+            add(hw_unit, prefix + suffix, info)
+
+
+def generate_ranges(limits, hw_unit=0):
+    '''
+    Generates the compact counter_ranges description of every realm, the
+    daemon expands it to the same counters as generate_counters()
+    '''
+    ranges = []
+    for realm, stats, indexes in REALMS:
+        ranges.append({REALM: realm,
+                       COUNTER_NAMES: list(stats),
+                       HW_UNIT: hw_unit,
+                       INDEXES: [[key, 1, limits[limit]]
+                                 for key, limit in indexes]})
+    return ranges
+
+
+def generate_counters(limits, hw_unit=0):
+    '''
+    Generates the CounterRegistry of every realm for the given ASIC limits
+    '''
+    registry = CounterRegistry()
+    for realm, stats, indexes in REALMS:
+        realm_counters(registry, realm, stats, indexes, limits, hw_unit)
+    return registry
+
+
+def yaml_scalar(value, cache, resolver):
+    '''
+    Formats a scalar the way yaml.dump() does, raises ValueError for the
+    values the fast emitter does not handle
+    '''
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if type(value) is int:
+        return str(value)
+    if type(value) is not str:
+        raise ValueError(value)
+
+    text = cache.get(value)
+    if text is None:
+        if not PLAIN_SCALAR.match(value):
+            raise ValueError(value)
+        # Strings that would load back as another type are quoted.
+        tag = resolver.resolve(yaml.ScalarNode, value, (True, False))
+        if tag == YAML_STR_TAG:
+            text = value
+        else:
+            text = "'" + value + "'"
+        cache[value] = text
+
+    return text
+
+
+def emit_bufmond_yaml(template):
+    '''
+    Yields the lines of the counters file, byte identical to
+    yaml.dump(template, default_flow_style=False) for the counters schema
+    '''
+    cache = {}
+    resolver = yaml.resolver.Resolver()
+
+    def scalar(value):
+        return yaml_scalar(value, cache, resolver)
+
+    for key in sorted(template):
+        value = template[key]
+        if key != 'counters':
+            yield scalar(key) + ": " + scalar(value) + "\n"
+            continue
+        if not value:
+            raise ValueError(key)
+
+        yield "counters:\n"
+        for counter in value:
+            if not counter:
+                raise ValueError(counter)
+            prefix = "- "
+            for counter_key in sorted(counter):
+                counter_value = counter[counter_key]
+                if type(counter_value) is dict:
+                    if not counter_value:
+                        raise ValueError(counter_key)
+                    yield prefix + scalar(counter_key) + ":\n"
+                    for info_key in sorted(counter_value):
+                        yield ("    " + scalar(info_key) + ": " +
+                               scalar(counter_value[info_key]) + "\n")
+                else:
+                    yield (prefix + scalar(counter_key) + ": " +
+                           scalar(counter_value) + "\n")
+                prefix = "  "
+
+
+def write_file_atomic(path, write):
+    '''
+    Calls write with a temporary file of the directory of path, then
+    renames it over path: a reader of path, such as a resident bufmond,
+    sees the old file or the complete new one
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.%s.' % os.path.basename(path))
+    try:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+        os.fchmod(fd, mode)
+        ff = os.fdopen(fd, 'wb')
+        try:
+            write(ff)
+        finally:
+            ff.close()
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def create_bufmond_yaml(path, header, registries):
+    '''
+    Writes the counters of the registries, in order, to the YAML file
+    '''
+    bufmon_template_unit = dict(bufmon_template)
+    bufmon_template_unit["counters"] = itertools.chain(*registries)
+
+    def write(ff):
+        ff.write(header)
+        start = ff.tell()
+        try:
+            ff.writelines(emit_bufmond_yaml(bufmon_template_unit))
+        except ValueError:
+            # Not the plain counters schema, let PyYAML serialise it.
+            ff.seek(start)
+            ff.truncate()
+            bufmon_template_unit["counters"] = list(
+                itertools.chain(*registries))
+            yaml.dump(bufmon_template_unit, ff, default_flow_style=False)
+
+    write_file_atomic(path, write)
+
+
+def create_compact_yaml(path, header, ranges):
+    bufmon_template_unit = dict(bufmon_template)
+    del bufmon_template_unit["counters"]
+    bufmon_template_unit[COUNTER_RANGES] = ranges
+
+    def write(ff):
+        ff.write(header)
+        yaml.dump(bufmon_template_unit, ff, default_flow_style=False)
+
+    write_file_atomic(path, write)
+
+
+def chip_limits(chip, ports):
+    '''
+    Returns the ASIC specific constants of the chip profile
+    '''
+    limits = dict(CHIP_PROFILES[chip])
+    limits["NUM_PORTS"] = int(ports)
+    return limits
+
+
+def unit_counters(job):
+    '''
+    Generates the CounterRegistry of one hardware unit, small enough to
+    come back from a worker process cheaply
+    '''
+    chip, ports, hw_unit = job
+    return generate_counters(chip_limits(chip, ports), hw_unit)
+
+
+def generate_units(chip, ports, units):
+    '''
+    Generates the CounterRegistry of every hardware unit, one worker
+    process per unit
+    '''
+    jobs = [(chip, ports, hw_unit) for hw_unit in range(units)]
+    if units == 1:
+        return [unit_counters(jobs[0])]
+
+    pool = multiprocessing.Pool(min(units, multiprocessing.cpu_count()))
+    try:
+        return pool.map(unit_counters, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def unit_output(path, hw_unit):
+    '''
+    Returns the per unit file name: bufmond.yaml -> bufmond-unit0.yaml
+    '''
+    root, ext = os.path.splitext(path)
+    return "%s-unit%d%s" % (root, hw_unit, ext)
+
+
+def usage():
+    print (['Usage:  [-u units] [-s] [-c] [-o file] [%s] [number of ports]'
+            % "|".join(sorted(CHIP_PROFILES)),
+            'Please enter chip and number of ports',
+            '-u, --units   number of hardware units (default 1)',
+            '-s, --split   write one file per hardware unit',
+            '-c, --compact write counter_ranges instead of every counter',
+            '-o, --output  YAML file name (default %s)' % DEFAULT_OUTPUT])
+    sys.exit()
+
 
 def main(argv):
-    global file_header
+    units = 1
+    split = False
+    compact = False
+    output = DEFAULT_OUTPUT
+
+    try:
+        opts, args = getopt.getopt(argv[1:], "u:sco:",
+                                   ["units=", "split", "compact", "output="])
+        for opt, value in opts:
+            if opt in ("-u", "--units"):
+                units = int(value)
+            elif opt in ("-s", "--split"):
+                split = True
+            elif opt in ("-c", "--compact"):
+                compact = True
+            elif opt in ("-o", "--output"):
+                output = value
+    except (getopt.GetoptError, ValueError):
+        usage()
+
+    if len(args) < 2 or units < 1:
+        usage()
+
+    chip, ports = args[0], args[1]
+    if chip not in CHIP_PROFILES:
+        print 'Only %s asic supported for buffer montioring feature' \
+            % ", ".join(sorted(CHIP_PROFILES))
+        return
+
+    header = file_header % (chip, ports)
+
+    if compact:
+        # The ranges are tiny, no need for worker processes.
+        limits = chip_limits(chip, ports)
+        units_ranges = [generate_ranges(limits, hw_unit)
+                        for hw_unit in range(units)]
+        if split:
+            for hw_unit, ranges in enumerate(units_ranges):
+                create_compact_yaml(unit_output(output, hw_unit), header,
+                                    ranges)
+        else:
+            create_compact_yaml(output, header,
+                                list(itertools.chain(*units_ranges)))
+        return
+
+    units_counters = generate_units(chip, ports, units)
 
-    if argv[1] == "trident":
-        header = file_header % (argv[1], argv[2])
-        file_header = header
-        trident(argv[2])
+    #Writing the counters list to the YAML file
+    if split:
+        for hw_unit, registry in enumerate(units_counters):
+            create_bufmond_yaml(unit_output(output, hw_unit), header,
+                                [registry])
     else:
-        print 'Only trident asic supported for buffer montioring feature'
+        create_bufmond_yaml(output, header, units_counters)
 
 if __name__ == '__main__':
 
-    if len (sys.argv) < 3:
-        print (['Usage:  [trident] [number of ports]',
-            'Please enter chip and number of ports'])
-        sys.exit();
-
     main(sys.argv)
- 
-
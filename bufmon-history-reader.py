@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# Copyright (C) 2014-2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Offline reader of the bufmond --history-file counter history, it does not
+# need ovs nor a running bufmond.
+#   msec,hw_unit_id,name,highest counter_value of the bucket
+# the bucket start being a wall clock time in msec since the epoch,
+# lines are written oldest bucket first.
+
+import sys, getopt
+import fnmatch
+import mmap
+import struct
+
+# Same format as bufmond.py HISTORY_FILE_*.
+HISTORY_FILE_MAGIC = b'BUFMONH\0'
+HISTORY_FILE_VERSION = 3
+HISTORY_FILE_HEADER = struct.Struct('<8sIIIII4x')
+HISTORY_FILE_RECORD = struct.Struct('<q')
+HISTORY_FILE_EMPTY = -1
+
+
+def open_history(path):
+    fh = open(path, 'rb')
+    history = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    fh.close()
+
+    magic, version, counters, buckets, bucket_msec, names_size = \
+        HISTORY_FILE_HEADER.unpack_from(history, 0)
+    if magic != HISTORY_FILE_MAGIC or version != HISTORY_FILE_VERSION:
+        raise ValueError('%s is not a bufmond history file' % path)
+
+    offset = HISTORY_FILE_HEADER.size
+    names = history[offset:offset + names_size].decode().rstrip('\0')
+    keys = [line.split(' ', 1) for line in names.splitlines()]
+    if len(keys) != counters:
+        raise ValueError('%s counters list is truncated' % path)
+
+    stamps = offset + names_size
+    records = stamps + buckets * HISTORY_FILE_RECORD.size
+    if len(history) < records + buckets * counters * HISTORY_FILE_RECORD.size:
+        raise ValueError('%s is truncated' % path)
+
+    # Used buckets, oldest first.
+    starts = []
+    for bucket in range(buckets):
+        start = HISTORY_FILE_RECORD.unpack_from(
+            history, stamps + bucket * HISTORY_FILE_RECORD.size)[0]
+        if start:
+            starts.append((start, records +
+                           bucket * counters * HISTORY_FILE_RECORD.size))
+    starts.sort()
+
+    return history, keys, starts
+
+
+def read_history(history, keys, starts, pattern=None, since=None):
+    selected = [(counter_id, key) for counter_id, key in enumerate(keys)
+                if pattern is None or fnmatch.fnmatchcase(key[1], pattern)]
+
+    for start, slot in starts:
+        if since is not None and start < since:
+            continue
+        for counter_id, key in selected:
+            value = HISTORY_FILE_RECORD.unpack_from(
+                history, slot + counter_id * HISTORY_FILE_RECORD.size)[0]
+            if value != HISTORY_FILE_EMPTY:
+                yield start, key[0], key[1], value
+
+
+def usage():
+    print('\n'.join(['Usage:  [-n pattern] [-s msec] [-p] history file',
+                     '-n, --name   only the counters matching the glob '
+                     'pattern',
+                     '-s, --since  only the buckets starting at or after '
+                     'msec (since the epoch)',
+                     '-p, --peak   only the highest value of each counter']))
+    sys.exit()
+
+
+def main(argv):
+    pattern = None
+    since = None
+    peak = False
+
+    try:
+        opts, args = getopt.getopt(argv[1:], "n:s:p",
+                                   ["name=", "since=", "peak"])
+        for opt, value in opts:
+            if opt in ("-n", "--name"):
+                pattern = value
+            elif opt in ("-s", "--since"):
+                since = int(value)
+            elif opt in ("-p", "--peak"):
+                peak = True
+    except (getopt.GetoptError, ValueError):
+        usage()
+
+    if len(args) != 1:
+        usage()
+
+    try:
+        history, keys, starts = open_history(args[0])
+    except (IOError, ValueError, struct.error) as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+
+    samples = read_history(history, keys, starts, pattern, since)
+
+    if peak:
+        peaks = {}
+        for start, hw_unit_id, name, value in samples:
+            key = (hw_unit_id, name)
+            if key not in peaks or value > peaks[key][1]:
+                peaks[key] = (start, value)
+        samples = sorted((start, key[0], key[1], value)
+                         for key, (start, value) in peaks.items())
+
+    for sample in samples:
+        sys.stdout.write('%d,%s,%s,%d\n' % sample)
+
+if __name__ == '__main__':
+
+    main(sys.argv)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# (c) Copyright [2015-2016] Hewlett Packard Enterprise Development LP
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Dense registry of the buffer monitoring counters, shared by bufmond and
+# bufmon-bcm-helper.py.
+#
+# Every counter gets a dense id in registration order. Its hw_unit_id,
+# name path components and counter_vendor_specific_info pairs are kept in
+# flat arrays of interned string ids, the name and the counter dict are
+# only built again when asked for. A counter costs well under a hundred
+# bytes instead of the two dicts and the name string PyYAML returns.
+
+import array
+import bisect
+
+HW_UNIT_ID = 'hw_unit_id'
+NAME = 'name'
+VENDOR_INFO = 'counter_vendor_specific_info'
+NAME_SEPARATOR = '/'
+
+
+class CounterRegistry(object):
+    '''
+    Counters by dense id. The (hw_unit_id, name) lookup table is only
+    built on the first find().
+    '''
+    __slots__ = ('strings', 'string_ids', 'units', 'names', 'name_offsets',
+                 'info', 'info_offsets', 'hashes', 'hash_ids')
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.units = array.array('l')
+        # Interned name path components, and key, value pairs of the
+        # vendor info, of counter i in [offsets[i], offsets[i + 1]).
+        self.names = array.array('I')
+        self.name_offsets = array.array('I', [0])
+        self.info = array.array('I')
+        self.info_offsets = array.array('I', [0])
+        # hash((hw_unit_id, name)) in sorted order, and their counter ids.
+        self.hashes = None
+        self.hash_ids = None
+
+    def __getstate__(self):
+        # The lookup table is rebuilt on demand, no need to pickle it.
+        return (self.strings, self.units, self.names, self.name_offsets,
+                self.info, self.info_offsets)
+
+    def __setstate__(self, state):
+        (self.strings, self.units, self.names, self.name_offsets,
+         self.info, self.info_offsets) = state
+        self.string_ids = dict((string, string_id) for string_id, string
+                               in enumerate(self.strings))
+        self.hashes = None
+        self.hash_ids = None
+
+    def __len__(self):
+        return len(self.units)
+
+    def __eq__(self, other):
+        # Same counters with the same ids and vendor info. The same
+        # counters registered in the same order intern the same strings.
+        return (isinstance(other, CounterRegistry) and
+                self.units == other.units and
+                self.name_offsets == other.name_offsets and
+                self.names == other.names and
+                self.info_offsets == other.info_offsets and
+                self.info == other.info and
+                self.strings == other.strings)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __iter__(self):
+        return (self.counter(counter_id) for counter_id in range(len(self)))
+
+    def intern(self, string):
+        '''
+        Returns the id of a string, adding it to the strings table
+        '''
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.string_ids[string] = string_id
+            self.strings.append(string)
+        return string_id
+
+    def add(self, hw_unit_id, name, vendor_info=None):
+        '''
+        Registers a counter and returns its id. Duplicates are only
+        collapsed once the lookup table is built (by the first find()):
+        a (hw_unit_id, name) already registered then keeps its id, before
+        that every add() gets a new id
+        '''
+        if self.hashes is not None:
+            counter_id = self.find(hw_unit_id, name)
+            if counter_id is not None:
+                return counter_id
+
+        counter_id = len(self.units)
+        self.units.append(hw_unit_id)
+        intern = self.intern
+        self.names.extend([intern(part)
+                           for part in name.split(NAME_SEPARATOR)])
+        self.name_offsets.append(len(self.names))
+        if vendor_info:
+            # Sorted, equal dicts give equal arrays.
+            for key, value in sorted(vendor_info.items()):
+                self.info.append(intern(key))
+                self.info.append(intern(value))
+        self.info_offsets.append(len(self.info))
+
+        if self.hashes is not None:
+            self.insert_hash(hash((hw_unit_id, name)), counter_id)
+
+        return counter_id
+
+    def insert_hash(self, key_hash, counter_id):
+        index = bisect.bisect_right(self.hashes, key_hash)
+        self.hashes.insert(index, key_hash)
+        self.hash_ids.insert(index, counter_id)
+
+    def build_lookup(self):
+        '''
+        Sorts the hashes of every counter key for find()
+        '''
+        pairs = sorted((hash(self.key(counter_id)), counter_id)
+                       for counter_id in range(len(self)))
+        self.hashes = array.array('l', [key_hash for key_hash, _ in pairs])
+        self.hash_ids = array.array('I', [counter_id
+                                          for _, counter_id in pairs])
+
+    def find(self, hw_unit_id, name):
+        '''
+        Returns the id of the counter (hw_unit_id, name), None when it is
+        not registered
+        '''
+        if self.hashes is None:
+            self.build_lookup()
+
+        key = (hw_unit_id, name)
+        key_hash = hash(key)
+        hashes = self.hashes
+        index = bisect.bisect_left(hashes, key_hash)
+        # The hash only narrows it down, the key is checked.
+        while index < len(hashes) and hashes[index] == key_hash:
+            counter_id = self.hash_ids[index]
+            if self.key(counter_id) == key:
+                return counter_id
+            index += 1
+
+        return None
+
+    def hw_unit_id(self, counter_id):
+        return self.units[counter_id]
+
+    def name_parts(self, counter_id):
+        '''
+        Returns the name path components of a counter
+        '''
+        strings = self.strings
+        return [strings[part] for part in
+                self.names[self.name_offsets[counter_id]:
+                           self.name_offsets[counter_id + 1]]]
+
+    def name(self, counter_id):
+        return NAME_SEPARATOR.join(self.name_parts(counter_id))
+
+    def key(self, counter_id):
+        '''
+        Returns the (hw_unit_id, name) key of a counter
+        '''
+        return (self.units[counter_id], self.name(counter_id))
+
+    def vendor_info(self, counter_id):
+        '''
+        Returns a new counter_vendor_specific_info dict of a counter
+        '''
+        strings = self.strings
+        pairs = self.info[self.info_offsets[counter_id]:
+                          self.info_offsets[counter_id + 1]]
+        return dict((strings[pairs[i]], strings[pairs[i + 1]])
+                    for i in range(0, len(pairs), 2))
+
+    def counter(self, counter_id):
+        '''
+        Returns a new counter dict, as read from the counters file
+        '''
+        return {HW_UNIT_ID: self.units[counter_id],
+                NAME: self.name(counter_id),
+                VENDOR_INFO: self.vendor_info(counter_id)}
+
+    def size(self):
+        '''
+        Returns the bytes used by the counter arrays
+        '''
+        size = 0
+        for values in (self.units, self.names, self.name_offsets,
+                       self.info, self.info_offsets, self.hashes,
+                       self.hash_ids):
+            if values is not None:
+                size += values.itemsize * len(values)
+        return size
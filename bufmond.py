@@ -40,192 +40,2712 @@ counters:
     port: '1'
     priority-group: '1'
   hw_unit_id: 0
+
+The counters of a realm can also be declared once, over index ranges.
+The counters list is then generated for every combination of the
+indexes (the counter names being the innermost loop), missing indexes
+are named NONE:
+
+counter_ranges:
+- realm: ingress-port-priority-group
+  counter_names:
+  - um-share-buffer-count
+  - um-headroom-buffer-count
+  hw_unit_id: 0
+  indexes:
+  - [port, 1, 104]
+  - [priority-group, 1, 8]
  '''
 
-import argparse
-import os
-import sys
-import time
-from time import sleep
+import argparse
+import array
+import bisect
+import cProfile
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import hashlib
+import itertools
+import json
+import marshal
+import mmap
+import os
+import struct
+import sys
+import time
+
+import ovs.dirs
+from ovs.db import error
+from ovs.db import types
+import ovs.daemon
+import ovs.db.idl
+import ovs.poller
+import ovs.stream
+import ovs.timeval
+import ovs.unixctl
+import ovs.unixctl.server
+
+from bufmon_registry import CounterRegistry
+
+# OVS definitions.
+idl = None
+
+# Hardware description file counters stream and capabilities.
+counters_stream = None
+bufmon_info = {}
+
+# Column plans of the counter schemas found in the YAML,
+# counter keys -> [bufmon columns, invalid keys, number of counters].
+bufmon_column_plans = {}
+
+# Tables definitions.
+SYSTEM_TABLE = 'System'
+SUBSYTEM_TABLE = 'Subsystem'
+BUFMON_TABLE = 'bufmon'
+
+# Columns definitions.
+SYSTEM_CUR_CFG = 'cur_cfg'
+SYSTEM_BUFMON_CONFIG_COLUMN = 'bufmon_config'
+SYSTEM_BUFMON_INFO_COLUMN = 'bufmon_info'
+
+SUBSYSTEM_HW_DESC_DIR_COLUMN = 'hw_desc_dir'
+
+BUFMON_HW_UNIT_ID_COLUMN = 'hw_unit_id'
+BUFMON_NAME_COLUMN = 'name'
+BUFMON_COUNTER_VENDOR_INFO_COLUMN = 'counter_vendor_specific_info'
+BUFMO_ENABLED_COLUMN = 'enabled'
+BUFMON_TRIGGER_THRESHHOLD_COLUMN = 'trigger_threshold'
+BUFMON_COUNTER_VALUE_COLUMN = 'counter_value'
+BUFMON_STATUS_COLUMN = 'status'
+
+# Default DB path.
+def_db = 'unix:/var/run/openvswitch/db.sock'
+
+# TODO: Need to pull these from the build env.
+ovs_schema = '/usr/share/openvswitch/vswitch.ovsschema'
+
+# YAML definitions.
+YAML_FILE_NAME = '/bufmond.yaml'
+YAML_FILE_PATH = YAML_FILE_NAME
+YAML_COUNTERS_ROOT = 'counters'
+YAML_COUNTER_RANGES_ROOT = 'counter_ranges'
+YAML_RANGE_REALM = 'realm'
+YAML_RANGE_COUNTER_NAMES = 'counter_names'
+YAML_RANGE_INDEXES = 'indexes'
+YAML_VENDOR_COUNTER_NAME = 'counter_name'
+YAML_VENDOR_REALM = 'realm'
+YAML_NONE_INDEX = 'NONE'
+
+# Parsed YAML cache definitions.
+# Directory of the cache, None keeps it in the OVS run directory: the
+# hw_desc_dir is often read-only.
+BUFMON_CACHE_DIR = None
+BUFMON_CACHE_FILE = '.bufmond.yaml.cache'
+BUFMON_CACHE_VERSION = 3
+# Set once a cache write failed, the next failures are not warned about.
+cache_save_failed = False
+
+# Batched insert definitions.
+# Number of bufmon rows per transaction, 0 inserts all rows in one.
+BUFMON_TXN_BATCH_SIZE = 500
+# Number of batch transactions outstanding in the IDL at a time.
+BUFMON_TXN_MAX_INFLIGHT = 4
+
+# Resident mode definitions.
+# Keep running and reload the YAML when it or hw_desc_dir changes.
+BUFMON_WATCH = False
+# Quiet period coalescing a burst of changes into one reload.
+BUFMON_WATCH_DEBOUNCE_MSEC = 500
+# Stat polling interval when inotify is not available.
+BUFMON_WATCH_POLL_MSEC = 2000
+# Share of the bufmon rows a load may delete before it waits for the
+# operator: bufmon/reload-confirm, or --confirm-deletes at startup.
+BUFMON_MAX_DELETE_PERCENT = 50
+BUFMON_CONFIRM_DELETES = False
+
+# inotify definitions.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+# Only a file written completely or moved in place is reloaded, a new
+# symlink is complete once created.
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+IN_EVENT = struct.Struct('iIII')
+
+# Readiness states.
+BUFMOND_WAIT_SYSTEM = 'waiting for System cur_cfg'
+BUFMOND_WAIT_HW_DESC = 'waiting for Subsystem hw_desc_dir'
+BUFMOND_WAIT_YAML = 'waiting for the hardware description file'
+BUFMOND_READY = 'ready'
+# Seconds to wait for readiness at startup, None waits forever.
+BUFMON_READY_TIMEOUT = None
+
+# Readiness state.
+bufmond_state = BUFMOND_WAIT_SYSTEM
+ready_deadline = None
+
+# Resident mode state.
+watch_fd = None
+watch_dirs = None
+watch_poll_deadline = None
+watch_poll_signature = None
+watch_poll_stable = None
+reload_deadline = None
+loaded_signature = None
+# Signature of the file whose reload waits for bufmon/reload-confirm,
+# and the number of rows it would delete.
+refused_signature = None
+refused_deletes = 0
+reload_confirmed = False
+
+# bufmon table monitoring state.
+# Runtime columns replicated for the optional features reading them, the
+# bufmon table is only kept monitored after loading when one is active.
+bufmon_runtime_columns = []
+# Capabilities of the loaded counters list.
+bufmon_loaded_info = {}
+bufmon_monitored = True
+# Whether the replica is complete since the monitor was last resumed,
+# and the read-only transaction confirming it.
+bufmon_resynced = True
+resync_txn = None
+
+# Lookup index of the loaded counters (resident mode only): the
+# CounterRegistry of the counters by dense id, the ids of the counters
+# by field and value, in id order, and the counter id of the bufmon rows
+# by uuid, None for the rows of no loaded counter.
+BUFMON_INDEX_REALM = 'realm'
+BUFMON_INDEX_STAT = 'stat'
+BUFMON_INDEX_UNIT = 'unit'
+BUFMON_QUERY_MAX_TERMS = 16
+bufmon_counters = None
+bufmon_index = {}
+bufmon_row_ids = {}
+
+# Columns bufmon/set can write (resident mode only), the
+# (conn, counter keys, values) requests waiting for the bufmon table, and
+# the request whose transactions are outstanding, replied to from
+# bufmond_run() once they completed.
+BUFMON_SET_COLUMNS = [BUFMO_ENABLED_COLUMN, BUFMON_TRIGGER_THRESHHOLD_COLUMN]
+bufmon_pending_sets = []
+bufmon_set_job = None
+
+# counter_value observers (resident mode only): hook(counter_id, value,
+# msec) is called for each counter_value update, reset(counters) when a
+# new counters list is indexed. The (columns, hook(counter_id, row))
+# bufmon_row_hooks are called when a row is created or one of the
+# columns changes.
+bufmon_value_hooks = []
+bufmon_reset_hooks = []
+bufmon_row_hooks = []
+sample_msec = 0
+sample_wall_msec = 0
+
+# counter_value history, BUFMON_HISTORY_SAMPLES slots per counter id.
+BUFMON_HISTORY_SAMPLES = 0
+history_values = None
+history_msec = None
+history_count = None
+
+# On-disk counter_value history, read by bufmon-history-reader.py.
+# 32 bytes header, "hw_unit_id name" lines padded to a multiple of 8
+# bytes so the 64-bit records are aligned, the start of each bucket in
+# wall clock msec (0 when unused), so the buckets recorded before a
+# reboot keep their order, then BUFMON_HISTORY_BUCKETS blocks of one
+# record per counter id holding the highest counter_value of the bucket
+# (-1 when no update).
+BUFMON_HISTORY_FILE = None
+BUFMON_HISTORY_BUCKETS = 360
+BUFMON_HISTORY_BUCKET_MSEC = 1000
+HISTORY_FILE_MAGIC = 'BUFMONH\0'
+HISTORY_FILE_VERSION = 3
+HISTORY_FILE_HEADER = struct.Struct('<8sIIIII4x')
+HISTORY_FILE_RECORD = struct.Struct('<q')
+HISTORY_FILE_EMPTY = -1
+history_file = None
+history_file_counters = 0
+history_file_stamps = 0
+history_file_records = 0
+history_file_bucket = None
+history_file_slot = 0
+
+# Software peak-since-last-read of every counter id, -1 when no update.
+# In auto mode the peaks are only tracked when the hardware description
+# sets cap_mode_peak to false.
+SOFT_PEAK_AUTO = 'auto'
+SOFT_PEAK_ON = 'on'
+SOFT_PEAK_OFF = 'off'
+BUFMON_SOFT_PEAK = SOFT_PEAK_AUTO
+BUFMON_CAP_MODE_PEAK = 'cap_mode_peak'
+BUFMON_PEAK_EMPTY = -1
+peak_values = None
+
+# Threshold evaluation: the trigger_threshold of every enabled counter
+# id (-1 when none) and its latest counter_value (-1 when none).
+# Crossings go through a threshold_trigger_rate_limit token bucket and
+# are written back as "Triggered" status once per interval.
+BUFMON_THRESHOLDS = False
+BUFMON_TRIGGER_INTERVAL_MSEC = 1000
+BUFMON_STATUS_TRIGGERED = 'Triggered'
+BUFMON_CONFIG_TRIGGER_ENABLED = 'threshold_trigger_collection_enabled'
+BUFMON_CONFIG_TRIGGER_RATE_LIMIT = 'threshold_trigger_rate_limit'
+BUFMON_DEFAULT_TRIGGER_RATE_LIMIT = 60
+threshold_limits = None
+threshold_values = None
+threshold_rows = None
+threshold_crossed = []
+trigger_pending = set()
+trigger_suppressed = 0
+trigger_tokens = 0.0
+trigger_refill_msec = None
+trigger_deadline = None
+trigger_txn = None
+
+# counter_value snapshots taken when counters go to "Triggered", the
+# last BUFMON_SNAPSHOTS are kept. snapshot_base holds the values of the
+# oldest one, each snapshot [id, msec, triggered ids, changed ids,
+# values] only the values changed since the previous one.
+BUFMON_SNAPSHOTS = 0
+snapshot_live = None
+snapshot_dirty = None
+snapshot_dirty_flags = None
+snapshot_base = None
+snapshots = []
+snapshot_seq = 0
+snapshot_triggered = []
+
+# OpenMetrics exporter on the BUFMON_METRICS passive stream (punix or
+# loopback ptcp). One cached line per counter id, in chunks of
+# METRICS_CHUNK_LINES joined with the HTTP head into metrics_response,
+# rebuilt on the first scrape after a counter_value update.
+BUFMON_METRICS = None
+METRICS_FAMILY = 'bufmon_counter_value'
+METRICS_CHUNK_LINES = 256
+METRICS_MAX_CLIENTS = 16
+METRICS_MAX_REQUEST = 8192
+metrics_pstream = None
+metrics_clients = []
+metrics_prefixes = None
+metrics_values = None
+metrics_lines = None
+metrics_chunks = None
+metrics_dirty = None
+metrics_dirty_flags = None
+metrics_response = None
+metrics_head_size = 0
+
+# counter_value subscriptions on the BUFMON_SUBSCRIBE passive stream.
+# A subscriber sends a name prefix line, then receives one JSON line per
+# IDL update with its matching changed counters. While a line is still
+# being sent, the next updates are coalesced into one, keeping only the
+# latest value of each counter.
+BUFMON_SUBSCRIBE = None
+SUBSCRIBE_MAX_CLIENTS = 16
+SUBSCRIBE_MAX_REQUEST = 4096
+# Time given to a subscriber to send its prefix line before it is
+# dropped, so idle connections do not hold the client slots.
+SUBSCRIBE_PREFIX_TIMEOUT_MSEC = 5000
+subscribe_pstream = None
+subscribe_clients = []
+subscribe_changes = {}
+
+# Load path and main loop instrumentation, replied by bufmon/stats.
+# stats_phases holds the seconds spent in each phase of the last load,
+# stats_counters the events since startup and stats_loop_histogram the
+# main loop iterations by processing time, bucket i counting the ones
+# under STATS_LOOP_BUCKETS_MSEC[i] (the last one the slower ones).
+BUFMON_PROFILE = None
+STATS_WAIT_SYSTEM = 'wait-system'
+STATS_PARSE = 'parse'
+STATS_RECONCILE = 'reconcile'
+STATS_TXN_BUILD = 'txn-build'
+STATS_TXN_COMMIT = 'txn-commit'
+STATS_CONFIG_COMMIT = 'config-commit'
+STATS_LOAD = 'load'
+STATS_LOAD_PHASES = [STATS_PARSE, STATS_RECONCILE, STATS_TXN_BUILD,
+                     STATS_TXN_COMMIT, STATS_CONFIG_COMMIT, STATS_LOAD]
+STATS_COUNTERS = ['loads', 'load-failures', 'rows-inserted', 'rows-updated',
+                  'rows-deleted', 'rows-set', 'invalid-columns',
+                  'idl-wakeups', 'reloads-refused']
+STATS_LOOP_BUCKETS_MSEC = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]
+stats_start = time.time()
+stats_phases = dict.fromkeys(STATS_LOAD_PHASES, 0.0)
+stats_phases[STATS_WAIT_SYSTEM] = None
+stats_counters = dict.fromkeys(STATS_COUNTERS, 0)
+stats_loop_histogram = [0] * (len(STATS_LOOP_BUCKETS_MSEC) + 1)
+stats_loop_max = 0.0
+profiler = None
+
+vlog = ovs.vlog.Vlog("bufmond")
+exiting = False
+seqno = 0
+
+
+def unixctl_exit(conn, unused_argv, unused_aux):
+    global exiting
+    exiting = True
+    conn.reply(None)
+
+
+#------------------ get_bufmond_cache_path() ----------------
+def get_bufmond_cache_path():
+    '''
+    Returns the path of the parsed YAML cache file
+    '''
+    cache_dir = BUFMON_CACHE_DIR
+    if cache_dir is None:
+        cache_dir = ovs.dirs.RUNDIR
+
+    return os.path.join(cache_dir, BUFMON_CACHE_FILE)
+
+
+#------------------ get_bufmond_cache_key() ----------------
+def get_bufmond_cache_key(path):
+    '''
+    Returns the key identifying the YAML file content:
+    (path, mtime, size, sha1 digest)
+    '''
+    sha1 = hashlib.sha1()
+    path = os.path.realpath(path)
+    st = os.stat(path)
+
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 16), b''):
+            sha1.update(chunk)
+
+    return (path, st.st_mtime, st.st_size, sha1.hexdigest())
+
+
+#------------------ load_bufmond_cache() ----------------
+def load_bufmond_cache(cache_key, bufmon_info):
+    '''
+    Opens the parsed YAML cache file.
+    The cache is a stream of marshal records: the header, the records of
+    the YAML file (see stream_bufmond_yaml()), a None end marker and the
+    capability keys.
+    Returns the records stream, or None when the cache is missing or
+    stale.
+    '''
+    try:
+        fh = open(get_bufmond_cache_path(), 'rb')
+    except (IOError, OSError):
+        return None
+
+    try:
+        header = marshal.load(fh)
+    except (EOFError, ValueError, TypeError):
+        header = None
+
+    if header != (BUFMON_CACHE_VERSION, cache_key):
+        fh.close()
+        return None
+
+    return read_bufmond_cache(fh, bufmon_info)
+
+
+#------------------ read_bufmond_cache() ----------------
+def read_bufmond_cache(fh, bufmon_info):
+    '''
+    Yields the records from the cache file one at a time and fills
+    bufmon_info once the records are exhausted. A corrupted cache is
+    removed and the records it is missing are read from the YAML file.
+    '''
+    path = get_bufmond_cache_path()
+    count = 0
+
+    try:
+        record = marshal.load(fh)
+        while record is not None:
+            yield record
+            count += 1
+            record = marshal.load(fh)
+        bufmon_info.update(marshal.load(fh))
+        return
+    except (EOFError, ValueError, TypeError) as e:
+        vlog.warn("bufmond cache %s corrupted (%s), parsing %s"
+                  % (path, e, YAML_FILE_PATH))
+    finally:
+        fh.close()
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+    records = open_bufmond_yaml(bufmon_info)
+    if records is None:
+        raise ValueError("%s has no content" % YAML_FILE_PATH)
+
+    # The cache was written from the same file, its records come first.
+    for record in itertools.islice(records, count, None):
+        yield record
+
+
+#------------------ warn_bufmond_cache_save() ----------------
+def warn_bufmond_cache_save(path, e):
+    '''
+    Warns the first time the cache cannot be written, the loads that
+    follow parse the YAML file again without repeating it
+    '''
+    global cache_save_failed
+
+    if cache_save_failed:
+        vlog.dbg("bufmond cache %s not written: %s" % (path, e))
+        return
+
+    cache_save_failed = True
+    vlog.warn("bufmond cache %s not written: %s, the YAML file is parsed "
+              "on every load (see --cache-dir)" % (path, e))
+
+
+#------------------ save_bufmond_cache() ----------------
+def save_bufmond_cache(cache_key, records, bufmon_info):
+    '''
+    Passes the records stream through, writing every record to the
+    cache file. The cache is only installed once the stream completed,
+    a failed write only stops the cache: the errors reading the YAML
+    file go through.
+    '''
+    path = get_bufmond_cache_path()
+    tmp_path = path + '.tmp'
+    fh = None
+    completed = False
+
+    try:
+        fh = open(tmp_path, 'wb')
+        marshal.dump((BUFMON_CACHE_VERSION, cache_key), fh)
+    except (IOError, OSError) as e:
+        warn_bufmond_cache_save(path, e)
+        fh = discard_bufmond_cache(fh, tmp_path)
+
+    try:
+        for record in records:
+            if fh is not None:
+                try:
+                    marshal.dump(record, fh)
+                except (IOError, OSError, ValueError) as e:
+                    warn_bufmond_cache_save(path, e)
+                    fh = discard_bufmond_cache(fh, tmp_path)
+            yield record
+
+        if fh is not None:
+            try:
+                marshal.dump(None, fh)
+                marshal.dump(bufmon_info, fh)
+                fh.close()
+                os.rename(tmp_path, path)
+                completed = True
+            except (IOError, OSError, ValueError) as e:
+                warn_bufmond_cache_save(path, e)
+    finally:
+        if not completed:
+            discard_bufmond_cache(fh, tmp_path)
+
+
+#------------------ discard_bufmond_cache() ----------------
+def discard_bufmond_cache(fh, tmp_path):
+    '''
+    Closes and removes the cache file being written, returns None
+    '''
+    if fh is None:
+        return None
+
+    fh.close()
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+    return None
+
+
+#------------------ compose_bufmond_node() ----------------
+def compose_bufmond_node(loader, anchors):
+    '''
+    Builds the node of the next YAML value from the loader events.
+    Works with the C parser, which does not expose the composer.
+    The anchored nodes of the document are kept in anchors, for the
+    aliases that follow.
+    '''
+    import yaml
+
+    event = loader.get_event()
+
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise yaml.YAMLError("undefined alias %s at %s"
+                                 % (event.anchor, event.start_mark))
+        return anchors[event.anchor]
+
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value,
+                                 event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark,
+                               event.end_mark, style=event.style)
+
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None,
+                                 flow_style=event.flow_style)
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(compose_bufmond_node(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+
+    elif isinstance(event, yaml.MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None,
+                                flow_style=event.flow_style)
+        while not loader.check_event(yaml.MappingEndEvent):
+            item_key = compose_bufmond_node(loader, anchors)
+            item_value = compose_bufmond_node(loader, anchors)
+            node.value.append((item_key, item_value))
+        node.end_mark = loader.get_event().end_mark
+
+    else:
+        raise yaml.YAMLError("unexpected %s at %s"
+                             % (event.__class__.__name__, event.start_mark))
+
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+
+#------------------ open_bufmond_yaml() ----------------
+def open_bufmond_yaml(bufmon_info):
+    '''
+    Opens the YAML file for streaming.
+    Returns the records stream, or None when the file has no content.
+    '''
+    import yaml
+
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+
+    fh = open(YAML_FILE_PATH)
+    loader = Loader(fh)
+
+    loader.get_event()
+    if not loader.check_event(yaml.DocumentStartEvent):
+        loader.dispose()
+        fh.close()
+        return None
+    loader.get_event()
+    if not loader.check_event(yaml.MappingStartEvent):
+        loader.dispose()
+        fh.close()
+        return None
+    loader.get_event()
+
+    return stream_bufmond_yaml(fh, loader, bufmon_info)
+
+
+#------------------ expand_counter_range() ----------------
+def expand_counter_range(counter_range):
+    '''
+    Yields the counters of a counter_ranges entry one at a time, in the
+    format of the counters list
+    '''
+    try:
+        realm = counter_range[YAML_RANGE_REALM]
+        counter_names = counter_range[YAML_RANGE_COUNTER_NAMES]
+        indexes = counter_range.get(YAML_RANGE_INDEXES) or []
+        hw_unit_id = counter_range.get(BUFMON_HW_UNIT_ID_COLUMN, 0)
+        keys = [key for key, first, last in indexes]
+        ranges = [[str(index) for index in range(first, last + 1)]
+                  for key, first, last in indexes]
+    except (KeyError, TypeError, ValueError):
+        # Never reconcile against a partial counters list.
+        raise ValueError("invalid %s entry %r"
+                         % (YAML_COUNTER_RANGES_ROOT, counter_range))
+
+    padding = [YAML_NONE_INDEX] * max(2 - len(indexes), 0)
+    prefixes = [(counter_name, realm + '/' + counter_name + '/')
+                for counter_name in counter_names]
+
+    for combination in itertools.product(*ranges):
+        suffix = '/'.join(list(combination) + padding)
+        location = dict(zip(keys, combination))
+        for counter_name, prefix in prefixes:
+            counter_vendor_info = {YAML_VENDOR_COUNTER_NAME: counter_name,
+                                   YAML_VENDOR_REALM: realm}
+            counter_vendor_info.update(location)
+            yield {BUFMON_HW_UNIT_ID_COLUMN: hw_unit_id,
+                   BUFMON_NAME_COLUMN: prefix + suffix,
+                   BUFMON_COUNTER_VENDOR_INFO_COLUMN: counter_vendor_info}
+
+
+#------------------ stream_bufmond_yaml() ----------------
+def stream_bufmond_yaml(fh, loader, bufmon_info):
+    '''
+    Yields the records of the YAML file one at a time, only one counter
+    (or one counter range) is ever constructed: the counters, and the
+    counter_ranges entries as (counter_ranges, entry) tuples, expanded
+    by expand_bufmond_records(). The other top level keys (capabilities)
+    are added to bufmon_info.
+    '''
+    import yaml
+
+    roots = (YAML_COUNTERS_ROOT, YAML_COUNTER_RANGES_ROOT)
+
+    anchors = {}
+
+    try:
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = loader.construct_document(compose_bufmond_node(loader,
+                                                                 anchors))
+
+            if key in roots and loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    node = compose_bufmond_node(loader, anchors)
+                    item = loader.construct_document(node)
+                    if key == YAML_COUNTER_RANGES_ROOT:
+                        yield (key, item)
+                    else:
+                        yield item
+                loader.get_event()
+            else:
+                node = compose_bufmond_node(loader, anchors)
+                if key not in roots:
+                    bufmon_info[key] = loader.construct_document(node)
+    finally:
+        loader.dispose()
+        fh.close()
+
+
+#------------------ expand_bufmond_records() ----------------
+def expand_bufmond_records(records):
+    '''
+    Yields the counters of the YAML records, the counter ranges are
+    expanded lazily. The cache keeps the records, so a compact file
+    gives a cache of about its size.
+    '''
+    for record in records:
+        if isinstance(record, tuple):
+            for counter_data in expand_counter_range(record[1]):
+                yield counter_data
+        else:
+            yield record
+
+
+#------------------ parse_bufmond_yaml() ----------------
+def parse_bufmond_yaml():
+    '''
+    Opens the counters stream of the hardware description file in
+    counters_stream, the capabilities are collected to bufmon_info
+    while the stream is consumed.
+    '''
+    global counters_stream
+    global bufmon_info
+
+    bufmon_info = {}
+
+    # Parse the YAML only when the cache does not match the file.
+    cache_key = get_bufmond_cache_key(YAML_FILE_PATH)
+    records = load_bufmond_cache(cache_key, bufmon_info)
+    if records is not None:
+        vlog.dbg("bufmond cache %s loaded" % get_bufmond_cache_path())
+    else:
+        records = open_bufmond_yaml(bufmon_info)
+        if records is None:
+            return False
+        records = save_bufmond_cache(cache_key, records, bufmon_info)
+
+    counters_stream = expand_bufmond_records(records)
+    return True
+
+
+#------------------ ovsdb_set_bufmon_config() ----------------
+def ovsdb_set_bufmon_config():
+    global idl
+    data = {}
+    ret = False
+    # Default values for system table bufmon_config.
+    data["enabled"] = "false"
+    data["counters_mode"] = "peak"
+    data["periodic_collection_enabled"] = "false"
+    data["collection_period"] = "5"
+    data["threshold_trigger_collection_enabled"] = "true"
+    data["threshold_trigger_rate_limit"] = "60"
+    data["threshold_trigger_collection_enabled"] = "true"
+    data["snapshot_on_threshold_trigger"] = "true"
+
+    for ovs_rec in idl.tables[SYSTEM_TABLE].rows.itervalues():
+        # Keep the configuration already done by the user.
+        if not ovs_rec.bufmon_config:
+            setattr(ovs_rec, SYSTEM_BUFMON_CONFIG_COLUMN, data)
+        ret = True
+        break
+
+    return ret
+
+
+#------------------ ovsdb_update_bufmon_info() ----------------
+def ovsdb_set_bufmon_info(ovsrec_bufmon_info):
+    '''
+    Update the counter capability information to System table
+    '''
+    global idl
+    ret = False
+
+    for ovs_rec in idl.tables[SYSTEM_TABLE].rows.itervalues():
+        if ovs_rec.bufmon_info != ovsrec_bufmon_info:
+            setattr(ovs_rec, SYSTEM_BUFMON_INFO_COLUMN, ovsrec_bufmon_info)
+        ret = True
+        break
+
+    return ret
+
+
+#------------------ get_bufmon_column_plan() ----------------
+def get_bufmon_column_plan(table, counter):
+    '''
+    Returns the column plan of the counter keys, built once per counter
+    schema: [bufmon columns to set, invalid keys, number of counters]
+    '''
+    keys = tuple(counter)
+    plan = bufmon_column_plans.get(keys)
+
+    if plan is None:
+        # validate column name present in the bufmon table.
+        columns = tuple(key for key in keys if key in table.columns)
+        invalid = tuple(key for key in keys if key not in table.columns)
+        plan = [columns, invalid, 0]
+        bufmon_column_plans[keys] = plan
+
+    plan[2] += 1
+    return plan
+
+
+#------------------ report_bufmon_invalid_columns() ----------------
+def report_bufmon_invalid_columns():
+    '''
+    Reports each invalid column once, with the number of counters using it
+    '''
+    invalid_columns = {}
+
+    for columns, invalid, count in bufmon_column_plans.itervalues():
+        for column in invalid:
+            invalid_columns[column] = invalid_columns.get(column, 0) + count
+
+    for column, count in sorted(invalid_columns.iteritems()):
+        if count:
+            vlog.warn("bufmon table invalid column '%s' in %d counters"
+                      % (column, count))
+            stats_counters['invalid-columns'] += count
+
+    for plan in bufmon_column_plans.itervalues():
+        plan[2] = 0
+
+
+#------------------ bufmond_dbg_is_enabled() ----------------
+def bufmond_dbg_is_enabled():
+    # Older vlog modules cannot tell, format the debug messages.
+    if not hasattr(vlog, 'dbg_is_enabled'):
+        return True
+
+    return vlog.dbg_is_enabled()
+
+
+#------------------ ovsdb_set_bufmon() ----------------
+def ovsdb_set_bufmon(ovsrec_row, counter, debug=False):
+    '''
+    Update the counter details to bufmon table
+    '''
+    columns = get_bufmon_column_plan(ovsrec_row._table, counter)[0]
+
+    for column in columns:
+        setattr(ovsrec_row, column, counter[column])
+
+    if debug:
+        for column in columns:
+            vlog.dbg("%s %s \n " % (column, counter[column]))
+
+
+#------------------ get_counter_key() ----------------
+def get_counter_key(counter):
+    '''
+    Returns the (hw_unit_id, name) key identifying a counter
+    '''
+    return (counter.get(BUFMON_HW_UNIT_ID_COLUMN, 0),
+            counter.get(BUFMON_NAME_COLUMN))
+
+
+#------------------ get_configured_counters() ----------------
+def get_configured_counters():
+    '''
+    Returns the bufmon table rows indexed by (hw_unit_id, name)
+    '''
+    global idl
+    configured = {}
+
+    for ovs_rec in idl.tables[BUFMON_TABLE].rows.itervalues():
+        configured[(ovs_rec.hw_unit_id, ovs_rec.name)] = ovs_rec
+
+    return configured
+
+
+#------------------ reconcile_bufmon_counters() ----------------
+def reconcile_bufmon_counters(counters_list, configured, max_deletes=None):
+    '''
+    Diffs the YAML counters against the bufmon table rows and yields
+    the (counter, row) changes needed to bring the table in sync:
+    (counter, None) inserts, (None, row) deletes and (counter, row)
+    rewrites counter_vendor_specific_info.
+    The runtime columns of existing rows are never touched.
+    When more than max_deletes rows would go, none is deleted and their
+    number is left in refused_deletes.
+    '''
+    global refused_deletes
+
+    seen = set()
+    refused_deletes = 0
+
+    for counter_data in counters_list:
+        key = get_counter_key(counter_data)
+        if key in seen:
+            vlog.warn("bufmon duplicate counter '%s' unit %s "
+                      % (key[1], key[0]))
+            continue
+        seen.add(key)
+
+        ovs_rec = configured.pop(key, None)
+        if ovs_rec is None:
+            yield (counter_data, None)
+        elif (ovs_rec.counter_vendor_specific_info !=
+              counter_data.get(BUFMON_COUNTER_VENDOR_INFO_COLUMN, {})):
+            yield (counter_data, ovs_rec)
+
+    # Rows left over are no longer described by the YAML.
+    if max_deletes is not None and len(configured) > max_deletes:
+        refused_deletes = len(configured)
+        return
+
+    for ovs_rec in configured.itervalues():
+        yield (None, ovs_rec)
+
+
+#------------------ get_bufmon_max_deletes() ----------------
+def get_bufmon_max_deletes(rows):
+    '''
+    Returns the number of the bufmon table rows a load may delete, None
+    when the operator confirmed the deletes
+    '''
+    if BUFMON_CONFIRM_DELETES or reload_confirmed:
+        return None
+
+    return rows * BUFMON_MAX_DELETE_PERCENT // 100
+
+
+#------------------ get_change_unit() ----------------
+def get_change_unit(change):
+    '''
+    Returns the hw_unit_id of a bufmon table change
+    '''
+    counter_data, ovs_rec = change
+
+    if ovs_rec is not None:
+        return ovs_rec.hw_unit_id
+
+    return counter_data.get(BUFMON_HW_UNIT_ID_COLUMN, 0)
+
+
+#------------------ get_bufmon_batches() ----------------
+def get_bufmon_batches(changes):
+    '''
+    Partitions the bufmon table changes by hw_unit_id and splits them
+    into (hw_unit_id, batch) of BUFMON_TXN_BATCH_SIZE rows, so a
+    transaction never spans two units. A unit batch is yielded as soon
+    as it is full, the first units of the YAML go out first.
+    '''
+    unit_batches = {}
+
+    for change in changes:
+        hw_unit_id = get_change_unit(change)
+        batch = unit_batches.setdefault(hw_unit_id, [])
+        batch.append(change)
+        if len(batch) == BUFMON_TXN_BATCH_SIZE:
+            yield (hw_unit_id, batch)
+            unit_batches[hw_unit_id] = []
+
+    for hw_unit_id in sorted(unit_batches):
+        if unit_batches[hw_unit_id]:
+            yield (hw_unit_id, unit_batches[hw_unit_id])
+
+
+#------------------ ovsdb_apply_bufmon_batch() ----------------
+def ovsdb_apply_bufmon_batch(batch):
+    '''
+    Applies one batch of changes to the bufmon table and sends the
+    transaction without waiting for the reply
+    '''
+    global idl
+
+    txn = ovs.db.idl.Transaction(idl)
+    debug = bufmond_dbg_is_enabled()
+
+    for counter_data, ovs_rec in batch:
+        if ovs_rec is None:
+            ovsrec_bufmon = txn.insert(idl.tables[BUFMON_TABLE])
+            ovsdb_set_bufmon(ovsrec_bufmon, counter_data, debug)
+        elif counter_data is None:
+            ovs_rec.delete()
+        else:
+            setattr(ovs_rec, BUFMON_COUNTER_VENDOR_INFO_COLUMN,
+                    counter_data.get(BUFMON_COUNTER_VENDOR_INFO_COLUMN, {}))
+
+    txn.commit()
+    return txn
+
+
+#------------------ count_bufmon_changes() ----------------
+def count_bufmon_changes(batch):
+    '''
+    Adds the rows of a committed batch to the bufmon/stats counters
+    '''
+    for counter_data, ovs_rec in batch:
+        if ovs_rec is None:
+            stats_counters['rows-inserted'] += 1
+        elif counter_data is None:
+            stats_counters['rows-deleted'] += 1
+        else:
+            stats_counters['rows-updated'] += 1
+
+
+#------------------ commit_bufmon_batches() ----------------
+def commit_bufmon_batches(batches, apply_batch=ovsdb_apply_bufmon_batch,
+                          timers=None):
+    '''
+    Commits the (hw_unit_id, batch) counter batches through apply_batch,
+    keeping up to BUFMON_TXN_MAX_INFLIGHT transactions of any unit
+    outstanding in the IDL. A failed batch only stops the remaining
+    batches of its unit. Batches committed before a failure stay in the
+    bufmon table and are not part of the diff when the daemon restarts.
+    Returns a dictionary of hw_unit_id: True if every batch of the unit
+    got committed, and the number of rows committed. The seconds spent
+    building the transactions and waiting for their replies are added
+    to the txn-build and txn-commit timers.
+    '''
+    global idl
+
+    inflight = []
+    retry = []
+    units = {}
+    changes = 0
+    exhausted = False
+    build = 0.0
+    wait = 0.0
+
+    while True:
+        # Keep the pipeline full.
+        while len(inflight) < BUFMON_TXN_MAX_INFLIGHT:
+            if retry:
+                hw_unit_id, batch = retry.pop(0)
+            elif not exhausted:
+                hw_unit_id, batch = next(batches, (None, None))
+                if batch is None:
+                    exhausted = True
+                    continue
+            else:
+                break
+            if units.setdefault(hw_unit_id, True) is False:
+                continue
+            start = time.time()
+            txn = apply_batch(batch)
+            build += time.time() - start
+            inflight.append((txn, hw_unit_id, batch))
+
+        if not inflight:
+            break
+
+        start = time.time()
+        idl.run()
+
+        pending = []
+        for txn, hw_unit_id, batch in inflight:
+            status = txn.commit()
+            if status == ovs.db.idl.Transaction.INCOMPLETE:
+                pending.append((txn, hw_unit_id, batch))
+            elif status == ovs.db.idl.Transaction.TRY_AGAIN:
+                retry.append((hw_unit_id, batch))
+            elif status in (ovs.db.idl.Transaction.SUCCESS,
+                            ovs.db.idl.Transaction.UNCHANGED):
+                vlog.dbg("Buffer monitoring unit %s batch of %d counters "
+                         "committed" % (hw_unit_id, len(batch)))
+                changes += len(batch)
+                count_bufmon_changes(batch)
+            else:
+                vlog.err("Buffer monitoring unit %s batch transaction "
+                         "status %s " % (hw_unit_id,
+                         ovs.db.idl.Transaction.status_to_string(status)))
+                units[hw_unit_id] = False
+        inflight = pending
+
+        # The batches to try again are sent right away.
+        if inflight and not retry:
+            poller = ovs.poller.Poller()
+            idl.wait(poller)
+            for txn, hw_unit_id, batch in inflight:
+                txn.wait(poller)
+            poller.block()
+        wait += time.time() - start
+
+    if timers is not None:
+        timers[STATS_TXN_BUILD] += build
+        timers[STATS_TXN_COMMIT] += wait
+
+    return units, changes
+
+
+#------------------ index_bufmon_counters() ----------------
+def index_bufmon_counters(counters_list, registry, index):
+    '''
+    Passes the counters through while adding them to the lookup index:
+    registry gives each (hw_unit_id, name) a dense id, index maps
+    field: {value: array of ids}. realm and stat come from the name
+    path, the other fields are the counter_vendor_specific_info indexes.
+    '''
+    seen = set()
+
+    for counter_data in counters_list:
+        key = get_counter_key(counter_data)
+        # Counters the bufmon table can not hold are not indexed.
+        if (key not in seen and isinstance(key[0], (int, long)) and
+                isinstance(key[1], basestring)):
+            seen.add(key)
+            vendor_info = counter_data.get(BUFMON_COUNTER_VENDOR_INFO_COLUMN,
+                                           {})
+            counter_id = registry.add(key[0], key[1], vendor_info)
+
+            path = key[1].split('/')
+            fields = {BUFMON_INDEX_UNIT: str(key[0])}
+            if len(path) >= 2:
+                fields[BUFMON_INDEX_REALM] = path[0]
+                fields[BUFMON_INDEX_STAT] = path[1]
+            else:
+                fields[BUFMON_INDEX_REALM] = vendor_info.get(YAML_VENDOR_REALM)
+                fields[BUFMON_INDEX_STAT] = vendor_info.get(
+                    YAML_VENDOR_COUNTER_NAME)
+            for field, value in vendor_info.iteritems():
+                if field not in (YAML_VENDOR_COUNTER_NAME, YAML_VENDOR_REALM):
+                    fields[field] = str(value)
+
+            for field, value in fields.iteritems():
+                if value is not None:
+                    index.setdefault(field, {}).setdefault(
+                        value, array.array('I')).append(counter_id)
+
+        yield counter_data
+
+
+#------------------ query_bufmon_index() ----------------
+def query_bufmon_index(terms):
+    '''
+    Returns the ids of the loaded counters matching every (field, value)
+    term, in id order. No terms match every counter.
+    '''
+    postings = []
+    for field, value in terms:
+        ids = bufmon_index.get(field, {}).get(value)
+        if not ids:
+            return []
+        postings.append(ids)
+
+    if not postings:
+        return range(len(bufmon_counters))
+
+    # Intersect starting from the most selective term.
+    postings.sort(key=len)
+    matches = set(postings[0])
+    for ids in postings[1:]:
+        matches.intersection_update(ids)
+
+    return sorted(matches)
+
+
+#------------------ select_bufmon_counters() ----------------
+def select_bufmon_counters(terms, pattern=None):
+    '''
+    Returns the ids of the loaded counters matching every (field, value)
+    term and the name glob pattern
+    '''
+    counter_ids = query_bufmon_index(terms)
+
+    if pattern is not None:
+        counter_ids = [counter_id for counter_id in counter_ids
+                       if fnmatch.fnmatchcase(
+                           bufmon_counters.name(counter_id), pattern)]
+
+    return counter_ids
+
+
+#------------------ parse_bufmon_terms() ----------------
+def parse_bufmon_terms(argv, options=()):
+    '''
+    Parses the field=value arguments of the bufmon/* commands into the
+    query terms, the name glob pattern and the {field: value} of the
+    fields in options. Raises ValueError for a malformed argument.
+    '''
+    terms = []
+    pattern = None
+    values = {}
+
+    for arg in argv:
+        field, sep, value = arg.partition('=')
+        if not sep or not field:
+            raise ValueError("invalid term '%s', expected field=value" % arg)
+        field, value = str(field), str(value)
+        if field in options:
+            values[field] = value
+        elif field == BUFMON_NAME_COLUMN:
+            pattern = value
+        else:
+            terms.append((field, value))
+
+    return terms, pattern, values
+
+
+#------------------ unixctl_bufmon_query() ----------------
+def unixctl_bufmon_query(conn, argv, unused_aux):
+    '''
+    bufmon/query [name=PATTERN] [field=value]...
+    Replies the "hw_unit_id name" of the matching counters, one per line
+    '''
+    try:
+        terms, pattern, _ = parse_bufmon_terms(argv)
+    except ValueError as e:
+        conn.reply_error(str(e))
+        return
+
+    if bufmon_counters is None:
+        conn.reply_error("bufmon counters list not loaded")
+        return
+
+    lines = []
+    for counter_id in select_bufmon_counters(terms, pattern):
+        lines.append('%s %s' % bufmon_counters.key(counter_id))
+    conn.reply('\n'.join(lines))
+
+
+#------------------ parse_bufmon_value() ----------------
+def parse_bufmon_value(column, value):
+    '''
+    Converts a bufmon/set value to the python value of the column, an
+    empty value clears an optional column
+    '''
+    if value == '':
+        if not column.type.is_optional():
+            raise ValueError("%s cannot be cleared" % column.name)
+        return []
+
+    atomic_type = column.type.key.type
+    if atomic_type == types.BooleanType:
+        if value not in ('true', 'false'):
+            raise ValueError("%s expects true or false" % column.name)
+        value = value == 'true'
+    elif atomic_type == types.IntegerType:
+        value = int(value)
+    elif atomic_type == types.RealType:
+        value = float(value)
+
+    if column.type.is_scalar():
+        return value
+
+    return [value]
+
+
+#------------------ ovsdb_set_bufmon_batch() ----------------
+def ovsdb_set_bufmon_batch(batch, values):
+    '''
+    Writes the column values to one batch of bufmon rows and sends the
+    transaction without waiting for the reply
+    '''
+    global idl
+
+    txn = ovs.db.idl.Transaction(idl)
+
+    for unused_counter_data, ovs_rec in batch:
+        for column, value in values.iteritems():
+            setattr(ovs_rec, column, value)
+
+    txn.commit()
+    return txn
+
+
+#------------------ bufmond_set_start() ----------------
+def bufmond_set_start(conn, keys, values):
+    '''
+    Returns the job writing the column values to the bufmon rows of the
+    (hw_unit_id, name) keys, only the rows that differ are written
+    '''
+    configured = get_configured_counters()
+    changes = []
+    matched = 0
+
+    for key in keys:
+        ovs_rec = configured.get(key)
+        if ovs_rec is None:
+            continue
+        matched += 1
+        for column, value in values.iteritems():
+            if getattr(ovs_rec, column) != value:
+                changes.append((values, ovs_rec))
+                break
+
+    return {'conn': conn, 'values': values,
+            'batches': get_bufmon_batches(changes), 'inflight': [],
+            'units': {}, 'changed': 0, 'matched': matched,
+            'start': time.time()}
+
+
+#------------------ bufmond_set_step() ----------------
+def bufmond_set_step(job):
+    '''
+    Collects the replies of the outstanding transactions of a bufmon/set
+    job and sends its next batches, keeping up to BUFMON_TXN_MAX_INFLIGHT
+    outstanding. A batch getting TRY_AGAIN is sent again, a failed batch
+    only stops the remaining batches of its unit. Returns True once every
+    batch is done.
+    '''
+    global idl
+
+    units = job['units']
+    inflight = []
+
+    for txn, hw_unit_id, batch in job['inflight']:
+        status = txn.commit()
+        if status == ovs.db.idl.Transaction.INCOMPLETE:
+            inflight.append((txn, hw_unit_id, batch))
+        elif status == ovs.db.idl.Transaction.TRY_AGAIN:
+            # Sent again to the rows still replicated.
+            rows = idl.tables[BUFMON_TABLE].rows
+            batch = [change for change in batch if change[1].uuid in rows]
+            if batch:
+                txn = ovsdb_set_bufmon_batch(batch, job['values'])
+                inflight.append((txn, hw_unit_id, batch))
+        elif status in (ovs.db.idl.Transaction.SUCCESS,
+                        ovs.db.idl.Transaction.UNCHANGED):
+            job['changed'] += len(batch)
+            stats_counters['rows-set'] += len(batch)
+        else:
+            vlog.err("bufmon/set unit %s batch transaction status %s"
+                     % (hw_unit_id,
+                        ovs.db.idl.Transaction.status_to_string(status)))
+            units[hw_unit_id] = False
+
+    while len(inflight) < BUFMON_TXN_MAX_INFLIGHT:
+        hw_unit_id, batch = next(job['batches'], (None, None))
+        if batch is None:
+            break
+        if units.setdefault(hw_unit_id, True) is False:
+            continue
+        txn = ovsdb_set_bufmon_batch(batch, job['values'])
+        inflight.append((txn, hw_unit_id, batch))
+
+    job['inflight'] = inflight
+    return not inflight
+
+
+#------------------ get_bufmond_set_reply() ----------------
+def get_bufmond_set_reply(job):
+    '''
+    Returns the reply of a completed bufmon/set job
+    '''
+    elapsed = (time.time() - job['start']) * 1000
+    reply = ("%d rows changed, %d matched, commit took %.1f ms"
+             % (job['changed'], job['matched'], elapsed))
+    failed_units = sorted(hw_unit_id for hw_unit_id, loaded
+                          in job['units'].iteritems() if not loaded)
+    if failed_units:
+        reply += ", units %s failed" % ' '.join(map(str, failed_units))
+
+    return reply
+
+
+#------------------ bufmond_set_run() ----------------
+def bufmond_set_run():
+    '''
+    Runs the bufmon/set requests one after the other, once the bufmon
+    table is replicated, and replies when their transactions completed
+    '''
+    global bufmon_set_job
+
+    while True:
+        if bufmon_set_job is None:
+            if not bufmon_pending_sets or not bufmond_resync_bufmon():
+                return
+            conn, keys, values = bufmon_pending_sets.pop(0)
+            bufmon_set_job = bufmond_set_start(conn, keys, values)
+
+        if not bufmond_set_step(bufmon_set_job):
+            return
+
+        reply = get_bufmond_set_reply(bufmon_set_job)
+        vlog.info("bufmon/set %s" % reply)
+        bufmon_set_job['conn'].reply(reply)
+        bufmon_set_job = None
+
+        if not bufmon_pending_sets and not is_bufmon_runtime_read():
+            bufmond_monitor_bufmon(False)
+
+
+#------------------ bufmond_set_wait() ----------------
+def bufmond_set_wait(poller):
+    if bufmon_set_job is not None:
+        for txn, hw_unit_id, batch in bufmon_set_job['inflight']:
+            txn.wait(poller)
+
+
+#------------------ unixctl_bufmon_set() ----------------
+def unixctl_bufmon_set(conn, argv, unused_aux):
+    '''
+    bufmon/set [name=PATTERN] [field=value]... column=value...
+    Sets the enabled and trigger_threshold columns of the counters
+    matching every query term and the name glob pattern
+    '''
+    global idl
+
+    if bufmon_counters is None:
+        conn.reply_error("bufmon counters list not loaded")
+        return
+
+    if not BUFMON_WATCH:
+        conn.reply_error("bufmon/set requires --watch")
+        return
+
+    try:
+        terms, pattern, values = parse_bufmon_terms(argv, BUFMON_SET_COLUMNS)
+    except ValueError as e:
+        conn.reply_error(str(e))
+        return
+
+    # Only replicated by a resident daemon.
+    table = idl.tables[BUFMON_TABLE]
+    for field, value in values.items():
+        if field not in table.columns:
+            conn.reply_error("bufmon column %s not replicated" % field)
+            return
+        try:
+            values[field] = parse_bufmon_value(table.columns[field], value)
+        except ValueError as e:
+            conn.reply_error("invalid %s value '%s': %s" % (field, value, e))
+            return
+
+    if not values:
+        conn.reply_error("nothing to set, expected %s"
+                         % ' or '.join(BUFMON_SET_COLUMNS))
+        return
+
+    keys = [bufmon_counters.key(counter_id)
+            for counter_id in select_bufmon_counters(terms, pattern)]
+
+    # Replied once the bufmon table is replicated again and the
+    # transactions completed.
+    bufmon_pending_sets.append((conn, keys, values))
+    bufmond_set_run()
+
+
+#------------------ get_bufmon_column_value() ----------------
+def get_bufmon_column_value(ovs_rec, column):
+    '''
+    Returns the value of a bufmon row column, None when it is not set
+    '''
+    value = getattr(ovs_rec, column)
+
+    # Optional columns come as a list.
+    if isinstance(value, list):
+        if not value:
+            return None
+        value = value[0]
+
+    return value
+
+
+#------------------ get_bufmon_row_counter() ----------------
+def get_bufmon_row_counter(ovs_rec):
+    '''
+    Returns the id of the loaded counter of a bufmon row, None if it is
+    not loaded. The hw_unit_id and name of a row never change, the
+    registry is only searched the first time a row is seen.
+    '''
+    try:
+        return bufmon_row_ids[ovs_rec.uuid]
+    except KeyError:
+        counter_id = bufmon_counters.find(ovs_rec.hw_unit_id, ovs_rec.name)
+        bufmon_row_ids[ovs_rec.uuid] = counter_id
+        return counter_id
+
+
+#------------------ bufmond_notify() ----------------
+def bufmond_notify(event, ovs_rec, updates=None):
+    '''
+    IDL row change notification, passes the changes of the loaded
+    counters to the bufmon_row_hooks and their counter_value updates to
+    the bufmon_value_hooks
+    '''
+    if ovs_rec._table.name != BUFMON_TABLE or bufmon_counters is None:
+        return
+
+    if event == ovs.db.idl.ROW_DELETE:
+        bufmon_row_ids.pop(ovs_rec.uuid, None)
+        return
+
+    counter_id = get_bufmon_row_counter(ovs_rec)
+    if counter_id is None:
+        return
+
+    # updates only holds the columns that changed.
+    for columns, hook in bufmon_row_hooks:
+        if (event == ovs.db.idl.ROW_CREATE or
+                [column for column in columns if column in updates._data]):
+            hook(counter_id, ovs_rec)
+
+    if (event == ovs.db.idl.ROW_UPDATE and
+            BUFMON_COUNTER_VALUE_COLUMN not in updates._data):
+        return
+
+    value = get_bufmon_column_value(ovs_rec, BUFMON_COUNTER_VALUE_COLUMN)
+    if value is None:
+        return
+
+    for hook in bufmon_value_hooks:
+        hook(counter_id, value, sample_msec)
+
+
+#------------------ bufmon_history_reset() ----------------
+def bufmon_history_reset(counters):
+    '''
+    Allocates the history ring buffers of a new counters list, the
+    history of the previous list is dropped
+    '''
+    global history_values
+    global history_msec
+    global history_count
+
+    slots = counters * BUFMON_HISTORY_SAMPLES
+    history_values = array.array('l', [0]) * slots
+    history_msec = array.array('l', [0]) * slots
+    history_count = array.array('L', [0]) * counters
+    vlog.info("bufmon history of %d samples for %d counters"
+              % (BUFMON_HISTORY_SAMPLES, counters))
+
+
+#------------------ bufmon_history_append() ----------------
+def bufmon_history_append(counter_id, value, msec):
+    '''
+    Appends a counter_value sample to the ring buffer of the counter,
+    overwriting its oldest sample once full
+    '''
+    count = history_count[counter_id]
+    slot = (counter_id * BUFMON_HISTORY_SAMPLES +
+            count % BUFMON_HISTORY_SAMPLES)
+    history_values[slot] = value
+    history_msec[slot] = int(msec)
+    history_count[counter_id] = count + 1
+
+
+#------------------ get_bufmon_history() ----------------
+def get_bufmon_history(counter_id, last=None, since=None):
+    '''
+    Returns the (msec, value) samples of the counter, oldest first:
+    at most the last samples, taken at or after the since msec
+    '''
+    count = history_count[counter_id]
+    samples = min(count, BUFMON_HISTORY_SAMPLES)
+    if last is not None:
+        samples = min(samples, last)
+
+    base = counter_id * BUFMON_HISTORY_SAMPLES
+    window = []
+    for seq in xrange(count - samples, count):
+        slot = base + seq % BUFMON_HISTORY_SAMPLES
+        if since is None or history_msec[slot] >= since:
+            window.append((history_msec[slot], history_values[slot]))
+
+    return window
+
+
+#------------------ close_bufmon_history_file() ----------------
+def close_bufmon_history_file():
+    global history_file
+
+    if history_file is not None:
+        history_file.flush()
+        history_file.close()
+        history_file = None
+
+
+#------------------ bufmon_history_file_reset() ----------------
+def bufmon_history_file_reset(counters):
+    '''
+    Maps the history file of a new counters list. The file is reused
+    when it describes the same counters, otherwise it is moved to
+    BUFMON_HISTORY_FILE.old and created again.
+    '''
+    global history_file
+    global history_file_counters
+    global history_file_stamps
+    global history_file_records
+    global history_file_bucket
+
+    close_bufmon_history_file()
+
+    names = ''.join('%s %s\n' % bufmon_counters.key(counter_id)
+                    for counter_id in xrange(counters))
+    names += '\0' * (-len(names) % 8)
+    head = HISTORY_FILE_HEADER.pack(HISTORY_FILE_MAGIC, HISTORY_FILE_VERSION,
+                                    counters, BUFMON_HISTORY_BUCKETS,
+                                    BUFMON_HISTORY_BUCKET_MSEC, len(names))
+    head += names
+    stamps = len(head)
+    records = stamps + BUFMON_HISTORY_BUCKETS * HISTORY_FILE_RECORD.size
+    size = records + (BUFMON_HISTORY_BUCKETS * counters *
+                      HISTORY_FILE_RECORD.size)
+
+    try:
+        fh = open(BUFMON_HISTORY_FILE, 'r+b')
+        if fh.read(len(head)) != head or os.fstat(fh.fileno()).st_size != size:
+            fh.close()
+            os.rename(BUFMON_HISTORY_FILE, BUFMON_HISTORY_FILE + '.old')
+            fh = None
+    except IOError:
+        fh = None
+
+    try:
+        if fh is None:
+            # Unused buckets read as zero stamps.
+            fh = open(BUFMON_HISTORY_FILE, 'w+b')
+            fh.write(head)
+            fh.truncate(size)
+            vlog.info("bufmon history file %s created" % BUFMON_HISTORY_FILE)
+        history_file = mmap.mmap(fh.fileno(), size)
+        fh.close()
+    except (IOError, OSError, mmap.error) as e:
+        vlog.err("bufmon history file %s: %s" % (BUFMON_HISTORY_FILE, e))
+        return
+
+    history_file_counters = counters
+    history_file_stamps = stamps
+    history_file_records = records
+    history_file_bucket = None
+
+
+#------------------ start_bufmon_history_bucket() ----------------
+def start_bufmon_history_bucket(bucket_start):
+    '''
+    Moves the history file to the bucket of bucket_start, wrapping around
+    over the oldest bucket
+    '''
+    global history_file_bucket
+    global history_file_slot
+
+    bucket = (bucket_start // BUFMON_HISTORY_BUCKET_MSEC %
+              BUFMON_HISTORY_BUCKETS)
+    stamp = history_file_stamps + bucket * HISTORY_FILE_RECORD.size
+    slot = (history_file_records +
+            bucket * history_file_counters * HISTORY_FILE_RECORD.size)
+
+    if HISTORY_FILE_RECORD.unpack_from(history_file, stamp)[0] != bucket_start:
+        # Invalidate the bucket while its records are cleared.
+        HISTORY_FILE_RECORD.pack_into(history_file, stamp, 0)
+        history_file[slot:slot + history_file_counters *
+                     HISTORY_FILE_RECORD.size] = (
+            HISTORY_FILE_RECORD.pack(HISTORY_FILE_EMPTY) *
+            history_file_counters)
+        HISTORY_FILE_RECORD.pack_into(history_file, stamp, bucket_start)
+
+    # The kernel writes the shared mapping back, it is only flushed on
+    # close.
+    history_file_bucket = bucket_start
+    history_file_slot = slot
+
+
+#------------------ bufmon_history_file_append() ----------------
+def bufmon_history_file_append(counter_id, value, unused_msec):
+    '''
+    Records a counter_value sample in the current bucket of the history
+    file, in place in the mapping. The buckets follow the wall clock of
+    the IDL run, the monotonic msec restarts at every boot.
+    '''
+    if history_file is None:
+        return
+
+    bucket_start = (sample_wall_msec -
+                    sample_wall_msec % BUFMON_HISTORY_BUCKET_MSEC)
+    if bucket_start != history_file_bucket:
+        start_bufmon_history_bucket(bucket_start)
+
+    offset = history_file_slot + counter_id * HISTORY_FILE_RECORD.size
+    if value > HISTORY_FILE_RECORD.unpack_from(history_file, offset)[0]:
+        HISTORY_FILE_RECORD.pack_into(history_file, offset, value)
+
+
+#------------------ unixctl_bufmon_history() ----------------
+def unixctl_bufmon_history(conn, argv, unused_aux):
+    '''
+    bufmon/history [name=PATTERN] [field=value]... [last=N] [since=MSEC]
+    Replies the "hw_unit_id name: msec:value..." samples of the matching
+    counters, since is an age in milliseconds
+    '''
+    last = None
+    since = None
+
+    try:
+        terms, pattern, values = parse_bufmon_terms(argv, ('last', 'since'))
+    except ValueError as e:
+        conn.reply_error(str(e))
+        return
+
+    for field, value in values.items():
+        try:
+            if field == 'last':
+                last = max(int(value), 0)
+            else:
+                since = int(ovs.timeval.msec()) - int(value)
+        except ValueError:
+            conn.reply_error("invalid %s value '%s'" % (field, value))
+            return
+
+    if history_count is None:
+        conn.reply_error("bufmon history not recorded")
+        return
+
+    lines = []
+    for counter_id in select_bufmon_counters(terms, pattern):
+        window = get_bufmon_history(counter_id, last, since)
+        if window:
+            lines.append('%s %s: ' % bufmon_counters.key(counter_id) +
+                         ' '.join('%d:%d' % sample for sample in window))
+    conn.reply('\n'.join(lines))
+
+
+#------------------ bufmon_peak_reset() ----------------
+def bufmon_peak_reset(counters):
+    '''
+    Allocates the software peaks of a new counters list, unless the
+    hardware tracks the peaks itself
+    '''
+    global peak_values
+
+    if is_soft_peak_enabled():
+        peak_values = array.array('l', [BUFMON_PEAK_EMPTY]) * counters
+    else:
+        peak_values = None
+
+
+#------------------ is_soft_peak_enabled() ----------------
+def is_soft_peak_enabled():
+    '''
+    Returns True if the software peaks are tracked for the loaded
+    capabilities
+    '''
+    if BUFMON_SOFT_PEAK == SOFT_PEAK_AUTO:
+        cap_mode_peak = bufmon_info.get(BUFMON_CAP_MODE_PEAK, True)
+        return str(cap_mode_peak).lower() == 'false'
+    return BUFMON_SOFT_PEAK == SOFT_PEAK_ON
+
+
+#------------------ bufmon_peak_update() ----------------
+def bufmon_peak_update(counter_id, value, unused_msec):
+    if peak_values is not None and value > peak_values[counter_id]:
+        peak_values[counter_id] = value
+
+
+#------------------ unixctl_bufmon_peak() ----------------
+def unixctl_bufmon_peak(conn, argv, unused_aux):
+    '''
+    bufmon/peak [name=PATTERN] [field=value]...
+    Replies the "hw_unit_id name peak" of the matching counters updated
+    since their last read, and starts their next peak period
+    '''
+    try:
+        terms, pattern, _ = parse_bufmon_terms(argv)
+    except ValueError as e:
+        conn.reply_error(str(e))
+        return
+
+    if peak_values is None:
+        conn.reply_error("bufmon software peaks not tracked, the hardware "
+                         "reports them (cap_mode_peak)")
+        return
+
+    lines = []
+    for counter_id in select_bufmon_counters(terms, pattern):
+        peak = peak_values[counter_id]
+        if peak != BUFMON_PEAK_EMPTY:
+            lines.append('%s %s %d' % (bufmon_counters.key(counter_id) +
+                                       (peak,)))
+            peak_values[counter_id] = BUFMON_PEAK_EMPTY
+    conn.reply('\n'.join(lines))
+
+
+#------------------ bufmon_threshold_config() ----------------
+def bufmon_threshold_config(counter_id, ovs_rec):
+    '''
+    Updates the threshold of a counter from its enabled and
+    trigger_threshold columns
+    '''
+    threshold = get_bufmon_column_value(ovs_rec,
+                                        BUFMON_TRIGGER_THRESHHOLD_COLUMN)
+    if (threshold is None or
+            not get_bufmon_column_value(ovs_rec, BUFMO_ENABLED_COLUMN)):
+        threshold = -1
+
+    threshold_limits[counter_id] = threshold
+    threshold_rows[counter_id] = ovs_rec
+
+
+#------------------ get_loaded_bufmon_rows() ----------------
+def get_loaded_bufmon_rows():
+    '''
+    Yields the (counter_id, row) of the replicated bufmon rows of the
+    loaded counters
+    '''
+    for ovs_rec in idl.tables[BUFMON_TABLE].rows.itervalues():
+        counter_id = get_bufmon_row_counter(ovs_rec)
+        if counter_id is not None:
+            yield counter_id, ovs_rec
+
+
+#------------------ bufmon_threshold_reset() ----------------
+def bufmon_threshold_reset(counters):
+    '''
+    Allocates the thresholds and latest values of a new counters list,
+    from the bufmon rows already replicated
+    '''
+    global idl
+    global threshold_limits
+    global threshold_values
+    global threshold_rows
+    global threshold_crossed
+    global trigger_pending
+
+    threshold_limits = array.array('l', [-1]) * counters
+    threshold_values = array.array('l', [-1]) * counters
+    threshold_rows = [None] * counters
+    threshold_crossed = []
+    trigger_pending = set()
+
+    for counter_id, ovs_rec in get_loaded_bufmon_rows():
+        bufmon_threshold_config(counter_id, ovs_rec)
+        value = get_bufmon_column_value(ovs_rec, BUFMON_COUNTER_VALUE_COLUMN)
+        if value is not None:
+            threshold_values[counter_id] = value
+
+
+#------------------ bufmon_threshold_update() ----------------
+def bufmon_threshold_update(counter_id, value, unused_msec):
+    '''
+    Records the counter_value, a counter going from below to at or above
+    its threshold is added to the crossings of the IDL run
+    '''
+    threshold = threshold_limits[counter_id]
+
+    if 0 <= threshold <= value and threshold_values[counter_id] < threshold:
+        threshold_crossed.append(counter_id)
+    threshold_values[counter_id] = value
+
+
+#------------------ get_bufmon_trigger_config() ----------------
+def get_bufmon_trigger_config():
+    '''
+    Returns the System bufmon_config threshold trigger collection enabled
+    and rate limit (reports per minute)
+    '''
+    global idl
+
+    enabled = True
+    rate_limit = BUFMON_DEFAULT_TRIGGER_RATE_LIMIT
+
+    for ovs_rec in idl.tables[SYSTEM_TABLE].rows.itervalues():
+        config = ovs_rec.bufmon_config
+        enabled = (config.get(BUFMON_CONFIG_TRIGGER_ENABLED, 'true').lower()
+                   == 'true')
+        try:
+            rate_limit = max(int(config.get(BUFMON_CONFIG_TRIGGER_RATE_LIMIT,
+                                            rate_limit)), 0)
+        except ValueError:
+            pass
+        break
+
+    return enabled, rate_limit
+
+
+#------------------ bufmon_trigger_report() ----------------
+def bufmon_trigger_report(crossed, rate_limit, now):
+    '''
+    Passes the crossings through the token bucket: rate_limit reports per
+    minute, averaged per second. The reports let through are written on
+    the next interval, a counter already waiting is reported once.
+    A rate_limit of 0 lets no report through.
+    '''
+    global trigger_tokens
+    global trigger_refill_msec
+    global trigger_suppressed
+
+    if rate_limit <= 0:
+        capacity = 0.0
+    else:
+        capacity = max(rate_limit / 60.0, 1.0)
+    if trigger_refill_msec is None:
+        trigger_tokens = capacity
+    else:
+        trigger_tokens = min(capacity, trigger_tokens +
+                             (now - trigger_refill_msec) * rate_limit /
+                             60000.0)
+    trigger_refill_msec = now
+
+    for counter_id in crossed:
+        if counter_id in trigger_pending:
+            continue
+        if trigger_tokens >= 1.0:
+            trigger_tokens -= 1.0
+            trigger_pending.add(counter_id)
+        else:
+            trigger_suppressed += 1
+
+
+#------------------ ovsdb_set_bufmon_triggered() ----------------
+def ovsdb_set_bufmon_triggered():
+    '''
+    Writes the "Triggered" status of the reported counters in one
+    transaction, sent without waiting for the reply
+    '''
+    global idl
+    global trigger_pending
+    global trigger_suppressed
+    global trigger_txn
+
+    rows = idl.tables[BUFMON_TABLE].rows
+    txn = ovs.db.idl.Transaction(idl)
+
+    for counter_id in trigger_pending:
+        ovs_rec = threshold_rows[counter_id]
+        if (ovs_rec is not None and ovs_rec.uuid in rows and
+                get_bufmon_column_value(ovs_rec, BUFMON_STATUS_COLUMN) !=
+                BUFMON_STATUS_TRIGGERED):
+            setattr(ovs_rec, BUFMON_STATUS_COLUMN, BUFMON_STATUS_TRIGGERED)
+
+    if txn.commit() == ovs.db.idl.Transaction.INCOMPLETE:
+        trigger_txn = txn
+
+    vlog.info("bufmon %d counters triggered, %d reports rate limited"
+              % (len(trigger_pending), trigger_suppressed))
+    trigger_pending = set()
+    trigger_suppressed = 0
+
+
+#------------------ bufmon_threshold_run() ----------------
+def bufmon_threshold_run():
+    '''
+    Evaluates the crossings of the last IDL run in bulk and writes the
+    status of the reported counters once per interval
+    '''
+    global threshold_crossed
+    global trigger_deadline
+    global trigger_txn
+
+    if trigger_txn is not None:
+        status = trigger_txn.commit()
+        if status != ovs.db.idl.Transaction.INCOMPLETE:
+            if status not in (ovs.db.idl.Transaction.SUCCESS,
+                              ovs.db.idl.Transaction.UNCHANGED):
+                vlog.warn("bufmon triggered status transaction status %s"
+                          % ovs.db.idl.Transaction.status_to_string(status))
+            trigger_txn = None
+
+    now = ovs.timeval.msec()
+
+    if threshold_crossed:
+        crossed = threshold_crossed
+        threshold_crossed = []
+        enabled, rate_limit = get_bufmon_trigger_config()
+        if enabled:
+            bufmon_trigger_report(crossed, rate_limit, now)
+        if trigger_pending and trigger_deadline is None:
+            trigger_deadline = now + BUFMON_TRIGGER_INTERVAL_MSEC
+
+    # One status transaction outstanding at a time.
+    if (trigger_deadline is not None and now >= trigger_deadline and
+            trigger_txn is None):
+        trigger_deadline = None
+        ovsdb_set_bufmon_triggered()
+
+
+#------------------ bufmon_threshold_wait() ----------------
+def bufmon_threshold_wait(poller):
+    if trigger_txn is not None:
+        trigger_txn.wait(poller)
+    elif trigger_deadline is not None:
+        poller.timer_wait_until(trigger_deadline)
+
+
+#------------------ bufmon_snapshot_reset() ----------------
+def bufmon_snapshot_reset(counters):
+    '''
+    Allocates the live values of a new counters list from the bufmon
+    rows already replicated, the snapshots of the previous list are
+    dropped
+    '''
+    global snapshot_live
+    global snapshot_dirty
+    global snapshot_dirty_flags
+    global snapshot_base
+    global snapshots
+    global snapshot_triggered
+
+    snapshot_live = array.array('l', [-1]) * counters
+    snapshot_dirty = array.array('L')
+    snapshot_dirty_flags = bytearray(counters)
+    snapshot_base = None
+    snapshots = []
+    snapshot_triggered = []
+
+    # The first snapshot copies every live value, no need to track them.
+    for counter_id, ovs_rec in get_loaded_bufmon_rows():
+        value = get_bufmon_column_value(ovs_rec, BUFMON_COUNTER_VALUE_COLUMN)
+        if value is not None:
+            snapshot_live[counter_id] = value
+
+
+#------------------ bufmon_snapshot_update() ----------------
+def bufmon_snapshot_update(counter_id, value, unused_msec):
+    snapshot_live[counter_id] = value
+    if not snapshot_dirty_flags[counter_id]:
+        snapshot_dirty_flags[counter_id] = 1
+        snapshot_dirty.append(counter_id)
+
+
+#------------------ bufmon_snapshot_status() ----------------
+def bufmon_snapshot_status(counter_id, ovs_rec):
+    '''
+    Requests a snapshot when the status of a counter is Triggered
+    '''
+    if (get_bufmon_column_value(ovs_rec, BUFMON_STATUS_COLUMN) ==
+            BUFMON_STATUS_TRIGGERED):
+        snapshot_triggered.append(counter_id)
+
+
+#------------------ bufmon_snapshot_run() ----------------
+def bufmon_snapshot_run():
+    '''
+    Takes the snapshot requested during the last IDL run, once all its
+    updates are applied. Only the values changed since the previous
+    snapshot are copied.
+    '''
+    global snapshot_dirty
+    global snapshot_base
+    global snapshot_seq
+    global snapshot_triggered
+
+    if not snapshot_triggered or snapshot_live is None:
+        return
+
+    snapshot_seq += 1
+    if snapshot_base is None:
+        snapshot_base = array.array('l', snapshot_live)
+        snapshots.append([snapshot_seq, sample_msec,
+                          array.array('L', snapshot_triggered),
+                          array.array('L'), array.array('l')])
+    else:
+        snapshot_dirty = array.array('L', sorted(snapshot_dirty))
+        snapshots.append([snapshot_seq, sample_msec,
+                          array.array('L', snapshot_triggered),
+                          snapshot_dirty,
+                          array.array('l', [snapshot_live[counter_id]
+                                            for counter_id
+                                            in snapshot_dirty])])
+
+    for counter_id in snapshot_dirty:
+        snapshot_dirty_flags[counter_id] = 0
+    snapshot_dirty = array.array('L')
+    snapshot_triggered = []
+
+    # Fold the oldest snapshot into the base.
+    if len(snapshots) > BUFMON_SNAPSHOTS:
+        snapshots.pop(0)
+        changed_ids, values = snapshots[0][3:5]
+        for counter_id, value in itertools.izip(changed_ids, values):
+            snapshot_base[counter_id] = value
+        snapshots[0][3:5] = [array.array('L'), array.array('l')]
+
+    vlog.info("bufmon snapshot %d taken, %d counters triggered"
+              % (snapshot_seq, len(snapshots[-1][2])))
+
+
+#------------------ get_bufmon_snapshot() ----------------
+def get_bufmon_snapshot(seq):
+    '''
+    Returns the counter values of the snapshot seq, None when it is not
+    kept
+    '''
+    values = None
+
+    for snapshot in snapshots:
+        if snapshot[0] > seq:
+            break
+        if values is None:
+            values = array.array('l', snapshot_base)
+        for counter_id, value in itertools.izip(snapshot[3], snapshot[4]):
+            values[counter_id] = value
+        if snapshot[0] == seq:
+            return values
+
+    return None
+
+
+#------------------ unixctl_bufmon_snapshots() ----------------
+def unixctl_bufmon_snapshots(conn, unused_argv, unused_aux):
+    '''
+    bufmon/snapshots
+    Replies "id msec triggered changed" for every snapshot kept, followed
+    by the names of the counters that triggered it
+    '''
+    if snapshot_live is None:
+        conn.reply_error("bufmon snapshots not taken")
+        return
+
+    lines = []
+    size = snapshot_base.itemsize * len(snapshot_base) if snapshots else 0
+    for seq, msec, triggered, changed_ids, values in snapshots:
+        lines.append('%d %d %d %d' % (seq, msec, len(triggered),
+                                      len(changed_ids)))
+        for counter_id in triggered:
+            lines.append('    %s %s' % bufmon_counters.key(counter_id))
+        size += (triggered.itemsize * len(triggered) +
+                 changed_ids.itemsize * len(changed_ids) +
+                 values.itemsize * len(values))
+    lines.append('%d snapshots, %d bytes' % (len(snapshots), size))
+    conn.reply('\n'.join(lines))
+
+
+#------------------ unixctl_bufmon_snapshot() ----------------
+def unixctl_bufmon_snapshot(conn, argv, unused_aux):
+    '''
+    bufmon/snapshot ID [name=PATTERN] [field=value]...
+    Replies the "hw_unit_id name value" of the matching counters in the
+    snapshot ID
+    '''
+    try:
+        terms, pattern, _ = parse_bufmon_terms(argv[1:])
+    except ValueError as e:
+        conn.reply_error(str(e))
+        return
+
+    try:
+        values = get_bufmon_snapshot(int(argv[0]))
+    except ValueError:
+        values = None
+    if values is None:
+        conn.reply_error("no bufmon snapshot %s" % argv[0])
+        return
+
+    lines = []
+    for counter_id in select_bufmon_counters(terms, pattern):
+        if values[counter_id] != -1:
+            lines.append('%s %s %d' % (bufmon_counters.key(counter_id) +
+                                       (values[counter_id],)))
+    conn.reply('\n'.join(lines))
+
+
+#------------------ get_bufmon_metrics_prefix() ----------------
+def get_bufmon_metrics_prefix(labels):
+    '''
+    Returns the series of a counter, labelled with its index fields
+    '''
+    pairs = []
+    for field, value in sorted(labels):
+        value = (value.replace('\\', '\\\\').replace('"', '\\"')
+                 .replace('\n', '\\n'))
+        pairs.append('%s="%s"' % (field.replace('-', '_'), value))
+
+    return '%s{%s} ' % (METRICS_FAMILY, ','.join(pairs))
+
+
+#------------------ bufmon_metrics_reset() ----------------
+def bufmon_metrics_reset(counters):
+    '''
+    Builds the series of a new counters list from the lookup index, with
+    the counter_value of the bufmon rows already replicated
+    '''
+    global metrics_prefixes
+    global metrics_values
+    global metrics_lines
+    global metrics_chunks
+    global metrics_dirty
+    global metrics_dirty_flags
+    global metrics_response
+
+    labels = [[] for counter_id in xrange(counters)]
+    for field, values in bufmon_index.iteritems():
+        for value, counter_ids in values.iteritems():
+            for counter_id in counter_ids:
+                labels[counter_id].append((field, value))
+
+    metrics_prefixes = [get_bufmon_metrics_prefix(counter_labels)
+                        for counter_labels in labels]
+    metrics_values = array.array('l', [-1]) * counters
+    metrics_lines = [''] * counters
+    metrics_chunks = [''] * (-(-counters // METRICS_CHUNK_LINES))
+    metrics_dirty = array.array('L')
+    metrics_dirty_flags = bytearray(counters)
+    metrics_response = None
+
+    # Counters that keep their value are exported too.
+    for counter_id, ovs_rec in get_loaded_bufmon_rows():
+        value = get_bufmon_column_value(ovs_rec, BUFMON_COUNTER_VALUE_COLUMN)
+        if value is not None:
+            bufmon_metrics_update(counter_id, value, sample_msec)
+
+
+#------------------ bufmon_metrics_update() ----------------
+def bufmon_metrics_update(counter_id, value, unused_msec):
+    if value != metrics_values[counter_id]:
+        metrics_values[counter_id] = value
+        if not metrics_dirty_flags[counter_id]:
+            metrics_dirty_flags[counter_id] = 1
+            metrics_dirty.append(counter_id)
+
+
+#------------------ get_bufmon_metrics_head() ----------------
+def get_bufmon_metrics_head(status, content_type, length):
+    return ('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+            'Connection: close\r\n\r\n' % (status, content_type, length))
+
+
+#------------------ get_bufmon_metrics_exposition() ----------------
+def get_bufmon_metrics_exposition():
+    '''
+    Returns the 200 response holding the OpenMetrics exposition, cached
+    until a counter_value changes. Only the lines of the counters
+    updated since the last scrape are rendered again.
+    '''
+    global metrics_dirty
+    global metrics_response
+    global metrics_head_size
+
+    if metrics_response is not None and not metrics_dirty:
+        return metrics_response
+
+    chunks = set()
+    for counter_id in metrics_dirty:
+        metrics_dirty_flags[counter_id] = 0
+        metrics_lines[counter_id] = '%s%d\n' % (metrics_prefixes[counter_id],
+                                                metrics_values[counter_id])
+        chunks.add(counter_id // METRICS_CHUNK_LINES)
+    metrics_dirty = array.array('L')
+
+    for chunk in chunks:
+        first = chunk * METRICS_CHUNK_LINES
+        metrics_chunks[chunk] = ''.join(
+            metrics_lines[first:first + METRICS_CHUNK_LINES])
+
+    body = (['# TYPE %s gauge\n' % METRICS_FAMILY,
+             '# HELP %s Last counter_value of the bufmon counters.\n'
+             % METRICS_FAMILY] + metrics_chunks + ['# EOF\n'])
+    head = get_bufmon_metrics_head(
+        '200 OK', 'application/openmetrics-text; version=1.0.0; '
+        'charset=utf-8', sum(len(part) for part in body))
+
+    # Joined once, every scrape sends this string.
+    metrics_response = ''.join([head] + body)
+    metrics_head_size = len(head)
+
+    return metrics_response
+
+
+#------------------ get_bufmon_metrics_response() ----------------
+def get_bufmon_metrics_response(request):
+    '''
+    Returns the HTTP response to a scrape request
+    '''
+    method = request.split(' ', 1)[0]
+
+    if metrics_prefixes is not None and method in ('GET', 'HEAD'):
+        response = get_bufmon_metrics_exposition()
+        if method == 'HEAD':
+            return response[:metrics_head_size]
+        return response
+
+    if metrics_prefixes is None:
+        status, body = '503 Service Unavailable', 'counters list not loaded\n'
+    else:
+        status, body = '405 Method Not Allowed', ''
+
+    head = get_bufmon_metrics_head(status, 'text/plain', len(body))
+    if method == 'HEAD':
+        return head
+
+    return head + body
+
+
+#------------------ is_local_pstream() ----------------
+def is_local_pstream(name):
+    '''
+    Returns True for a punix:PATH or a ptcp:IP:PORT bound to a loopback
+    address
+    '''
+    if name.startswith('punix:'):
+        return True
+
+    if not name.startswith('ptcp:'):
+        return False
+
+    remote = name.split(':')
+    return (len(remote) == 3 and
+            (remote[1] == 'localhost' or remote[1].startswith('127.')))
+
+
+#------------------ bufmon_metrics_open() ----------------
+def bufmon_metrics_open():
+    global metrics_pstream
+
+    error, metrics_pstream = ovs.stream.PassiveStream.open(BUFMON_METRICS)
+    if error:
+        ovs.util.ovs_fatal(error, "could not listen on %s" % BUFMON_METRICS,
+                           vlog)
+
+
+#------------------ bufmon_metrics_run() ----------------
+def bufmon_metrics_run():
+    '''
+    Accepts the scrapers and serves them one response each
+    '''
+    global metrics_clients
+
+    while len(metrics_clients) < METRICS_MAX_CLIENTS:
+        error, stream = metrics_pstream.accept()
+        if error:
+            break
+        # [stream, request received, response, bytes sent]
+        metrics_clients.append([stream, '', None, 0])
+
+    clients = []
+    for client in metrics_clients:
+        stream, request, response, sent = client
+        if response is None:
+            error, data = stream.recv(METRICS_MAX_REQUEST)
+            if error == errno.EAGAIN:
+                clients.append(client)
+                continue
+            request += data
+            if (error or not data or '\r\n\r\n' in request or
+                    len(request) >= METRICS_MAX_REQUEST):
+                if error or not data:
+                    stream.close()
+                    continue
+                response = get_bufmon_metrics_response(request)
+            else:
+                client[1] = request
+                clients.append(client)
+                continue
+
+        # A view, the exposition is not copied.
+        retval = stream.send(memoryview(response)[sent:])
+        if retval == -errno.EAGAIN:
+            retval = 0
+        elif retval < 0:
+            stream.close()
+            continue
+        sent += retval
+        if sent < len(response):
+            client[1:] = [request, response, sent]
+            clients.append(client)
+        else:
+            stream.close()
+
+    metrics_clients = clients
+
 
-import ovs.dirs
-from ovs.db import error
-from ovs.db import types
-import ovs.daemon
-import ovs.db.idl
-import ovs.unixctl
-import ovs.unixctl.server
+#------------------ bufmon_metrics_wait() ----------------
+def bufmon_metrics_wait(poller):
+    if len(metrics_clients) < METRICS_MAX_CLIENTS:
+        metrics_pstream.wait(poller)
 
-# OVS definitions.
-idl = None
+    for stream, request, response, sent in metrics_clients:
+        if response is None:
+            stream.recv_wait(poller)
+        else:
+            stream.send_wait(poller)
 
-# Tables definitions.
-SYSTEM_TABLE = 'System'
-SUBSYTEM_TABLE = 'Subsystem'
-BUFMON_TABLE = 'bufmon'
 
-# Columns definitions.
-SYSTEM_CUR_CFG = 'cur_cfg'
-SYSTEM_BUFMON_CONFIG_COLUMN = 'bufmon_config'
-SYSTEM_BUFMON_INFO_COLUMN = 'bufmon_info'
+#------------------ get_bufmon_subscribe_mask() ----------------
+def get_bufmon_subscribe_mask(prefix):
+    '''
+    Returns the counter ids flags of the loaded counters whose name
+    starts with prefix
+    '''
+    mask = bytearray(len(bufmon_counters))
 
-SUBSYSTEM_HW_DESC_DIR_COLUMN = 'hw_desc_dir'
+    for counter_id in xrange(len(bufmon_counters)):
+        if bufmon_counters.name(counter_id).startswith(prefix):
+            mask[counter_id] = 1
 
-BUFMON_HW_UNIT_ID_COLUMN = 'hw_unit_id'
-BUFMON_NAME_COLUMN = 'name'
-BUFMON_COUNTER_VENDOR_INFO_COLUMN = 'counter_vendor_specific_info'
-BUFMO_ENABLED_COLUMN = 'enabled'
-BUFMON_TRIGGER_THRESHHOLD_COLUMN = 'trigger_threshold'
-BUFMON_COUNTER_VALUE_COLUMN = 'counter_value'
-BUFMON_STATUS_COLUMN = 'status'
+    return mask
 
-# Default DB path.
-def_db = 'unix:/var/run/openvswitch/db.sock'
 
-# TODO: Need to pull these from the build env.
-ovs_schema = '/usr/share/openvswitch/vswitch.ovsschema'
+#------------------ bufmon_subscribe_reset() ----------------
+def bufmon_subscribe_reset(counters):
+    '''
+    Matches the subscriptions against a new counters list, the changes
+    pending for the previous list are dropped
+    '''
+    global subscribe_changes
 
-# YAML definitions.
-YAML_FILE_PATH = '/bufmond.yaml'
-YAML_COUNTERS_ROOT = 'counters'
+    subscribe_changes = {}
+    for client in subscribe_clients:
+        if client['prefix'] is not None:
+            client['mask'] = get_bufmon_subscribe_mask(client['prefix'])
+            client['pending'] = {}
 
-vlog = ovs.vlog.Vlog("bufmond")
-exiting = False
-seqno = 0
 
+#------------------ bufmon_subscribe_update() ----------------
+def bufmon_subscribe_update(counter_id, value, unused_msec):
+    if subscribe_clients:
+        subscribe_changes[counter_id] = value
 
-def unixctl_exit(conn, unused_argv, unused_aux):
-    global exiting
-    exiting = True
-    conn.reply(None)
 
+#------------------ bufmon_subscribe_flush() ----------------
+def bufmon_subscribe_flush(client):
+    '''
+    Formats the changes pending for a subscriber into its next line, once
+    the previous one is sent
+    '''
+    pending = client['pending']
 
-#------------------ parse_bufmond_yaml() ----------------
-def parse_bufmond_yaml():
-    import yaml
-    global yaml_data
+    if not pending or client['output'] is not None:
+        return
 
-    try:
-        from yaml import CLoader as Loader
-    except ImportError:
-        from yaml import Loader
+    counters = [list(bufmon_counters.key(counter_id)) + [pending[counter_id]]
+                for counter_id in sorted(pending)]
+    client['output'] = json.dumps({'msec': client['msec'],
+                                   'coalesced': client['batches'],
+                                   'counters': counters},
+                                  separators=(',', ':')) + '\n'
+    client['sent'] = 0
+    client['pending'] = {}
+    client['batches'] = 0
 
-    with open(YAML_FILE_PATH) as fh:
-        yaml_data = yaml.load(fh, Loader=Loader) or {}
 
-    return yaml_data != {}
+#------------------ bufmon_subscribe_publish() ----------------
+def bufmon_subscribe_publish():
+    '''
+    Queues the changes of the last IDL run to the matching subscribers,
+    a subscriber still sending a line gets them merged into its next one
+    '''
+    global subscribe_changes
 
+    changes = subscribe_changes
+    subscribe_changes = {}
 
-#------------------ ovsdb_set_bufmon_config() ----------------
-def ovsdb_set_bufmon_config():
-    global idl
-    data = {}
-    ret = False
-    # Default values for system table bufmon_config.
-    data["enabled"] = "false"
-    data["counters_mode"] = "peak"
-    data["periodic_collection_enabled"] = "false"
-    data["collection_period"] = "5"
-    data["threshold_trigger_collection_enabled"] = "true"
-    data["threshold_trigger_rate_limit"] = "60"
-    data["threshold_trigger_collection_enabled"] = "true"
-    data["snapshot_on_threshold_trigger"] = "true"
+    for client in subscribe_clients:
+        mask = client['mask']
+        if mask is None:
+            continue
 
-    for ovs_rec in idl.tables[SYSTEM_TABLE].rows.itervalues():
-        setattr(ovs_rec, SYSTEM_BUFMON_CONFIG_COLUMN, data)
-        ret = True
-        break
+        pending = client['pending']
+        matched = False
+        for counter_id, value in changes.iteritems():
+            if mask[counter_id]:
+                pending[counter_id] = value
+                matched = True
+        if matched:
+            client['batches'] += 1
+            client['msec'] = sample_msec
 
-    return ret
+        bufmon_subscribe_flush(client)
 
 
-#------------------ ovsdb_update_bufmon_info() ----------------
-def ovsdb_set_bufmon_info(ovsrec_bufmon_info):
+#------------------ bufmon_subscribe_open() ----------------
+def bufmon_subscribe_open():
+    global subscribe_pstream
+
+    error, subscribe_pstream = ovs.stream.PassiveStream.open(
+        BUFMON_SUBSCRIBE)
+    if error:
+        ovs.util.ovs_fatal(error, "could not listen on %s"
+                           % BUFMON_SUBSCRIBE, vlog)
+
+
+#------------------ bufmon_subscribe_run() ----------------
+def bufmon_subscribe_run():
     '''
-    Update the counter capability information to System table
+    Accepts the subscribers, reads their prefix and sends their updates
     '''
-    global idl
-    ret = False
+    global subscribe_clients
 
-    for ovs_rec in idl.tables[SYSTEM_TABLE].rows.itervalues():
-        setattr(ovs_rec, SYSTEM_BUFMON_INFO_COLUMN, ovsrec_bufmon_info)
-        ret = True
-        break
+    now = ovs.timeval.msec()
+    while len(subscribe_clients) < SUBSCRIBE_MAX_CLIENTS:
+        error, stream = subscribe_pstream.accept()
+        if error:
+            break
+        deadline = now + SUBSCRIBE_PREFIX_TIMEOUT_MSEC
+        subscribe_clients.append({'stream': stream, 'request': '',
+                                  'prefix': None, 'deadline': deadline,
+                                  'mask': None, 'pending': {},
+                                  'batches': 0, 'msec': 0,
+                                  'output': None, 'sent': 0})
+
+    bufmon_subscribe_publish()
+
+    clients = []
+    for client in subscribe_clients:
+        stream = client['stream']
+
+        # Reads the prefix, then only watches for the subscriber leaving.
+        error, data = stream.recv(SUBSCRIBE_MAX_REQUEST)
+        if error != errno.EAGAIN:
+            if error or not data:
+                stream.close()
+                continue
+            if client['prefix'] is None:
+                client['request'] += data
+                if '\n' in client['request']:
+                    client['prefix'] = client['request'].split('\n', 1)[0]
+                    client['prefix'] = client['prefix'].rstrip('\r')
+                    client['request'] = None
+                    if bufmon_counters is not None:
+                        client['mask'] = get_bufmon_subscribe_mask(
+                            client['prefix'])
+                elif len(client['request']) >= SUBSCRIBE_MAX_REQUEST:
+                    stream.close()
+                    continue
+
+        if client['prefix'] is None and now >= client['deadline']:
+            vlog.dbg("bufmon subscriber %s sent no prefix, dropped"
+                     % stream.name)
+            stream.close()
+            continue
 
-    return ret
+        if client['output'] is not None:
+            output = memoryview(client['output'])
+            retval = stream.send(output[client['sent']:])
+            if retval < 0 and retval != -errno.EAGAIN:
+                stream.close()
+                continue
+            client['sent'] += max(retval, 0)
+            if client['sent'] == len(client['output']):
+                client['output'] = None
+                bufmon_subscribe_flush(client)
 
+        clients.append(client)
 
-#------------------ ovsdb_set_bufmon() ----------------
-def ovsdb_set_bufmon(ovsrec_row, counter):
+    subscribe_clients = clients
+
+
+#------------------ bufmon_subscribe_wait() ----------------
+def bufmon_subscribe_wait(poller):
+    if len(subscribe_clients) < SUBSCRIBE_MAX_CLIENTS:
+        subscribe_pstream.wait(poller)
+
+    for client in subscribe_clients:
+        client['stream'].recv_wait(poller)
+        if client['prefix'] is None:
+            poller.timer_wait_until(client['deadline'])
+        if client['output'] is not None:
+            client['stream'].send_wait(poller)
+
+
+#------------------ time_bufmon_stream() ----------------
+def time_bufmon_stream(stream, phase):
     '''
-    Update the counter details to bufmon table
+    Passes the items of a stream through, adding the seconds spent
+    producing them to the phase timer
     '''
-    for column, value in counter.iteritems():
-        # validate column name present in the bufmon table.
-        if column not in ovsrec_row._table.columns:
-            vlog.warn("bufmon table invalid column '%s' " % column)
-            continue
+    start = time.time()
+    for item in stream:
+        stats_phases[phase] += time.time() - start
+        yield item
+        start = time.time()
+    stats_phases[phase] += time.time() - start
+
+
+#------------------ bufmon_stats_loop() ----------------
+def bufmon_stats_loop(elapsed):
+    '''
+    Adds a main loop iteration of elapsed seconds to the histogram
+    '''
+    global stats_loop_max
+
+    msec = elapsed * 1000
+    stats_loop_histogram[bisect.bisect_right(STATS_LOOP_BUCKETS_MSEC,
+                                             msec)] += 1
+    if msec > stats_loop_max:
+        stats_loop_max = msec
+
+
+#------------------ unixctl_bufmon_stats() ----------------
+def unixctl_bufmon_stats(conn, unused_argv, unused_aux):
+    '''
+    bufmon/stats
+    Replies the phase timers of the last load in msec, the counters since
+    startup and the main loop iterations histogram
+    '''
+    lines = []
+    for phase in [STATS_WAIT_SYSTEM] + STATS_LOAD_PHASES:
+        if stats_phases[phase] is None:
+            lines.append('%s: -' % phase)
         else:
-            setattr(ovsrec_row, column, value)
-            vlog.dbg("%s %s \n " % (column, value))
+            lines.append('%s: %.1f ms' % (phase, stats_phases[phase] * 1000))
+
+    for counter in STATS_COUNTERS:
+        lines.append('%s: %d' % (counter, stats_counters[counter]))
+
+    lines.append('loop: %d iterations, max %.1f ms'
+                 % (sum(stats_loop_histogram), stats_loop_max))
+    for bound, count in zip(STATS_LOOP_BUCKETS_MSEC, stats_loop_histogram):
+        lines.append('loop <%d ms: %d' % (bound, count))
+    lines.append('loop >=%d ms: %d' % (STATS_LOOP_BUCKETS_MSEC[-1],
+                                      stats_loop_histogram[-1]))
+    conn.reply('\n'.join(lines))
+
+
+#------------------ bufmond_profile_stop() ----------------
+def bufmond_profile_stop():
+    '''
+    Writes the cProfile dump of the startup path to BUFMON_PROFILE
+    '''
+    global profiler
+
+    if profiler is None:
+        return
+
+    profiler.disable()
+    try:
+        profiler.dump_stats(BUFMON_PROFILE)
+        vlog.info("bufmond startup profile written to %s" % BUFMON_PROFILE)
+    except (IOError, OSError) as e:
+        vlog.err("bufmond startup profile %s not written: %s"
+                 % (BUFMON_PROFILE, e))
+    profiler = None
 
 
 #------------------ update_bufmond_config() ----------------
 def update_bufmond_config():
     '''
     Update the YAML content to the OVS-DB
-    Update the global configuration to System Table
     Update the ASIC supported buffer counters to bufmon Table
+    Update the global configuration to System Table
+    Only the differences between the YAML and the bufmon table are
+    written, in per hw_unit_id batches. A failed unit does not roll back
+    the others. The System table is updated last, once at least one
+    unit got loaded.
     '''
 
-    global yaml_data
+    global counters_stream
+    global bufmon_info
     global idl
     global seqno
+    global bufmon_counters
+    global bufmon_index
+    global bufmon_loaded_info
 
-    ovsrec_openvswitch = {}
-    ovsrec_bufmon = {}
     bufmon_global_config = {}
     ret = False
 
-    # create the transaction.
     seqno = idl.change_seqno
-    txn = ovs.db.idl.Transaction(idl)
 
-    # create new row in system table to update the configuration.
-    ovsrec_openvswitch = idl.tables[SYSTEM_TABLE].rows.itervalues()
+    # The lookup index only serves the unixctl queries of a resident
+    # daemon.
+    if BUFMON_WATCH:
+        registry = CounterRegistry()
+        index = {}
+        counters_stream = index_bufmon_counters(counters_stream,
+                                                registry, index)
+
+    # Insert, update or delete the counters that differ from the YAML.
+    start = time.time()
+    timers = [STATS_PARSE, STATS_TXN_BUILD, STATS_TXN_COMMIT]
+    timed = sum(stats_phases[phase] for phase in timers)
+    configured = get_configured_counters()
+    rows = len(configured)
+    max_deletes = get_bufmon_max_deletes(rows)
+    changes = reconcile_bufmon_counters(counters_stream, configured,
+                                        max_deletes)
+    units, changes = commit_bufmon_batches(get_bufmon_batches(changes),
+                                           timers=stats_phases)
+    counters_stream = None
+    report_bufmon_invalid_columns()
+
+    # The counters are parsed as the diff consumes them.
+    stats_phases[STATS_RECONCILE] = (
+        time.time() - start -
+        (sum(stats_phases[phase] for phase in timers) - timed))
+
+    if changes:
+        vlog.info("bufmon table reconciled, %d counters changed" % changes)
+
+    # A truncated YAML must not empty the table, the counters it does
+    # describe are in sync but the load is not complete.
+    if refused_deletes:
+        vlog.warn("bufmon load would delete %d of %d counters, %s to "
+                  "apply it" % (refused_deletes, rows,
+                                "run bufmon/reload-confirm" if BUFMON_WATCH
+                                else "start bufmond with --confirm-deletes"))
+        return False
 
-    if ovsrec_openvswitch is None:
+    failed_units = sorted(hw_unit_id for hw_unit_id, loaded
+                          in units.iteritems() if not loaded)
+    for hw_unit_id in failed_units:
+        vlog.err("bufmon counters of unit %s not loaded" % hw_unit_id)
+    if units and len(failed_units) == len(units):
         return False
 
+    # The capabilities are complete once the counters stream is consumed.
+    for key, value in bufmon_info.iteritems():
+        bufmon_global_config[key] = str(value)
+
+    # create the transaction.
+    txn = ovs.db.idl.Transaction(idl)
+
     # Default configurations.
     if ovsdb_set_bufmon_config() is False:
+        txn.abort()
         return False
 
-    # Insert new row for each counter in OVS-DB.
-    if yaml_data.get(YAML_COUNTERS_ROOT) is not None:
-        for key, value in yaml_data.iteritems():
-            if YAML_COUNTERS_ROOT in key:
-                counters_list = yaml_data[YAML_COUNTERS_ROOT]
-                # Add the list of buffer monitoring counters.
-                for counter_data in counters_list:
-                    ovsrec_bufmon = txn.insert(idl.tables[BUFMON_TABLE])
-                    ret = ovsdb_set_bufmon(ovsrec_bufmon,
-                                           counter_data)
-            else:
-                    bufmon_global_config[key] = str(value)
-
     # Update the system table bufmon_info column.
-    if bufmon_global_config is not None:
-        ret = ovsdb_set_bufmon_info(bufmon_global_config)
+    ret = ovsdb_set_bufmon_info(bufmon_global_config)
 
     # commit the transaction.
+    start = time.time()
     status = txn.commit_block()
+    stats_phases[STATS_CONFIG_COMMIT] = time.time() - start
     vlog.dbg("Buffer monitoring transaction status %s "
              % (ovs.db.idl.Transaction.status_to_string(status)))
 
-    if ret is True and status != ovs.db.idl.Transaction.SUCCESS:
+    if ret is True and status not in (ovs.db.idl.Transaction.SUCCESS,
+                                      ovs.db.idl.Transaction.UNCHANGED):
         ret = False
 
+    # Failed units are retried on the next reconfiguration.
+    if failed_units:
+        ret = False
+
+    if ret is True and BUFMON_WATCH:
+        # The counter ids only change when the counters list does, the
+        # features also start over when the capabilities change.
+        changed = (registry != bufmon_counters or
+                   bufmon_info != bufmon_loaded_info)
+        bufmon_counters = registry
+        bufmon_loaded_info = dict(bufmon_info)
+        bufmon_index = index
+        if changed:
+            bufmon_row_ids.clear()
+        vlog.dbg("bufmon lookup index of %d counters, %d bytes"
+                 % (len(registry), registry.size()))
+        if changed:
+            for reset in bufmon_reset_hooks:
+                reset(len(registry))
+
     return ret
 
 
@@ -246,6 +2766,19 @@ def db_get_system_status(data):
     return False
 
 
+#------------------ get_hw_desc_dir_status() ----------------
+def get_hw_desc_dir_status(data):
+    '''
+    Checks the hardware description directory is published
+    Subsystem:hw_desc_dir
+    '''
+    for ovs_rec in data[SUBSYTEM_TABLE].rows.itervalues():
+        if ovs_rec.hw_desc_dir:
+            return True
+
+    return False
+
+
 #------------------ get_bufmond_yaml_file_status() ----------------
 def get_bufmond_yaml_file_status(data):
     '''
@@ -260,50 +2793,323 @@ def get_bufmond_yaml_file_status(data):
     for ovs_rec in data[SUBSYTEM_TABLE].rows.itervalues():
         if ovs_rec.hw_desc_dir:
             if not ovs_rec.hw_desc_dir is None:
-                YAML_FILE_PATH = ovs_rec.hw_desc_dir + YAML_FILE_PATH
+                YAML_FILE_PATH = ovs_rec.hw_desc_dir + YAML_FILE_NAME
                 return os.path.exists(YAML_FILE_PATH)
 
     return False
 
 
+#------------------ set_bufmond_state() ----------------
+def set_bufmond_state(state):
+    global bufmond_state
+    global ready_deadline
+
+    if state != bufmond_state:
+        vlog.info('bufmond %s' % state)
+        bufmond_state = state
+
+    # The startup timeout no longer applies.
+    if state == BUFMOND_READY:
+        ready_deadline = None
+
+
 #------------------ system_is_configured() ----------------
 def system_is_configured():
+    '''
+    Readiness state machine, driven by the IDL changes of System:cur_cfg
+    and Subsystem:hw_desc_dir (and the file watch in resident mode)
+    '''
     global idl
     global exiting
     global YAML_FILE_PATH
 
     # Check the OVS-DB/File status to see if initialization has completed.
     if not db_get_system_status(idl.tables):
-        # Delay a little before trying again.
-        sleep(1)
+        set_bufmond_state(BUFMOND_WAIT_SYSTEM)
+        return False
+    elif not get_hw_desc_dir_status(idl.tables):
+        set_bufmond_state(BUFMOND_WAIT_HW_DESC)
         return False
     elif not get_bufmond_yaml_file_status(idl.tables):
+        if BUFMON_WATCH:
+            # Wait for the file to show up.
+            bufmond_watch_update()
+            set_bufmond_state(BUFMOND_WAIT_YAML)
+            return False
         exiting = True
         vlog.info('File %s not found. bufmond Exiting' % YAML_FILE_PATH)
         return False
 
+    set_bufmond_state(BUFMOND_READY)
     return True
 
 
-#------------------ check_counters_list_is_empty() ----------------
-def check_counters_list_is_empty():
+#------------------ bufmond_ready_run() ----------------
+def bufmond_ready_run():
+    global exiting
+
+    if (ready_deadline is not None and
+            ovs.timeval.msec() >= ready_deadline):
+        exiting = True
+        vlog.err('bufmond not ready after %s seconds, %s. bufmond Exiting'
+                 % (BUFMON_READY_TIMEOUT, bufmond_state))
+
+
+#------------------ get_bufmond_yaml_signature() ----------------
+def get_bufmond_yaml_signature():
+    '''
+    Returns the (path, real path, mtime, size) of the YAML file,
+    None if the file does not exist
+    '''
+    try:
+        st = os.stat(YAML_FILE_PATH)
+    except OSError:
+        return None
+
+    return (YAML_FILE_PATH, os.path.realpath(YAML_FILE_PATH),
+            st.st_mtime, st.st_size)
+
+
+#------------------ bufmond_watch_update() ----------------
+def bufmond_watch_update():
+    '''
+    Watches the directories of the YAML file and of its symlink target
+    with inotify. Stat polling is used when inotify is not available.
+    '''
+    global watch_fd
+    global watch_dirs
+    global watch_poll_deadline
+
+    # hw_desc_dir is not known yet.
+    if YAML_FILE_PATH == YAML_FILE_NAME:
+        return
+
+    dirs = set([os.path.dirname(YAML_FILE_PATH),
+                os.path.dirname(os.path.realpath(YAML_FILE_PATH))])
+    if dirs == watch_dirs:
+        return
+    watch_dirs = dirs
+
+    if watch_fd is not None:
+        os.close(watch_fd)
+        watch_fd = None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+    except (OSError, AttributeError):
+        fd = -1
+
+    if fd < 0:
+        vlog.info('inotify not available, polling %s every %d ms'
+                  % (YAML_FILE_PATH, BUFMON_WATCH_POLL_MSEC))
+        watch_poll_deadline = ovs.timeval.msec() + BUFMON_WATCH_POLL_MSEC
+        return
+
+    for path in dirs:
+        if libc.inotify_add_watch(fd, path, IN_WATCH_MASK) < 0:
+            vlog.warn('inotify watch on %s failed' % path)
+    watch_fd = fd
+    watch_poll_deadline = None
+
+
+#------------------ is_bufmond_yaml_event() ----------------
+def is_bufmond_yaml_event(events):
+    '''
+    Returns True if a buffer of inotify events has one completing the
+    YAML file or its symlink target: written and closed, moved in place,
+    or created as a symlink
+    '''
+    names = set([os.path.basename(YAML_FILE_PATH),
+                 os.path.basename(os.path.realpath(YAML_FILE_PATH))])
+    offset = 0
+
+    while offset + IN_EVENT.size <= len(events):
+        _, mask, _, length = IN_EVENT.unpack_from(events, offset)
+        offset += IN_EVENT.size
+        name = events[offset:offset + length].rstrip('\0')
+        offset += length
+        if name not in names:
+            continue
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            return True
+        if mask & IN_CREATE and os.path.islink(YAML_FILE_PATH):
+            return True
+
+    return False
+
+
+#------------------ bufmond_watch_run() ----------------
+def bufmond_watch_run():
+    '''
+    Schedules a reload when the YAML file changed, each new change
+    postpones the reload by BUFMON_WATCH_DEBOUNCE_MSEC.
+    Reloads once the changes settled. Without inotify, a change is only
+    taken once, on the first poll finding the file kept the same size and
+    mtime for a poll interval.
+    '''
+    global watch_poll_deadline
+    global watch_poll_signature
+    global watch_poll_stable
+    global reload_deadline
+
+    now = ovs.timeval.msec()
+    changed = False
+
+    if watch_fd is not None:
+        try:
+            while True:
+                events = os.read(watch_fd, 4096)
+                if not events:
+                    break
+                if is_bufmond_yaml_event(events):
+                    changed = True
+        except OSError:
+            pass
+    elif watch_poll_deadline is not None and now >= watch_poll_deadline:
+        watch_poll_deadline = now + BUFMON_WATCH_POLL_MSEC
+        signature = get_bufmond_yaml_signature()
+        changed = (signature == watch_poll_signature and
+                   signature != watch_poll_stable)
+        watch_poll_signature = signature
+        if changed:
+            watch_poll_stable = signature
+
+    if changed and get_bufmond_yaml_signature() != loaded_signature:
+        reload_deadline = now + BUFMON_WATCH_DEBOUNCE_MSEC
+
+    if reload_deadline is not None and now >= reload_deadline:
+        reload_deadline = None
+        vlog.info('File %s changed, reloading' % YAML_FILE_PATH)
+        bufmond_reconfigure()
+    elif resync_txn is not None:
+        bufmond_reconfigure()
+
+
+#------------------ unixctl_bufmon_reload_confirm() ----------------
+def unixctl_bufmon_reload_confirm(conn, unused_argv, unused_aux):
+    '''
+    Applies the reload refused for deleting most of the bufmon table
+    '''
+    global refused_signature
+    global reload_confirmed
+    global reload_deadline
+
+    if refused_signature is None:
+        conn.reply_error("no reload waiting for confirmation")
+        return
+
+    if get_bufmond_yaml_signature() != refused_signature:
+        conn.reply_error("%s changed since the reload was refused"
+                         % YAML_FILE_PATH)
+        return
+
+    refused_signature = None
+    reload_confirmed = True
+    reload_deadline = ovs.timeval.msec()
+    conn.reply("reloading %s" % YAML_FILE_PATH)
+
+
+#------------------ bufmond_watch_wait() ----------------
+def bufmond_watch_wait(poller):
+    if watch_fd is not None:
+        poller.fd_wait(watch_fd, ovs.poller.POLLIN)
+    elif watch_poll_deadline is not None:
+        poller.timer_wait_until(watch_poll_deadline)
+
+    if reload_deadline is not None:
+        poller.timer_wait_until(reload_deadline)
+
+    if resync_txn is not None:
+        resync_txn.wait(poller)
+
+
+#------------------ bufmond_monitor_bufmon() ----------------
+def bufmond_monitor_bufmon(enable):
+    '''
+    Resumes or drops the replication of the bufmon table, when the IDL
+    supports conditional monitoring
+    '''
+    global idl
+    global bufmon_monitored
+
+    if (enable == bufmon_monitored or not hasattr(idl, 'cond_change') or
+            not hasattr(idl, 'send_cond_change')):
+        return
+
+    if enable:
+        idl.cond_change(BUFMON_TABLE, [True])
+    else:
+        idl.cond_change(BUFMON_TABLE, [False])
+    # Sent now, ahead of the transactions that follow.
+    idl.send_cond_change()
+    bufmon_monitored = enable
+    vlog.dbg('bufmon table monitoring %s'
+             % ('resumed' if enable else 'dropped'))
+
+
+#------------------ is_bufmon_runtime_read() ----------------
+def is_bufmon_runtime_read():
     '''
-    Checks list of counters already configured in the OVS-DB
-    If counter rows not exits : return True
-    else: return False and Exit
+    Returns True if an optional feature reads the runtime columns of the
+    loaded counters. The software peaks are only read when tracked for
+    the loaded capabilities.
     '''
+    if peak_values is not None or bufmon_row_hooks:
+        return True
+    return any(hook is not bufmon_peak_update for hook in bufmon_value_hooks)
 
+
+#------------------ ovsdb_send_bufmon_barrier() ----------------
+def ovsdb_send_bufmon_barrier():
+    '''
+    Sends a read-only transaction fetching System:cur_cfg. ovsdb-server
+    handles the requests of a session in order, the reply comes after
+    the updates of the monitor_cond_change sent before it.
+    '''
     global idl
-    global exiting
 
-    # counters list already configured avoid over writing.
-    for ovs_rec in idl.tables[BUFMON_TABLE].rows.itervalues():
-        if ovs_rec is not None:
-            # Exiting Daemon.
-            exiting = True
-            vlog.info('bufmon counters list already configured')
-            return False
+    txn = ovs.db.idl.Transaction(idl)
+    for ovs_rec in idl.tables[SYSTEM_TABLE].rows.itervalues():
+        ovs_rec.fetch(SYSTEM_CUR_CFG)
+        break
+    txn.commit()
+    return txn
+
+
+#------------------ bufmond_resync_bufmon() ----------------
+def bufmond_resync_bufmon():
+    '''
+    Makes sure the bufmon table replica is complete before reconciling.
+    Returns False until ovsdb-server acknowledged the resumed monitor,
+    whether it sent rows back or the table is empty.
+    '''
+    global bufmon_resynced
+    global resync_txn
+
+    if not bufmon_monitored:
+        bufmond_monitor_bufmon(True)
+        bufmon_resynced = False
 
+    if bufmon_resynced:
+        return True
+
+    if resync_txn is None:
+        resync_txn = ovsdb_send_bufmon_barrier()
+
+    status = resync_txn.commit()
+    if status == ovs.db.idl.Transaction.INCOMPLETE:
+        return False
+
+    resync_txn = None
+    if status not in (ovs.db.idl.Transaction.SUCCESS,
+                      ovs.db.idl.Transaction.UNCHANGED):
+        # Disconnected, sent again on the next database change.
+        vlog.dbg("bufmon resync transaction status %s"
+                 % ovs.db.idl.Transaction.status_to_string(status))
+        return False
+
+    bufmon_resynced = True
     return True
 
 
@@ -329,38 +3135,97 @@ def bufmond_init(remote):
                                     SYSTEM_BUFMON_INFO_COLUMN])
     schema_helper.register_columns(SUBSYTEM_TABLE,
                                    [SUBSYSTEM_HW_DESC_DIR_COLUMN, ])
+    # Only the columns identifying the counters are replicated, switchd
+    # statistics pushes to counter_value and status do not wake bufmond.
+    # A resident daemon also writes the bufmon/set columns.
+    set_columns = [column for column in BUFMON_SET_COLUMNS
+                   if BUFMON_WATCH and column not in bufmon_runtime_columns]
     schema_helper.register_columns(BUFMON_TABLE,
                                    [BUFMON_HW_UNIT_ID_COLUMN,
                                     BUFMON_NAME_COLUMN,
-                                    BUFMON_COUNTER_VENDOR_INFO_COLUMN,
-                                    BUFMO_ENABLED_COLUMN,
-                                    BUFMON_TRIGGER_THRESHHOLD_COLUMN,
-                                    BUFMON_COUNTER_VALUE_COLUMN,
-                                    BUFMON_STATUS_COLUMN])
+                                    BUFMON_COUNTER_VENDOR_INFO_COLUMN] +
+                                   bufmon_runtime_columns + set_columns)
 
     idl = ovs.db.idl.Idl(remote, schema_helper)
 
+    if bufmon_value_hooks:
+        idl.notify = bufmond_notify
+
 
 #------------------ bufmond_reconfigure() ----------------
 def bufmond_reconfigure():
 
+    global loaded_signature
+    global refused_signature
+    global reload_confirmed
+    global reload_deadline
+    global counters_stream
+
     # System configuration is not completed.
     if system_is_configured() is False:
         return
 
-    # Check the counter list is already populated in OVS-DB.
-    if check_counters_list_is_empty() is False:
-        return
+    if stats_phases[STATS_WAIT_SYSTEM] is None:
+        stats_phases[STATS_WAIT_SYSTEM] = time.time() - stats_start
+
+    if BUFMON_WATCH:
+        bufmond_watch_update()
+        signature = get_bufmond_yaml_signature()
+        # Nothing changed, a burst of changes is still settling, or the
+        # reload waits for bufmon/reload-confirm.
+        if (signature in (loaded_signature, refused_signature) or
+                reload_deadline is not None):
+            return
+        if not bufmond_resync_bufmon():
+            return
+
+    for phase in STATS_LOAD_PHASES:
+        stats_phases[phase] = 0.0
+    start = time.time()
 
     # Parse the bufmond counters list YAML file.
     if parse_bufmond_yaml() is False:
+        stats_counters['load-failures'] += 1
         return
+    stats_phases[STATS_PARSE] = time.time() - start
+    counters_stream = time_bufmon_stream(counters_stream, STATS_PARSE)
 
     # Update the counters to OVS-DB.
-    if update_bufmond_config() is False:
+    loaded = update_bufmond_config()
+    reload_confirmed = False
+    stats_phases[STATS_LOAD] = time.time() - start
+    if refused_deletes:
+        stats_counters['reloads-refused'] += 1
+        if not BUFMON_WATCH:
+            vlog.err('bufmon counters list not loaded. bufmond Exiting')
+            terminate()
+            return
+        refused_signature = signature
+        return
+    if loaded is False:
+        stats_counters['load-failures'] += 1
+        if BUFMON_WATCH:
+            # Try again later.
+            reload_deadline = ovs.timeval.msec() + BUFMON_WATCH_POLL_MSEC
         return
 
-    # Counters list added successfully Exiting the Daemon.
+    stats_counters['loads'] += 1
+    bufmond_profile_stop()
+
+    if BUFMON_WATCH:
+        loaded_signature = signature
+        refused_signature = None
+        vlog.info('bufmon counters list loaded in %.1f ms, watching %s'
+                  % (stats_phases[STATS_LOAD] * 1000, YAML_FILE_PATH))
+        # Nothing reads the bufmon table until the next reload.
+        if not is_bufmon_runtime_read():
+            bufmond_monitor_bufmon(False)
+        return
+
+    vlog.info('bufmon counters list loaded in %.1f ms'
+              % (stats_phases[STATS_LOAD] * 1000))
+
+    # Counters list reconciled successfully Exiting the Daemon.
     terminate()
 
 
@@ -369,17 +3234,59 @@ def bufmond_run():
 
     global idl
     global seqno
+    global sample_msec
+    global sample_wall_msec
 
+    # The updates of one run are timestamped together, ovs.timeval.msec()
+    # is a float.
+    sample_msec = int(ovs.timeval.msec())
+    sample_wall_msec = int(time.time() * 1000)
     idl.run()
 
     if seqno != idl.change_seqno:
+        stats_counters['idl-wakeups'] += 1
         bufmond_reconfigure()
         seqno = idl.change_seqno
 
+    bufmond_ready_run()
+
+    if BUFMON_WATCH:
+        bufmond_watch_run()
+        bufmond_set_run()
+
+    if BUFMON_THRESHOLDS:
+        bufmon_threshold_run()
+
+    if BUFMON_SNAPSHOTS:
+        bufmon_snapshot_run()
+
+    if BUFMON_METRICS is not None:
+        bufmon_metrics_run()
+
+    if BUFMON_SUBSCRIBE is not None:
+        bufmon_subscribe_run()
+
 
 #------------------ bufmond_wait() ----------------
-def bufmond_wait():
-        pass
+def bufmond_wait(poller):
+
+    # Readiness changes wake up through idl.wait(), only the timeout
+    # needs a timer.
+    if ready_deadline is not None:
+        poller.timer_wait_until(ready_deadline)
+
+    if BUFMON_WATCH:
+        bufmond_watch_wait(poller)
+        bufmond_set_wait(poller)
+
+    if BUFMON_THRESHOLDS:
+        bufmon_threshold_wait(poller)
+
+    if BUFMON_METRICS is not None:
+        bufmon_metrics_wait(poller)
+
+    if BUFMON_SUBSCRIBE is not None:
+        bufmon_subscribe_wait(poller)
 
 
 #------------------ main() ----------------
@@ -388,11 +3295,118 @@ def main():
     global exiting
     global idl
     global seqno
+    global BUFMON_CACHE_DIR
+    global BUFMON_TXN_BATCH_SIZE
+    global BUFMON_TXN_MAX_INFLIGHT
+    global BUFMON_WATCH
+    global BUFMON_CONFIRM_DELETES
+    global BUFMON_WATCH_DEBOUNCE_MSEC
+    global BUFMON_READY_TIMEOUT
+    global BUFMON_HISTORY_SAMPLES
+    global BUFMON_HISTORY_FILE
+    global BUFMON_HISTORY_BUCKETS
+    global BUFMON_HISTORY_BUCKET_MSEC
+    global BUFMON_SOFT_PEAK
+    global BUFMON_THRESHOLDS
+    global BUFMON_SNAPSHOTS
+    global BUFMON_METRICS
+    global BUFMON_SUBSCRIBE
+    global BUFMON_PROFILE
+    global ready_deadline
+    global profiler
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--database', metavar="DATABASE",
                         help="A socket on which ovsdb-server is listening.",
                         dest='database')
+    parser.add_argument('--cache-dir', metavar="DIR",
+                        default=BUFMON_CACHE_DIR,
+                        help="Directory of the parsed YAML cache, "
+                             "defaults to the OVS run directory.",
+                        dest='cache_dir')
+    parser.add_argument('-b', '--batch-size', metavar="ROWS", type=int,
+                        default=BUFMON_TXN_BATCH_SIZE,
+                        help="Number of bufmon rows inserted per "
+                             "transaction, 0 inserts all rows at once.",
+                        dest='batch_size')
+    parser.add_argument('--max-inflight', metavar="TXNS", type=int,
+                        default=BUFMON_TXN_MAX_INFLIGHT,
+                        help="Number of batch transactions outstanding "
+                             "at a time.",
+                        dest='max_inflight')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="Keep running and reload the counters list "
+                             "when the hardware description file changes.",
+                        dest='watch')
+    parser.add_argument('--confirm-deletes', action='store_true',
+                        help="Let the load delete more than half of the "
+                             "bufmon table rows, as a counters list of "
+                             "another platform does.",
+                        dest='confirm_deletes')
+    parser.add_argument('--debounce', metavar="MSEC", type=int,
+                        default=BUFMON_WATCH_DEBOUNCE_MSEC,
+                        help="Quiet period after a change of the hardware "
+                             "description file before reloading.",
+                        dest='debounce')
+    parser.add_argument('--ready-timeout', metavar="SEC", type=int,
+                        default=BUFMON_READY_TIMEOUT,
+                        help="Exit if the system is not configured or the "
+                             "hardware description file is not found "
+                             "within SEC seconds.",
+                        dest='ready_timeout')
+    parser.add_argument('--history', metavar="SAMPLES", type=int, default=0,
+                        help="Keep the last SAMPLES counter_value updates "
+                             "of every counter in memory, requires --watch.",
+                        dest='history')
+    parser.add_argument('--history-file', metavar="FILE",
+                        help="Record the highest counter_value of every "
+                             "counter per time bucket in FILE, requires "
+                             "--watch.",
+                        dest='history_file')
+    parser.add_argument('--history-buckets', metavar="BUCKETS", type=int,
+                        default=BUFMON_HISTORY_BUCKETS,
+                        help="Number of time buckets kept in the history "
+                             "file before wrapping around.",
+                        dest='history_buckets')
+    parser.add_argument('--history-bucket-msec', metavar="MSEC", type=int,
+                        default=BUFMON_HISTORY_BUCKET_MSEC,
+                        help="Duration of a history file time bucket.",
+                        dest='history_bucket_msec')
+    parser.add_argument('--soft-peak', choices=[SOFT_PEAK_AUTO, SOFT_PEAK_ON,
+                                                SOFT_PEAK_OFF],
+                        default=BUFMON_SOFT_PEAK,
+                        help="Track the peak counter_value of every counter "
+                             "since its last bufmon/peak read: auto (the "
+                             "default) when the hardware description sets "
+                             "cap_mode_peak to false, on for every ASIC, "
+                             "off. Only in --watch mode.",
+                        dest='soft_peak')
+    parser.add_argument('--thresholds', action='store_true',
+                        help="Evaluate the trigger_threshold of the enabled "
+                             "counters and set their status to Triggered, "
+                             "rate limited by threshold_trigger_rate_limit. "
+                             "Requires --watch.",
+                        dest='thresholds')
+    parser.add_argument('--snapshots', metavar="COUNT", type=int, default=0,
+                        help="Keep a snapshot of every counter_value for "
+                             "the last COUNT times a counter status went to "
+                             "Triggered. Requires --watch.",
+                        dest='snapshots')
+    parser.add_argument('--metrics', metavar="PSTREAM",
+                        help="Serve the counter values in the OpenMetrics "
+                             "text format on PSTREAM (punix:PATH or "
+                             "ptcp:127.0.0.1:PORT). Requires --watch.",
+                        dest='metrics')
+    parser.add_argument('--subscribe', metavar="PSTREAM",
+                        help="Stream the counter_value changes as JSON lines "
+                             "to the subscribers of PSTREAM (punix:PATH or "
+                             "ptcp:127.0.0.1:PORT), filtered by the name "
+                             "prefix line they send. Requires --watch.",
+                        dest='subscribe')
+    parser.add_argument('--profile', metavar="FILE",
+                        help="Write a cProfile dump of the startup path, "
+                             "up to the first counters list load, to FILE.",
+                        dest='profile')
 
     ovs.vlog.add_args(parser)
     ovs.daemon.add_args(parser)
@@ -405,27 +3419,151 @@ def main():
     else:
         remote = args.database
 
+    BUFMON_CACHE_DIR = args.cache_dir
+    BUFMON_TXN_BATCH_SIZE = max(args.batch_size, 0)
+    BUFMON_TXN_MAX_INFLIGHT = max(args.max_inflight, 1)
+    BUFMON_WATCH = args.watch
+    BUFMON_CONFIRM_DELETES = args.confirm_deletes
+    BUFMON_WATCH_DEBOUNCE_MSEC = max(args.debounce, 0)
+    BUFMON_READY_TIMEOUT = args.ready_timeout
+    BUFMON_HISTORY_SAMPLES = max(args.history, 0)
+
+    BUFMON_HISTORY_FILE = args.history_file
+    BUFMON_HISTORY_BUCKETS = max(args.history_buckets, 1)
+    BUFMON_HISTORY_BUCKET_MSEC = max(args.history_bucket_msec, 1)
+    BUFMON_SOFT_PEAK = args.soft_peak
+    BUFMON_THRESHOLDS = args.thresholds
+    BUFMON_SNAPSHOTS = max(args.snapshots, 0)
+    BUFMON_METRICS = args.metrics
+    BUFMON_SUBSCRIBE = args.subscribe
+    BUFMON_PROFILE = args.profile
+
+    if BUFMON_PROFILE is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if BUFMON_HISTORY_SAMPLES:
+        if not BUFMON_WATCH:
+            parser.error("--history requires --watch")
+        bufmon_value_hooks.append(bufmon_history_append)
+        bufmon_reset_hooks.append(bufmon_history_reset)
+
+    if BUFMON_HISTORY_FILE is not None:
+        if not BUFMON_WATCH:
+            parser.error("--history-file requires --watch")
+        bufmon_value_hooks.append(bufmon_history_file_append)
+        bufmon_reset_hooks.append(bufmon_history_file_reset)
+
+    if BUFMON_SOFT_PEAK == SOFT_PEAK_ON and not BUFMON_WATCH:
+        parser.error("--soft-peak on requires --watch")
+    if BUFMON_SOFT_PEAK != SOFT_PEAK_OFF and BUFMON_WATCH:
+        bufmon_value_hooks.append(bufmon_peak_update)
+        bufmon_reset_hooks.append(bufmon_peak_reset)
+
+    if BUFMON_THRESHOLDS:
+        if not BUFMON_WATCH:
+            parser.error("--thresholds requires --watch")
+        bufmon_runtime_columns.extend([BUFMO_ENABLED_COLUMN,
+                                       BUFMON_TRIGGER_THRESHHOLD_COLUMN,
+                                       BUFMON_STATUS_COLUMN])
+        bufmon_value_hooks.append(bufmon_threshold_update)
+        bufmon_reset_hooks.append(bufmon_threshold_reset)
+        bufmon_row_hooks.append(([BUFMO_ENABLED_COLUMN,
+                                  BUFMON_TRIGGER_THRESHHOLD_COLUMN],
+                                 bufmon_threshold_config))
+
+    if BUFMON_SNAPSHOTS:
+        if not BUFMON_WATCH:
+            parser.error("--snapshots requires --watch")
+        if BUFMON_STATUS_COLUMN not in bufmon_runtime_columns:
+            bufmon_runtime_columns.append(BUFMON_STATUS_COLUMN)
+        bufmon_value_hooks.append(bufmon_snapshot_update)
+        bufmon_reset_hooks.append(bufmon_snapshot_reset)
+        bufmon_row_hooks.append(([BUFMON_STATUS_COLUMN],
+                                 bufmon_snapshot_status))
+
+    if BUFMON_METRICS is not None:
+        if not BUFMON_WATCH:
+            parser.error("--metrics requires --watch")
+        if not is_local_pstream(BUFMON_METRICS):
+            parser.error("--metrics expects punix:PATH or a loopback "
+                         "ptcp:127.0.0.1:PORT")
+        bufmon_value_hooks.append(bufmon_metrics_update)
+        bufmon_reset_hooks.append(bufmon_metrics_reset)
+
+    if BUFMON_SUBSCRIBE is not None:
+        if not BUFMON_WATCH:
+            parser.error("--subscribe requires --watch")
+        if not is_local_pstream(BUFMON_SUBSCRIBE):
+            parser.error("--subscribe expects punix:PATH or a loopback "
+                         "ptcp:127.0.0.1:PORT")
+        bufmon_value_hooks.append(bufmon_subscribe_update)
+        bufmon_reset_hooks.append(bufmon_subscribe_reset)
+
+    if bufmon_value_hooks:
+        bufmon_runtime_columns.append(BUFMON_COUNTER_VALUE_COLUMN)
+
     bufmond_init(remote)
 
     ovs.daemon.daemonize()
 
     ovs.unixctl.command_register("exit", "", 0, 0, unixctl_exit, None)
+    ovs.unixctl.command_register("bufmon/query",
+                                 "[name=PATTERN] [field=value]...", 0,
+                                 BUFMON_QUERY_MAX_TERMS + 1,
+                                 unixctl_bufmon_query, None)
+    ovs.unixctl.command_register("bufmon/set",
+                                 "[name=PATTERN] [field=value]... "
+                                 "column=value...", 1,
+                                 BUFMON_QUERY_MAX_TERMS + 1 +
+                                 len(BUFMON_SET_COLUMNS),
+                                 unixctl_bufmon_set, None)
+    ovs.unixctl.command_register("bufmon/history",
+                                 "[name=PATTERN] [field=value]... "
+                                 "[last=N] [since=MSEC]", 0,
+                                 BUFMON_QUERY_MAX_TERMS + 3,
+                                 unixctl_bufmon_history, None)
+    ovs.unixctl.command_register("bufmon/peak",
+                                 "[name=PATTERN] [field=value]...", 0,
+                                 BUFMON_QUERY_MAX_TERMS + 1,
+                                 unixctl_bufmon_peak, None)
+    ovs.unixctl.command_register("bufmon/snapshots", "", 0, 0,
+                                 unixctl_bufmon_snapshots, None)
+    ovs.unixctl.command_register("bufmon/snapshot",
+                                 "ID [name=PATTERN] [field=value]...", 1,
+                                 BUFMON_QUERY_MAX_TERMS + 2,
+                                 unixctl_bufmon_snapshot, None)
+    ovs.unixctl.command_register("bufmon/reload-confirm", "", 0, 0,
+                                 unixctl_bufmon_reload_confirm, None)
+    ovs.unixctl.command_register("bufmon/stats", "", 0, 0,
+                                 unixctl_bufmon_stats, None)
     error, unixctl_server = ovs.unixctl.server.UnixctlServer.create(None)
 
     if error:
         ovs.util.ovs_fatal(error, "could not create unix-ctl server", vlog)
 
+    if BUFMON_METRICS is not None:
+        bufmon_metrics_open()
+
+    if BUFMON_SUBSCRIBE is not None:
+        bufmon_subscribe_open()
+
     # Sequence number when we last processed the db.
     seqno = idl.change_seqno
 
+    if BUFMON_READY_TIMEOUT is not None:
+        ready_deadline = ovs.timeval.msec() + BUFMON_READY_TIMEOUT * 1000
+
     exiting = False
     while not exiting:
 
+        start = time.time()
+
         bufmond_run()
 
         unixctl_server.run()
 
-        bufmond_wait()
+        bufmon_stats_loop(time.time() - start)
 
         if exiting:
             break
@@ -434,9 +3572,16 @@ def main():
             poller = ovs.poller.Poller()
             unixctl_server.wait(poller)
             idl.wait(poller)
+            bufmond_wait(poller)
             poller.block()
 
     # Daemon Exit.
+    bufmond_profile_stop()
+    close_bufmon_history_file()
+    if metrics_pstream is not None:
+        metrics_pstream.close()
+    if subscribe_pstream is not None:
+        subscribe_pstream.close()
     unixctl_server.close()
     idl.close()
 
@@ -18,7 +18,7 @@ from setuptools import setup
 setup(
     name='bufmond',
     version='1.0',
-    py_modules=['bufmond'],
+    py_modules=['bufmond', 'bufmon_registry'],
     entry_points={
         'console_scripts': ['bufmond = bufmond:main',]
     }
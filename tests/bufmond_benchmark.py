@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# (c) Copyright [2015-2016] Hewlett Packard Enterprise Development LP
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Startup and load benchmark of bufmond.
+#
+# Generates hardware description files of increasing size with
+# bufmon-bcm-helper.py and runs the bufmond load path (bufmond_init,
+# parse_bufmond_yaml, update_bufmond_config) on each of them, then runs it
+# a second time to measure the cached parse and the no-op reconcile.
+# Each file is loaded in its own process, against an in-process fake IDL
+# by default or against a local ovsdb-server started from --schema.
+#
+# For every phase the benchmark reports the wall time, the number of
+# transactions, the bytes sent to the database and the peak RSS.
+#
+#   python tests/bufmond_benchmark.py --ports 32,104,256 --units 1,2
+#   python tests/bufmond_benchmark.py --ovsdb-server \
+#       --schema /usr/share/openvswitch/vswitch.ovsschema
+
+import argparse
+import imp
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+BUFMOND = os.path.join(REPO_DIR, 'bufmond.py')
+HELPER = os.path.join(REPO_DIR, 'bufmon-bcm-helper.py')
+
+PHASES = ['init', 'parse', 'load', 'parse-cached', 'reconcile']
+
+# Columns read back as maps by bufmond.
+MAP_COLUMNS = ['bufmon_config', 'bufmon_info',
+               'counter_vendor_specific_info']
+
+stats = {'txns': 0, 'bytes': 0}
+
+
+#------------------ fake IDL ----------------
+class FakeSchemaHelper(object):
+    def __init__(self, location=None):
+        self.tables = {}
+
+    def register_columns(self, table, columns, readonly=[]):
+        self.tables.setdefault(table, set()).update(columns)
+
+    def register_table(self, table):
+        self.tables.setdefault(table, set())
+
+
+class FakeTable(object):
+    def __init__(self, idl, name, columns):
+        self.idl = idl
+        self.name = name
+        self.columns = dict((column, None) for column in columns)
+        self.rows = {}
+
+
+class FakeRow(object):
+    def __init__(self, table, uuid):
+        self.__dict__['_table'] = table
+        self.__dict__['uuid'] = uuid
+        self.__dict__['_data'] = {}
+
+    def __getattr__(self, column):
+        if column in self._data:
+            return self._data[column]
+        if column in self._table.columns:
+            return {} if column in MAP_COLUMNS else None
+        raise AttributeError(column)
+
+    def __setattr__(self, column, value):
+        assert column in self._table.columns
+        self._table.idl.txn.ops.append(('update', self, column, value))
+
+    def delete(self):
+        self._table.idl.txn.ops.append(('delete', self, None, None))
+
+
+class FakeTransaction(object):
+    UNCOMMITTED = 'uncommitted'
+    UNCHANGED = 'unchanged'
+    INCOMPLETE = 'incomplete'
+    ABORTED = 'aborted'
+    SUCCESS = 'success'
+    TRY_AGAIN = 'try again'
+    NOT_LOCKED = 'not locked'
+    ERROR = 'error'
+
+    def __init__(self, idl):
+        assert idl.txn is None
+        idl.txn = self
+        self.idl = idl
+        self.ops = []
+        self.status = FakeTransaction.UNCOMMITTED
+
+    @staticmethod
+    def status_to_string(status):
+        return status
+
+    def insert(self, table):
+        self.idl.next_uuid += 1
+        row = FakeRow(table, self.idl.next_uuid)
+        self.ops.append(('insert', row, None, None))
+        return row
+
+    def abort(self):
+        self.idl.txn = None
+        self.status = FakeTransaction.ABORTED
+
+    def commit(self):
+        if self.status != FakeTransaction.UNCOMMITTED:
+            return self.status
+        self.idl.txn = None
+
+        if not self.ops:
+            self.status = FakeTransaction.UNCHANGED
+            return self.status
+
+        # Size of the equivalent "transact" request.
+        request = [self.idl.name]
+        for op, row, column, value in self.ops:
+            request.append({'op': op, 'table': row._table.name,
+                            'uuid': row.uuid, column: value})
+        stats['txns'] += 1
+        stats['bytes'] += len(json.dumps(
+            {'method': 'transact', 'params': request, 'id': stats['txns']}))
+
+        self.idl.pending.append(self)
+        self.status = FakeTransaction.INCOMPLETE
+        return self.status
+
+    def commit_block(self):
+        status = self.commit()
+        while status == FakeTransaction.INCOMPLETE:
+            self.idl.run()
+            status = self.commit()
+        return status
+
+    def wait(self, poller):
+        if self.status != FakeTransaction.INCOMPLETE:
+            poller.immediate_wake()
+
+    def apply(self):
+        for op, row, column, value in self.ops:
+            if op == 'insert':
+                row._table.rows[row.uuid] = row
+            elif op == 'delete':
+                row._table.rows.pop(row.uuid, None)
+            else:
+                row._data[column] = value
+        self.status = FakeTransaction.SUCCESS
+
+
+class FakeIdl(object):
+    def __init__(self, remote, schema_helper):
+        self.name = 'OpenSwitch'
+        self.txn = None
+        self.pending = []
+        self.next_uuid = 0
+        self.change_seqno = 1
+        # Statuses of the next transactions the server gets, in order,
+        # instead of committing them.
+        self.statuses = []
+        self.tables = dict((name, FakeTable(self, name, columns))
+                           for name, columns
+                           in schema_helper.tables.items())
+
+    def run(self):
+        # The server commits every outstanding transaction at once.
+        if self.pending:
+            for txn in self.pending:
+                if self.statuses:
+                    txn.status = self.statuses.pop(0)
+                else:
+                    txn.apply()
+            self.pending = []
+            self.change_seqno += 1
+
+    def wait(self, poller):
+        if self.pending:
+            poller.immediate_wake()
+
+    def has_ever_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def install_fake_idl():
+    import ovs.db.idl
+
+    ovs.db.idl.SchemaHelper = FakeSchemaHelper
+    ovs.db.idl.Idl = FakeIdl
+    ovs.db.idl.Transaction = FakeTransaction
+
+
+#------------------ ovsdb-server ----------------
+def start_ovsdb_server(schema, run_dir):
+    db = os.path.join(run_dir, 'bench.db')
+    sock = os.path.join(run_dir, 'bench.sock')
+
+    subprocess.check_call(['ovsdb-tool', 'create', db, schema])
+    server = subprocess.Popen(['ovsdb-server', '--remote=punix:' + sock,
+                               '--unixctl=' + os.path.join(run_dir, 'ctl'),
+                               db])
+    while not os.path.exists(sock):
+        if server.poll() is not None:
+            raise RuntimeError('ovsdb-server exited')
+        time.sleep(0.05)
+
+    return server, 'unix:' + sock
+
+
+def count_jsonrpc_bytes():
+    import ovs.db.idl
+    import ovs.json
+    import ovs.jsonrpc
+
+    send = ovs.jsonrpc.Connection.send
+    commit = ovs.db.idl.Transaction.commit
+
+    def counted_send(self, msg):
+        stats['bytes'] += len(ovs.json.to_string(msg.to_json()))
+        return send(self, msg)
+
+    def counted_commit(self):
+        sent = getattr(self, '_bench_sent', False)
+        status = commit(self)
+        if not sent and status == ovs.db.idl.Transaction.INCOMPLETE:
+            self._bench_sent = True
+            stats['txns'] += 1
+        return status
+
+    ovs.jsonrpc.Connection.send = counted_send
+    ovs.db.idl.Transaction.commit = counted_commit
+
+
+def sync_idl(bufmond):
+    '''
+    Waits for the first replica of the database, creates the System row
+    '''
+    import ovs.db.idl
+    import ovs.poller
+
+    idl = bufmond.idl
+    while not idl.has_ever_connected() or idl.change_seqno == 0:
+        idl.run()
+        poller = ovs.poller.Poller()
+        idl.wait(poller)
+        poller.block()
+
+    if not idl.tables[bufmond.SYSTEM_TABLE].rows:
+        txn = ovs.db.idl.Transaction(idl)
+        txn.insert(idl.tables[bufmond.SYSTEM_TABLE])
+        txn.commit_block()
+
+
+#------------------ worker ----------------
+def measure(results, phase, func):
+    before = dict(stats)
+    start = time.time()
+    ret = func()
+    results[phase] = {
+        'wall_ms': (time.time() - start) * 1000,
+        'txns': stats['txns'] - before['txns'],
+        'bytes': stats['bytes'] - before['bytes'],
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    return ret
+
+
+def load(bufmond):
+    if bufmond.update_bufmond_config() is False:
+        raise RuntimeError('update_bufmond_config() failed')
+
+
+def run_worker(args):
+    run_dir = tempfile.mkdtemp(prefix='bufmond-bench-')
+    server = None
+    results = {}
+
+    try:
+        if args.ovsdb_server:
+            server, remote = start_ovsdb_server(args.schema, run_dir)
+            count_jsonrpc_bytes()
+        else:
+            install_fake_idl()
+            remote = None
+
+        # bufmond imports bufmon_registry from the repository.
+        sys.path.insert(0, REPO_DIR)
+        bufmond = imp.load_source('bufmond', BUFMOND)
+        bufmond.ovs_schema = args.schema
+        bufmond.YAML_FILE_PATH = args.worker
+        bufmond.BUFMON_CACHE_DIR = run_dir
+        bufmond.BUFMON_TXN_BATCH_SIZE = args.batch_size
+        bufmond.BUFMON_TXN_MAX_INFLIGHT = args.max_inflight
+
+        def init():
+            bufmond.bufmond_init(remote)
+            if server is not None:
+                sync_idl(bufmond)
+            else:
+                system_table = bufmond.idl.tables[bufmond.SYSTEM_TABLE]
+                system_table.rows[0] = FakeRow(system_table, 0)
+
+        measure(results, 'init', init)
+        # The YAML is streamed while the rows are written, parse only
+        # covers opening the stream.
+        measure(results, 'parse', bufmond.parse_bufmond_yaml)
+        measure(results, 'load', lambda: load(bufmond))
+        measure(results, 'parse-cached', bufmond.parse_bufmond_yaml)
+        measure(results, 'reconcile', lambda: load(bufmond))
+
+        results['counters'] = len(
+            bufmond.idl.tables[bufmond.BUFMON_TABLE].rows)
+        bufmond.idl.close()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(run_dir)
+
+    sys.stdout.write(json.dumps(results) + '\n')
+
+
+#------------------ benchmark ----------------
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='bufmond-bench-')
+
+    print('%6s %5s %8s  %-12s %10s %6s %12s %12s'
+          % ('ports', 'units', 'counters', 'phase', 'wall(ms)', 'txns',
+             'bytes', 'maxrss(KB)'))
+
+    try:
+        for units in args.units:
+            for ports in args.ports:
+                yaml_path = os.path.join(work_dir, 'bufmond-%d-%d.yaml'
+                                         % (ports, units))
+                subprocess.check_call([sys.executable, HELPER,
+                                       '-u', str(units), '-o', yaml_path,
+                                       args.chip, str(ports)])
+
+                cmd = [sys.executable, os.path.abspath(__file__),
+                       '--worker', yaml_path,
+                       '--batch-size', str(args.batch_size),
+                       '--max-inflight', str(args.max_inflight)]
+                if args.ovsdb_server:
+                    cmd += ['--ovsdb-server', '--schema', args.schema]
+                output = subprocess.check_output(cmd)
+                results = json.loads(output.splitlines()[-1])
+
+                for phase in PHASES:
+                    result = results[phase]
+                    print('%6d %5d %8d  %-12s %10.1f %6d %12d %12d'
+                          % (ports, units, results['counters'], phase,
+                             result['wall_ms'], result['txns'],
+                             result['bytes'], result['maxrss_kb']))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="bufmond startup and load benchmark")
+    parser.add_argument('--chip', default='trident',
+                        help="Chip profile of bufmon-bcm-helper.py.")
+    parser.add_argument('--ports', type=int_list, default=[8, 32, 104, 256],
+                        help="Comma separated port counts.")
+    parser.add_argument('--units', type=int_list, default=[1],
+                        help="Comma separated hardware unit counts.")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="bufmond rows per transaction.")
+    parser.add_argument('--max-inflight', type=int, default=4,
+                        help="bufmond transactions in flight.")
+    parser.add_argument('--ovsdb-server', action='store_true',
+                        help="Load against a local ovsdb-server instead "
+                             "of the in-process fake IDL.")
+    parser.add_argument('--schema',
+                        default='/usr/share/openvswitch/vswitch.ovsschema',
+                        help="Schema of the local ovsdb-server.")
+    parser.add_argument('--worker', metavar='YAML', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+    else:
+        run_benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# (c) Copyright [2015-2016] Hewlett Packard Enterprise Development LP
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Unit tests of bufmon-bcm-helper.py:
+#
+#   python -m unittest discover -s tests -p 'test_*.py'
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import yaml
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+helper = imp.load_source('bufmon_bcm_helper',
+                         os.path.join(REPO_DIR, 'bufmon-bcm-helper.py'))
+
+
+class EmitTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'bufmond.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def template(self, counters):
+        template = dict(helper.bufmon_template)
+        template['counters'] = counters
+        return template
+
+    def test_same_as_yaml_dump(self):
+        limits = helper.chip_limits('trident', 2)
+        counters = list(helper.generate_counters(limits, 1))
+        # Strings loading back as other types are quoted.
+        counters.append({'hw_unit_id': 0, 'name': 'true',
+                         'counter_vendor_specific_info': {'port': '1',
+                                                          'queue': 'null'}})
+        template = self.template(counters)
+
+        self.assertEqual(''.join(helper.emit_bufmond_yaml(template)),
+                         yaml.dump(template, default_flow_style=False))
+
+    def test_unhandled_values(self):
+        for counter in ({'name': 'egress queue'}, {'name': u'device'},
+                        {'hw_unit_id': 1.5}, {'info': {}}, {}):
+            self.assertRaises(ValueError, list,
+                              helper.emit_bufmond_yaml(
+                                  self.template([counter])))
+        self.assertRaises(ValueError, list,
+                          helper.emit_bufmond_yaml(self.template([])))
+
+    def test_yaml_dump_fallback(self):
+        # Written by PyYAML, the file still loads the same counters.
+        registry = helper.CounterRegistry()
+        registry.add(0, 'device/data/NONE/NONE', {'realm': 'device: main'})
+        helper.create_bufmond_yaml(self.path, '# header\n', [registry])
+
+        with open(self.path) as ff:
+            content = ff.read()
+        self.assertTrue(content.startswith('# header\n'))
+        self.assertEqual(yaml.safe_load(content),
+                         self.template(list(registry)))
+
+
+class UnitsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'bufmond.yaml')
+        self.limits = helper.chip_limits('trident', 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def load(self, name):
+        with open(os.path.join(self.tmp_dir, name)) as ff:
+            content = ff.read()
+        self.assertTrue(content.startswith(helper.file_header
+                                           % ('trident', '2')))
+        return yaml.safe_load(content)
+
+    def test_split(self):
+        helper.main(['bufmon-bcm-helper.py', '-u', '2', '-s', '-o',
+                     self.path, 'trident', '2'])
+
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['bufmond-unit0.yaml', 'bufmond-unit1.yaml'])
+        for hw_unit in range(2):
+            document = self.load('bufmond-unit%d.yaml' % hw_unit)
+            self.assertEqual(document['counters'],
+                             list(helper.generate_counters(self.limits,
+                                                           hw_unit)))
+            self.assertTrue(document['cap_mode_peak'])
+
+    def test_one_file(self):
+        # The units follow each other in a single counters list.
+        helper.main(['bufmon-bcm-helper.py', '-u', '2', '-o', self.path,
+                     'trident', '2'])
+
+        counters = self.load('bufmond.yaml')['counters']
+        self.assertEqual(counters,
+                         list(helper.generate_counters(self.limits, 0)) +
+                         list(helper.generate_counters(self.limits, 1)))
+
+    def test_compact_split(self):
+        helper.main(['bufmon-bcm-helper.py', '-u', '2', '-s', '-c', '-o',
+                     self.path, 'trident', '2'])
+
+        for hw_unit in range(2):
+            document = self.load('bufmond-unit%d.yaml' % hw_unit)
+            self.assertNotIn('counters', document)
+            self.assertEqual(document['counter_ranges'],
+                             helper.generate_ranges(self.limits, hw_unit))
+
+
+class WriteFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'bufmond.yaml')
+        with open(self.path, 'w') as ff:
+            ff.write('old\n')
+        os.chmod(self.path, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        with open(self.path) as ff:
+            return ff.read()
+
+    def test_replaced(self):
+        helper.write_file_atomic(self.path, lambda ff: ff.write('new\n'))
+
+        self.assertEqual(self.read(), 'new\n')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.tmp_dir), ['bufmond.yaml'])
+
+    def test_failed_write(self):
+        # The file is left as it was, without the temporary file.
+        def write(ff):
+            ff.write('partial')
+            raise IOError('disk full')
+
+        self.assertRaises(IOError, helper.write_file_atomic, self.path,
+                          write)
+        self.assertEqual(self.read(), 'old\n')
+        self.assertEqual(os.listdir(self.tmp_dir), ['bufmond.yaml'])
+
+    def test_compact_yaml(self):
+        ranges = [{'realm': 'device', 'counter_names': ['data'],
+                   'hw_unit_id': 0}]
+        helper.create_compact_yaml(self.path, '# header\n', ranges)
+
+        self.assertTrue(self.read().startswith('# header\n'))
+        self.assertEqual(yaml.safe_load(self.read())['counter_ranges'],
+                         ranges)
+
+
+if __name__ == '__main__':
+    unittest.main()
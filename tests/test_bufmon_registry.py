@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# (c) Copyright [2015-2016] Hewlett Packard Enterprise Development LP
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Unit tests of bufmon_registry.py:
+#
+#   python -m unittest discover -s tests -p 'test_*.py'
+
+import os
+import pickle
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from bufmon_registry import CounterRegistry
+
+QUEUE_INFO = {'counter_name': 'UC_QUEUE_BUFFER_COUNT',
+              'realm': 'egress-uc-queue', 'port': '1', 'queue': '2'}
+
+
+def make_registry(info=QUEUE_INFO):
+    registry = CounterRegistry()
+    registry.add(0, 'device/data/NONE/NONE')
+    registry.add(0, 'egress-uc-queue/uc-buffer-count/1/2', info)
+    registry.add(1, 'egress-uc-queue/uc-buffer-count/1/2', info)
+    return registry
+
+
+class CounterRegistryTest(unittest.TestCase):
+    def test_counters(self):
+        registry = make_registry()
+
+        self.assertEqual(len(registry), 3)
+        self.assertEqual(registry.counter(1),
+                         {'hw_unit_id': 0,
+                          'name': 'egress-uc-queue/uc-buffer-count/1/2',
+                          'counter_vendor_specific_info': QUEUE_INFO})
+        self.assertEqual(registry.counter(0)['counter_vendor_specific_info'],
+                         {})
+        self.assertEqual(registry.name_parts(2),
+                         ['egress-uc-queue', 'uc-buffer-count', '1', '2'])
+        self.assertEqual([counter['hw_unit_id'] for counter in registry],
+                         [0, 0, 1])
+
+    def test_find(self):
+        registry = make_registry()
+
+        self.assertEqual(registry.find(1, 'egress-uc-queue/uc-buffer-count/'
+                                          '1/2'), 2)
+        self.assertEqual(registry.find(0, 'device/data/NONE/NONE'), 0)
+        self.assertIsNone(registry.find(1, 'device/data/NONE/NONE'))
+        self.assertIsNone(registry.find(0, 'device/data'))
+
+        # Added after the lookup table is built.
+        self.assertEqual(registry.add(1, 'device/data/NONE/NONE'), 3)
+        self.assertEqual(registry.find(1, 'device/data/NONE/NONE'), 3)
+        self.assertEqual(registry.add(0, 'device/data/NONE/NONE'), 0)
+        self.assertEqual(len(registry), 4)
+
+    def test_duplicates(self):
+        # Only collapsed once the lookup table is built.
+        registry = make_registry()
+        self.assertEqual(registry.add(0, 'device/data/NONE/NONE'), 3)
+        self.assertEqual(len(registry), 4)
+
+        registry.find(0, 'device/data/NONE/NONE')
+        self.assertIn(registry.add(0, 'device/data/NONE/NONE'), (0, 3))
+        self.assertEqual(len(registry), 4)
+
+    def test_equal(self):
+        self.assertEqual(make_registry(), make_registry())
+        self.assertEqual(make_registry(), make_registry(dict(QUEUE_INFO)))
+
+        # The vendor info is part of the counters.
+        info = dict(QUEUE_INFO, queue='3')
+        self.assertNotEqual(make_registry(), make_registry(info))
+
+        registry = make_registry()
+        registry.add(2, 'device/data/NONE/NONE')
+        self.assertNotEqual(make_registry(), registry)
+
+    def test_pickle(self):
+        registry = make_registry()
+        registry.find(0, 'device/data/NONE/NONE')
+
+        copy = pickle.loads(pickle.dumps(registry, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy, registry)
+        self.assertIsNone(copy.hashes)
+        self.assertEqual(copy.find(1, 'egress-uc-queue/uc-buffer-count/1/2'),
+                         2)
+        self.assertEqual(copy.add(2, 'device/data/NONE/NONE'), 3)
+        self.assertEqual(copy.strings, registry.strings)
+
+
+if __name__ == '__main__':
+    unittest.main()
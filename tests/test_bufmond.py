@@ -0,0 +1,1272 @@
+#!/usr/bin/env python
+# (c) Copyright [2015-2016] Hewlett Packard Enterprise Development LP
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Unit tests of bufmond, run against the in-process fake IDL of
+# bufmond_benchmark.py:
+#
+#   python -m unittest discover -s tests -p 'test_*.py'
+
+import cProfile
+import errno
+import imp
+import json
+import os
+import pstats
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import yaml
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+import bufmond_benchmark
+bufmond_benchmark.install_fake_idl()
+
+import ovs.db.schema
+import ovs.dirs
+import ovs.db.types
+import ovs.timeval
+
+from bufmon_registry import CounterRegistry
+
+
+def load_bufmond():
+    '''
+    Returns a freshly initialized bufmond module
+    '''
+    return imp.load_source('bufmond', os.path.join(REPO_DIR, 'bufmond.py'))
+
+
+def load_counters(bufmond, keys):
+    '''
+    Registers the (hw_unit_id, name) keys as the loaded counters, with
+    their lookup index
+    '''
+    registry = bufmond.CounterRegistry()
+    index = {}
+    counters = [{'hw_unit_id': hw_unit_id, 'name': name}
+                for hw_unit_id, name in keys]
+    for counter in bufmond.index_bufmon_counters(counters, registry, index):
+        pass
+    bufmond.bufmon_counters = registry
+    bufmond.bufmon_index = index
+
+
+def init_idl(bufmond):
+    '''
+    Connects a resident bufmond replicating counter_value to a fake IDL
+    '''
+    bufmond.BUFMON_WATCH = True
+    bufmond.bufmon_runtime_columns.append(bufmond.BUFMON_COUNTER_VALUE_COLUMN)
+    bufmond.bufmond_init('unix:fake')
+
+
+def add_bufmon_row(bufmond, hw_unit_id, name, **columns):
+    '''
+    Adds a replicated bufmon row, optional columns are given as lists
+    '''
+    table = bufmond.idl.tables[bufmond.BUFMON_TABLE]
+    # Taken from the fake IDL, not to clash with rows it inserts.
+    bufmond.idl.next_uuid += 1
+    row = bufmond_benchmark.FakeRow(table, bufmond.idl.next_uuid)
+    row._data.update(columns, hw_unit_id=hw_unit_id, name=name)
+    table.rows[row.uuid] = row
+    return row
+
+
+COMPACT_YAML = '''\
+cap_mode_peak: true
+counter_ranges:
+- counter_names: [uc-buffer-count]
+  hw_unit_id: 1
+  indexes:
+  - [port, 1, 4]
+  - [queue, 0, 7]
+  realm: egress-uc-queue
+counters:
+- counter_vendor_specific_info: {counter_name: data, realm: device}
+  hw_unit_id: 0
+  name: device/data/NONE/NONE
+'''
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bufmond = load_bufmond()
+        self.bufmond.YAML_FILE_PATH = os.path.join(self.tmp_dir,
+                                                   'bufmond.yaml')
+        with open(self.bufmond.YAML_FILE_PATH, 'w') as fh:
+            fh.write(COMPACT_YAML)
+        self.bufmond.BUFMON_CACHE_DIR = self.tmp_dir
+        self.cache_path = self.bufmond.get_bufmond_cache_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def parse(self):
+        self.assertTrue(self.bufmond.parse_bufmond_yaml())
+        return list(self.bufmond.counters_stream), self.bufmond.bufmon_info
+
+    def test_cached(self):
+        counters, info = self.parse()
+        self.assertEqual(len(counters), 33)
+        self.assertEqual(counters[0]['name'],
+                         'egress-uc-queue/uc-buffer-count/1/0')
+        self.assertEqual(counters[-1]['name'], 'device/data/NONE/NONE')
+        self.assertEqual(info, {'cap_mode_peak': True})
+
+        # The ranges are cached as such, not expanded.
+        self.assertLess(os.path.getsize(self.cache_path),
+                        len(COMPACT_YAML) * 2)
+        self.assertEqual(self.parse(), (counters, info))
+
+    def test_corrupted(self):
+        expected = self.parse()
+        with open(self.cache_path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(self.cache_path) - 10)
+
+        # The YAML file carries on where the cache broke off.
+        self.assertEqual(self.parse(), expected)
+        self.assertFalse(os.path.exists(self.cache_path))
+        self.assertEqual(self.parse(), expected)
+        self.assertTrue(os.path.exists(self.cache_path))
+
+    def test_default_dir(self):
+        # Out of hw_desc_dir, which is often read-only.
+        self.bufmond.BUFMON_CACHE_DIR = None
+        self.assertEqual(os.path.dirname(
+            self.bufmond.get_bufmond_cache_path()), ovs.dirs.RUNDIR)
+
+    def test_not_written(self):
+        # Warned about once, the loads still parse the YAML file.
+        self.bufmond.BUFMON_CACHE_DIR = os.path.join(self.tmp_dir, 'missing')
+        warnings = []
+        self.bufmond.vlog.warn = warnings.append
+        self.addCleanup(delattr, self.bufmond.vlog, 'warn')
+
+        expected = self.parse()
+        self.assertEqual(len(expected[0]), 33)
+        self.assertEqual(self.parse(), expected)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('not written', warnings[0])
+
+    def test_read_error(self):
+        # A YAML read error is not taken for the end of the counters.
+        def records():
+            yield {'name': 'device/data/NONE/NONE'}
+            raise IOError('read error')
+
+        stream = self.bufmond.save_bufmond_cache(('key',), records(), {})
+        self.assertEqual(next(stream), {'name': 'device/data/NONE/NONE'})
+        self.assertRaises(IOError, next, stream)
+        self.assertEqual(os.listdir(self.tmp_dir), ['bufmond.yaml'])
+
+
+ALIAS_YAML = '''\
+cap_mode_peak: &yes true
+cap_mode_current: *yes
+counters:
+- &port1
+  counter_vendor_specific_info: &info {counter_name: q, realm: queue}
+  hw_unit_id: 0
+  name: queue/q/1/NONE
+- <<: *port1
+  name: queue/q/2/NONE
+- counter_vendor_specific_info: *info
+  hw_unit_id: 1
+  name: queue/q/1/NONE
+'''
+
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bufmond = load_bufmond()
+        self.bufmond.YAML_FILE_PATH = os.path.join(self.tmp_dir,
+                                                   'bufmond.yaml')
+        self.bufmond.BUFMON_CACHE_DIR = self.tmp_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def parse(self, content):
+        with open(self.bufmond.YAML_FILE_PATH, 'w') as fh:
+            fh.write(content)
+        self.assertTrue(self.bufmond.parse_bufmond_yaml())
+        return list(self.bufmond.counters_stream), self.bufmond.bufmon_info
+
+    def test_aliases(self):
+        # Streamed the same as PyYAML loads the whole file.
+        document = yaml.safe_load(ALIAS_YAML)
+        counters, info = self.parse(ALIAS_YAML)
+
+        self.assertEqual(counters, document['counters'])
+        self.assertEqual(info, {'cap_mode_peak': True,
+                                'cap_mode_current': True})
+
+    def test_records(self):
+        # A counter range is one record, expanded after the cache.
+        with open(self.bufmond.YAML_FILE_PATH, 'w') as fh:
+            fh.write(COMPACT_YAML)
+        records = self.bufmond.open_bufmond_yaml({})
+        self.assertEqual(next(records)[0], 'counter_ranges')
+        self.assertEqual(next(records)['name'], 'device/data/NONE/NONE')
+        self.assertRaises(StopIteration, next, records)
+
+    def test_empty(self):
+        with open(self.bufmond.YAML_FILE_PATH, 'w') as fh:
+            fh.write('# no counters\n')
+        self.assertIsNone(self.bufmond.open_bufmond_yaml({}))
+
+
+class ExpandTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+
+    def expand(self, counter_range):
+        return list(self.bufmond.expand_counter_range(counter_range))
+
+    def test_names(self):
+        counters = self.expand({'realm': 'egress-uc-queue',
+                                'counter_names': ['uc-buffer-count',
+                                                  'uc-share-count'],
+                                'hw_unit_id': 1,
+                                'indexes': [['port', 1, 2], ['queue', 0, 1]]})
+
+        self.assertEqual([counter['name'] for counter in counters[:3]],
+                         ['egress-uc-queue/uc-buffer-count/1/0',
+                          'egress-uc-queue/uc-share-count/1/0',
+                          'egress-uc-queue/uc-buffer-count/1/1'])
+        self.assertEqual(len(counters), 8)
+        self.assertEqual(counters[-1],
+                         {'hw_unit_id': 1,
+                          'name': 'egress-uc-queue/uc-share-count/2/1',
+                          'counter_vendor_specific_info':
+                              {'counter_name': 'uc-share-count',
+                               'realm': 'egress-uc-queue',
+                               'port': '2', 'queue': '1'}})
+
+    def test_defaults(self):
+        # hw_unit_id 0, the missing indexes are NONE.
+        counters = self.expand({'realm': 'egress-cpu-queue',
+                                'counter_names': ['cpu-buffer-count'],
+                                'indexes': [['queue', 7, 8]]})
+        self.assertEqual([(counter['hw_unit_id'], counter['name'])
+                          for counter in counters],
+                         [(0, 'egress-cpu-queue/cpu-buffer-count/7/NONE'),
+                          (0, 'egress-cpu-queue/cpu-buffer-count/8/NONE')])
+
+        counters = self.expand({'realm': 'device',
+                                'counter_names': ['data']})
+        self.assertEqual(counters,
+                         [{'hw_unit_id': 0, 'name': 'device/data/NONE/NONE',
+                           'counter_vendor_specific_info':
+                               {'counter_name': 'data', 'realm': 'device'}}])
+
+    def test_invalid(self):
+        for counter_range in ({'counter_names': ['data']},
+                              {'realm': 'device'},
+                              {'realm': 'device', 'counter_names': ['data'],
+                               'indexes': [['port', 1]]},
+                              {'realm': 'device', 'counter_names': ['data'],
+                               'indexes': [['port', 1, 'last']]},
+                              ['device']):
+            self.assertRaises(ValueError, self.expand, counter_range)
+
+    def test_helper_counters(self):
+        # The same counters as the full listing of bufmon-bcm-helper.py.
+        helper = imp.load_source(
+            'bufmon_bcm_helper',
+            os.path.join(REPO_DIR, 'bufmon-bcm-helper.py'))
+        limits = helper.chip_limits('trident', 4)
+
+        counters = []
+        for counter_range in helper.generate_ranges(limits, 1):
+            counters.extend(self.expand(counter_range))
+        self.assertEqual(counters,
+                         list(helper.generate_counters(limits, 1)))
+
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        self.rows = dict(
+            (name, add_bufmon_row(self.bufmond, 0, name,
+                                  counter_vendor_specific_info=info))
+            for name, info in [('a', {}), ('b', {'port': '1'}), ('c', {})])
+
+    def reconcile(self, counters, max_deletes=None):
+        return list(self.bufmond.reconcile_bufmon_counters(
+            counters, self.bufmond.get_configured_counters(), max_deletes))
+
+    def test_diff(self):
+        d = {'hw_unit_id': 0, 'name': 'd'}
+        b = {'hw_unit_id': 0, 'name': 'b',
+             'counter_vendor_specific_info': {'port': '2'}}
+        counters = [{'hw_unit_id': 0, 'name': 'a'}, b, d,
+                    {'hw_unit_id': 0, 'name': 'd'}]
+
+        self.assertEqual(self.reconcile(counters),
+                         [(b, self.rows['b']), (d, None),
+                          (None, self.rows['c'])])
+        self.assertEqual(self.bufmond.refused_deletes, 0)
+
+    def test_deletes_refused(self):
+        counters = [{'hw_unit_id': 0, 'name': 'a'}]
+
+        self.assertEqual(self.reconcile(counters, max_deletes=1), [])
+        self.assertEqual(self.bufmond.refused_deletes, 2)
+        self.assertEqual(len(self.reconcile(counters, max_deletes=2)), 2)
+
+    def test_max_deletes(self):
+        # Every load is limited until the operator confirms it.
+        self.assertEqual(self.bufmond.get_bufmon_max_deletes(10), 5)
+        self.bufmond.reload_confirmed = True
+        self.assertIsNone(self.bufmond.get_bufmon_max_deletes(10))
+        self.bufmond.reload_confirmed = False
+        self.bufmond.BUFMON_CONFIRM_DELETES = True
+        self.assertIsNone(self.bufmond.get_bufmon_max_deletes(10))
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bufmond = load_bufmond()
+        self.bufmond.BUFMON_CACHE_DIR = self.tmp_dir
+        self.bufmond.bufmond_init('unix:fake')
+        tables = self.bufmond.idl.tables
+        for table, columns in [(self.bufmond.SYSTEM_TABLE, {'cur_cfg': 1}),
+                               (self.bufmond.SUBSYTEM_TABLE,
+                                {'hw_desc_dir': self.tmp_dir})]:
+            row = bufmond_benchmark.FakeRow(tables[table], table)
+            row._data.update(columns)
+            tables[table].rows[row.uuid] = row
+        # Rows of another counters list.
+        for port in range(40):
+            add_bufmon_row(self.bufmond, 0, 'queue/q/%d/NONE' % port)
+        with open(os.path.join(self.tmp_dir, 'bufmond.yaml'), 'w') as fh:
+            fh.write(COMPACT_YAML)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def names(self):
+        table = self.bufmond.idl.tables[self.bufmond.BUFMON_TABLE]
+        return set(row.name for row in table.rows.values())
+
+    def test_deletes_refused(self):
+        # A truncated file does not empty the table of a one-shot start,
+        # only its new counters are written.
+        self.bufmond.bufmond_reconfigure()
+
+        self.assertTrue(self.bufmond.exiting)
+        self.assertEqual(len(self.names()), 40 + 33)
+        self.assertEqual(self.bufmond.stats_counters['reloads-refused'], 1)
+        self.assertEqual(self.bufmond.stats_counters['loads'], 0)
+
+    def test_deletes_confirmed(self):
+        self.bufmond.BUFMON_CONFIRM_DELETES = True
+        self.bufmond.bufmond_reconfigure()
+
+        self.assertTrue(self.bufmond.exiting)
+        self.assertEqual(len(self.names()), 33)
+        self.assertEqual(self.bufmond.stats_counters['loads'], 1)
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        self.bufmond.BUFMON_TXN_BATCH_SIZE = 2
+        self.bufmond.BUFMON_TXN_MAX_INFLIGHT = 2
+        self.outstanding = []
+
+    def inserts(self, units):
+        return [({'hw_unit_id': hw_unit_id, 'name': 'queue/q/%d/NONE' % i},
+                 None) for i, hw_unit_id in enumerate(units)]
+
+    def apply_batch(self, batch):
+        # Transactions sent and not replied yet.
+        self.outstanding.append(len(self.bufmond.idl.pending))
+        return self.bufmond.ovsdb_apply_bufmon_batch(batch)
+
+    def commit(self, changes):
+        return self.bufmond.commit_bufmon_batches(
+            self.bufmond.get_bufmon_batches(iter(changes)), self.apply_batch)
+
+    def names(self):
+        table = self.bufmond.idl.tables[self.bufmond.BUFMON_TABLE]
+        return sorted((row.hw_unit_id, row.name)
+                      for row in table.rows.values())
+
+    def test_pipelined(self):
+        changes = self.inserts([0] * 9)
+
+        self.assertEqual(self.commit(changes), ({0: True}, 9))
+        self.assertEqual(len(self.names()), 9)
+        # 5 batches, never more than 2 outstanding.
+        self.assertEqual(self.outstanding, [0, 1, 0, 1, 0])
+        self.assertEqual(self.bufmond.stats_counters['rows-inserted'], 9)
+
+    def test_try_again(self):
+        # The batch is sent again, the unit does not fail.
+        self.bufmond.idl.statuses.append('try again')
+        changes = self.inserts([0] * 4)
+
+        self.assertEqual(self.commit(changes), ({0: True}, 4))
+        self.assertEqual(self.names(), sorted(
+            (0, counter['name']) for counter, unused_row in changes))
+        self.assertEqual(len(self.outstanding), 3)
+
+    def test_unit_order(self):
+        # Full batches go out as the YAML fills them, then the rest of
+        # every unit in hw_unit_id order.
+        batches = self.bufmond.get_bufmon_batches(
+            iter(self.inserts([1, 0, 1, 0, 0])))
+        self.assertEqual([(hw_unit_id, len(batch))
+                          for hw_unit_id, batch in batches],
+                         [(1, 2), (0, 2), (0, 1)])
+
+        changes = (self.inserts([0, 0, 0]) +
+                   [(None, add_bufmon_row(self.bufmond, 1, 'old'))])
+        self.assertEqual([hw_unit_id for hw_unit_id, batch
+                          in self.bufmond.get_bufmon_batches(iter(changes))],
+                         [0, 0, 1])
+
+    def test_unit_failure(self):
+        # The failed batch stops the rest of its unit only.
+        self.bufmond.BUFMON_TXN_MAX_INFLIGHT = 1
+        self.bufmond.idl.statuses.append('error')
+        changes = self.inserts([0, 0, 0, 0, 1, 1, 1])
+
+        self.assertEqual(self.commit(changes), ({0: False, 1: True}, 3))
+        self.assertEqual([hw_unit_id for hw_unit_id, name in self.names()],
+                         [1, 1, 1])
+        self.assertEqual(len(self.outstanding), 3)
+
+
+class ColumnPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        self.warnings = []
+        self.bufmond.vlog.warn = self.warnings.append
+        self.addCleanup(delattr, self.bufmond.vlog, 'warn')
+
+    def test_invalid_columns(self):
+        counters = [{'hw_unit_id': 0, 'name': 'a', 'bogus': 1},
+                    {'hw_unit_id': 0, 'name': 'b', 'bogus': 2},
+                    {'hw_unit_id': 1, 'name': 'c', 'bogus': 3,
+                     'counter_vendor_specific_info': {'port': '1'}}]
+        self.bufmond.ovsdb_apply_bufmon_batch(
+            [(counter, None) for counter in counters])
+        self.bufmond.idl.run()
+
+        # One plan per counter schema.
+        plans = sorted((sorted(columns), sorted(invalid), count)
+                       for columns, invalid, count
+                       in self.bufmond.bufmon_column_plans.itervalues())
+        self.assertEqual(plans,
+                         [(['counter_vendor_specific_info', 'hw_unit_id',
+                            'name'], ['bogus'], 1),
+                          (['hw_unit_id', 'name'], ['bogus'], 2)])
+        table = self.bufmond.idl.tables[self.bufmond.BUFMON_TABLE]
+        self.assertEqual(sorted(sorted(row._data)
+                                for row in table.rows.values())[0],
+                         ['counter_vendor_specific_info', 'hw_unit_id',
+                          'name'])
+
+        # A single warning for the counters of every schema.
+        self.bufmond.report_bufmon_invalid_columns()
+        self.assertEqual(self.warnings,
+                         ["bufmon table invalid column 'bogus' in 3 counters"])
+        self.assertEqual(self.bufmond.stats_counters['invalid-columns'], 3)
+
+        # Counted again on the next load only.
+        self.bufmond.report_bufmon_invalid_columns()
+        self.assertEqual(len(self.warnings), 1)
+
+
+class StubTransaction(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def commit(self):
+        return self.statuses.pop(0)
+
+
+class ResyncTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        self.conditions = []
+        self.barriers = []
+        idl = self.bufmond.idl
+        idl.cond_change = lambda table, cond: self.conditions.append(cond)
+        idl.send_cond_change = lambda: self.conditions.append('sent')
+        self.bufmond.ovsdb_send_bufmon_barrier = self.barrier
+        self.bufmond.bufmon_monitored = False
+
+    def barrier(self):
+        self.barriers.append(StubTransaction(self.statuses))
+        return self.barriers[-1]
+
+    def test_acknowledged(self):
+        # Not complete before the reply, however long it takes.
+        Transaction = bufmond_benchmark.FakeTransaction
+        self.statuses = [Transaction.INCOMPLETE, Transaction.INCOMPLETE,
+                         Transaction.SUCCESS]
+        for _ in range(2):
+            self.assertFalse(self.bufmond.bufmond_resync_bufmon())
+        self.assertEqual(self.conditions, [[True], 'sent'])
+        self.assertTrue(self.bufmond.bufmond_resync_bufmon())
+        self.assertTrue(self.bufmond.bufmond_resync_bufmon())
+        self.assertEqual(len(self.barriers), 1)
+
+    def test_sent_again(self):
+        Transaction = bufmond_benchmark.FakeTransaction
+        self.statuses = [Transaction.TRY_AGAIN, Transaction.UNCHANGED]
+        self.assertFalse(self.bufmond.bufmond_resync_bufmon())
+        self.assertIsNone(self.bufmond.resync_txn)
+        self.assertTrue(self.bufmond.bufmond_resync_bufmon())
+        self.assertEqual(len(self.barriers), 2)
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bufmond = load_bufmond()
+        self.bufmond.YAML_FILE_PATH = os.path.join(self.tmp_dir,
+                                                   'bufmond.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def event(self, mask, name):
+        # The name is padded with NULs, as the kernel aligns the events.
+        name += '\0' * (16 - len(name))
+        return struct.pack('iIII', 1, mask, 0, len(name)) + name
+
+    def test_completed_file(self):
+        bufmond = self.bufmond
+        for mask in [bufmond.IN_CLOSE_WRITE, bufmond.IN_MOVED_TO]:
+            self.assertTrue(bufmond.is_bufmond_yaml_event(
+                self.event(bufmond.IN_CREATE, 'bufmond.yaml') +
+                self.event(mask, 'bufmond.yaml')))
+
+    def test_other_events(self):
+        bufmond = self.bufmond
+        open(bufmond.YAML_FILE_PATH, 'w').close()
+        # Created but not written yet, or another file of the directory.
+        self.assertFalse(bufmond.is_bufmond_yaml_event(
+            self.event(bufmond.IN_CREATE, 'bufmond.yaml') +
+            self.event(bufmond.IN_CLOSE_WRITE, 'bufmond.yaml.swp')))
+
+    def test_symlink(self):
+        bufmond = self.bufmond
+        target = os.path.join(self.tmp_dir, 'as5712.yaml')
+        open(target, 'w').close()
+        os.symlink(target, bufmond.YAML_FILE_PATH)
+        self.assertTrue(bufmond.is_bufmond_yaml_event(
+            self.event(bufmond.IN_CREATE, 'bufmond.yaml')))
+        self.assertTrue(bufmond.is_bufmond_yaml_event(
+            self.event(bufmond.IN_CLOSE_WRITE, 'as5712.yaml')))
+
+    def test_polled_long_debounce(self):
+        # A debounce longer than the poll interval still reloads.
+        bufmond = self.bufmond
+        bufmond.BUFMON_WATCH_POLL_MSEC = 1000
+        bufmond.BUFMON_WATCH_DEBOUNCE_MSEC = 2500
+        bufmond.watch_poll_deadline = 0
+        bufmond.loaded_signature = ('old',)
+        with open(bufmond.YAML_FILE_PATH, 'w') as fh:
+            fh.write(COMPACT_YAML)
+
+        reloads = []
+        bufmond.bufmond_reconfigure = lambda: reloads.append(now)
+        msec = ovs.timeval.msec
+        self.addCleanup(setattr, ovs.timeval, 'msec', msec)
+        for now in range(0, 6000, 500):
+            ovs.timeval.msec = lambda: now
+            bufmond.bufmond_watch_run()
+
+        # Stable from the second poll on, reloaded once.
+        self.assertEqual(reloads, [3500])
+
+
+class ReadyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+
+    def tearDown(self):
+        if self.bufmond.watch_fd is not None:
+            os.close(self.bufmond.watch_fd)
+        shutil.rmtree(self.tmp_dir)
+
+    def add_row(self, table, **columns):
+        row = bufmond_benchmark.FakeRow(self.bufmond.idl.tables[table], table)
+        row._data.update(columns)
+        row._table.rows[row.uuid] = row
+
+    def test_states(self):
+        bufmond = self.bufmond
+        self.assertFalse(bufmond.system_is_configured())
+        self.assertEqual(bufmond.bufmond_state, bufmond.BUFMOND_WAIT_SYSTEM)
+
+        self.add_row(bufmond.SYSTEM_TABLE, cur_cfg=1)
+        self.assertFalse(bufmond.system_is_configured())
+        self.assertEqual(bufmond.bufmond_state, bufmond.BUFMOND_WAIT_HW_DESC)
+
+        self.add_row(bufmond.SUBSYTEM_TABLE, hw_desc_dir=self.tmp_dir)
+        self.assertFalse(bufmond.system_is_configured())
+        self.assertEqual(bufmond.bufmond_state, bufmond.BUFMOND_WAIT_YAML)
+        self.assertFalse(bufmond.exiting)
+
+        bufmond.ready_deadline = ovs.timeval.msec() + 60000
+        open(os.path.join(self.tmp_dir, 'bufmond.yaml'), 'w').close()
+        self.assertTrue(bufmond.system_is_configured())
+        self.assertEqual(bufmond.bufmond_state, bufmond.BUFMOND_READY)
+        self.assertIsNone(bufmond.ready_deadline)
+
+    def test_timeout(self):
+        # Not ready in time: the daemon exits with an error.
+        bufmond = self.bufmond
+        bufmond.BUFMON_READY_TIMEOUT = 5
+        bufmond.ready_deadline = 5000
+        errors = []
+        bufmond.vlog.err = errors.append
+        self.addCleanup(delattr, bufmond.vlog, 'err')
+        msec = ovs.timeval.msec
+        self.addCleanup(setattr, ovs.timeval, 'msec', msec)
+
+        ovs.timeval.msec = lambda: 4999
+        self.assertFalse(bufmond.system_is_configured())
+        bufmond.bufmond_ready_run()
+        self.assertFalse(bufmond.exiting)
+
+        ovs.timeval.msec = lambda: 5000
+        bufmond.bufmond_ready_run()
+        self.assertTrue(bufmond.exiting)
+        self.assertEqual(errors, ['bufmond not ready after 5 seconds, '
+                                  'waiting for System cur_cfg. bufmond '
+                                  'Exiting'])
+
+
+class CountingRegistry(CounterRegistry):
+    def __init__(self):
+        super(CountingRegistry, self).__init__()
+        self.finds = []
+
+    def find(self, hw_unit_id, name):
+        self.finds.append((hw_unit_id, name))
+        return super(CountingRegistry, self).find(hw_unit_id, name)
+
+
+class NotifyTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        self.row = add_bufmon_row(self.bufmond, 0, 'device/data/NONE/NONE',
+                                  counter_value=[5])
+        self.other = add_bufmon_row(self.bufmond, 1, 'device/data/NONE/NONE')
+        self.bufmond.CounterRegistry = CountingRegistry
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE')])
+        self.finds = self.bufmond.bufmon_counters.finds
+        self.values = []
+        self.bufmond.bufmon_value_hooks.append(
+            lambda counter_id, value, msec:
+            self.values.append((counter_id, value)))
+
+    def notify(self, event, ovs_rec, **updates):
+        row = bufmond_benchmark.FakeRow(ovs_rec._table, ovs_rec.uuid)
+        row._data.update(updates)
+        self.bufmond.bufmond_notify(event, ovs_rec, row)
+
+    def test_row_ids_cached(self):
+        ROW_UPDATE = ovs.db.idl.ROW_UPDATE
+        for value in [6, 7]:
+            self.row._data['counter_value'] = [value]
+            self.notify(ROW_UPDATE, self.row, counter_value=[value])
+            self.notify(ROW_UPDATE, self.other, counter_value=[value])
+
+        self.assertEqual(self.values, [(0, 6), (0, 7)])
+        self.assertEqual(self.finds, [(0, 'device/data/NONE/NONE'),
+                                      (1, 'device/data/NONE/NONE')])
+
+        self.notify(ovs.db.idl.ROW_DELETE, self.row)
+        self.assertNotIn(self.row.uuid, self.bufmond.bufmon_row_ids)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.replies = []
+
+    def reply(self, body):
+        self.replies.append(body)
+
+    def reply_error(self, body):
+        self.replies.append('error: ' + body)
+
+
+class SetTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        self.keys = [(hw_unit_id, 'device/data/NONE/NONE')
+                     for hw_unit_id in range(3)]
+        for hw_unit_id, name in self.keys:
+            add_bufmon_row(self.bufmond, hw_unit_id, name,
+                           enabled=hw_unit_id == 2, trigger_threshold=[])
+        load_counters(self.bufmond, self.keys)
+
+        # The types of the vswitch schema columns.
+        types = ovs.db.types
+        columns = self.bufmond.idl.tables[self.bufmond.BUFMON_TABLE].columns
+        columns['enabled'] = ovs.db.schema.ColumnSchema(
+            'enabled', True, True, types.Type(types.BaseType(
+                types.BooleanType)))
+        columns['trigger_threshold'] = ovs.db.schema.ColumnSchema(
+            'trigger_threshold', True, True, types.Type(types.BaseType(
+                types.IntegerType), None, 0, 1))
+
+    def set(self, *argv):
+        conn = FakeConnection()
+        self.bufmond.unixctl_bufmon_set(conn, list(argv), None)
+        for i in range(3):
+            self.bufmond.idl.run()
+            self.bufmond.bufmond_set_run()
+        return conn.replies
+
+    def rows(self, column):
+        table = self.bufmond.idl.tables[self.bufmond.BUFMON_TABLE]
+        return [row._data.get(column) for row in
+                sorted(table.rows.values(), key=lambda row: row.uuid)]
+
+    def test_command(self):
+        replies = self.set('unit=1', 'enabled=true', 'trigger_threshold=50')
+        self.assertTrue(replies[0].startswith('1 rows changed, 1 matched'))
+        self.assertEqual(self.rows('enabled'), [False, True, True])
+        self.assertEqual(self.rows('trigger_threshold'), [[], [50], []])
+
+        # An empty value clears an optional column.
+        replies = self.set('trigger_threshold=')
+        self.assertTrue(replies[0].startswith('1 rows changed, 3 matched'))
+        self.assertEqual(self.rows('trigger_threshold'), [[], [], []])
+
+    def test_invalid_values(self):
+        self.assertEqual(self.set('enabled=maybe'),
+                         ["error: invalid enabled value 'maybe': enabled "
+                          "expects true or false"])
+        self.assertEqual(self.set('enabled='),
+                         ["error: invalid enabled value '': enabled cannot "
+                          "be cleared"])
+        self.assertTrue(self.set('trigger_threshold=high')[0].startswith(
+            "error: invalid trigger_threshold value 'high'"))
+        self.assertEqual(self.set('unit=1'),
+                         ["error: nothing to set, expected enabled or "
+                          "trigger_threshold"])
+        self.assertEqual(self.rows('enabled'), [False, False, True])
+
+    def test_not_replicated(self):
+        # Answered without a crash by a daemon not in --watch mode.
+        self.bufmond.bufmon_counters = None
+        self.assertEqual(self.set('enabled=true'),
+                         ['error: bufmon counters list not loaded'])
+
+        load_counters(self.bufmond, self.keys)
+        self.bufmond.BUFMON_WATCH = False
+        self.assertEqual(self.set('enabled=true'),
+                         ['error: bufmon/set requires --watch'])
+
+        self.bufmond.BUFMON_WATCH = True
+        del self.bufmond.idl.tables[self.bufmond.BUFMON_TABLE].columns[
+            'enabled']
+        self.assertEqual(self.set('enabled=true'),
+                         ['error: bufmon column enabled not replicated'])
+
+    def test_try_again(self):
+        # The batch is sent again, its unit does not fail.
+        self.bufmond.idl.statuses.append('try again')
+        replies = self.set('enabled=true')
+
+        self.assertTrue(replies[0].startswith('2 rows changed, 3 matched'))
+        self.assertNotIn('failed', replies[0])
+        self.assertEqual(self.rows('enabled'), [True, True, True])
+
+    def test_replied_once_committed(self):
+        conn = FakeConnection()
+        self.bufmond.bufmon_pending_sets.append(
+            (conn, self.keys, {'enabled': True}))
+
+        # The transactions are outstanding, the handler does not block.
+        self.bufmond.bufmond_set_run()
+        self.assertEqual(conn.replies, [])
+        self.assertEqual(len(self.bufmond.bufmon_set_job['inflight']), 2)
+
+        self.bufmond.idl.run()
+        self.bufmond.bufmond_set_run()
+        self.assertEqual(len(conn.replies), 1)
+        self.assertTrue(conn.replies[0].startswith(
+            '2 rows changed, 3 matched'))
+        self.assertIsNone(self.bufmond.bufmon_set_job)
+
+        # Operator writes are not reconcile updates.
+        self.assertEqual(self.bufmond.stats_counters['rows-set'], 2)
+        self.assertEqual(self.bufmond.stats_counters['rows-updated'], 0)
+
+    def test_queued(self):
+        first, second = FakeConnection(), FakeConnection()
+        self.bufmond.bufmon_pending_sets.extend(
+            [(first, self.keys[:1], {'enabled': True}),
+             (second, self.keys, {'enabled': True})])
+        self.bufmond.bufmond_set_run()
+        self.bufmond.idl.run()
+        self.bufmond.bufmond_set_run()
+        self.bufmond.idl.run()
+        self.bufmond.bufmond_set_run()
+
+        self.assertTrue(first.replies[0].startswith(
+            '1 rows changed, 1 matched'))
+        self.assertTrue(second.replies[0].startswith(
+            '1 rows changed, 3 matched'))
+
+
+class CommandTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        load_counters(self.bufmond,
+                      [(0, 'device/data/NONE/NONE'),
+                       (0, 'ingress-service-pool/um-buffer-count/0/NONE'),
+                       (1, 'ingress-service-pool/um-buffer-count/1/NONE')])
+
+    def query(self, *argv):
+        conn = FakeConnection()
+        self.bufmond.unixctl_bufmon_query(conn, list(argv), None)
+        return conn.replies[0]
+
+    def test_parse_terms(self):
+        parse = self.bufmond.parse_bufmon_terms
+        self.assertEqual(parse(['realm=device', 'name=*/data/*', 'last=3'],
+                               ('last', 'since')),
+                         ([('realm', 'device')], '*/data/*', {'last': '3'}))
+        self.assertEqual(parse([]), ([], None, {}))
+        self.assertRaises(ValueError, parse, ['realm'])
+        self.assertRaises(ValueError, parse, ['=device'])
+
+    def test_query(self):
+        self.assertEqual(self.query('realm=ingress-service-pool', 'unit=1'),
+                         '1 ingress-service-pool/um-buffer-count/1/NONE')
+        self.assertEqual(self.query('name=*/0/*'),
+                         '0 ingress-service-pool/um-buffer-count/0/NONE')
+        self.assertEqual(self.query('realm=device', 'name=*/0/*'), '')
+        self.assertEqual(self.query('realm'),
+                         "error: invalid term 'realm', expected field=value")
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        self.bufmond.BUFMON_HISTORY_SAMPLES = 3
+        self.bufmond.bufmon_history_reset(2)
+
+    def test_append_timeval_msec(self):
+        # ovs.timeval.msec() is a float, the ring buffers hold integers.
+        msec = ovs.timeval.msec()
+        for i in range(4):
+            self.bufmond.bufmon_history_append(1, 10 + i, msec + i)
+
+        start = int(msec)
+        self.assertEqual(self.bufmond.get_bufmon_history(1),
+                         [(start + 1, 11), (start + 2, 12), (start + 3, 13)])
+        self.assertEqual(self.bufmond.get_bufmon_history(0), [])
+
+    def test_last_and_since(self):
+        for i in range(3):
+            self.bufmond.bufmon_history_append(0, i, 1000 + i * 10)
+
+        self.assertEqual(self.bufmond.get_bufmon_history(0, last=1),
+                         [(1020, 2)])
+        self.assertEqual(self.bufmond.get_bufmon_history(0, since=1010),
+                         [(1010, 1), (1020, 2)])
+
+
+class PeakTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE'),
+                                     (1, 'device/data/NONE/NONE')])
+        self.bufmond.bufmon_value_hooks.append(self.bufmond.bufmon_peak_update)
+
+    def peak(self, *argv):
+        conn = FakeConnection()
+        self.bufmond.unixctl_bufmon_peak(conn, list(argv), None)
+        return conn.replies[0]
+
+    def test_cap_mode_peak_false(self):
+        # Tracked from the capabilities, in auto mode by default.
+        self.bufmond.bufmon_info = {'cap_mode_peak': False}
+        self.bufmond.bufmon_peak_reset(2)
+        for value in (3, 9, 4):
+            self.bufmond.bufmon_peak_update(1, value, 0)
+
+        self.assertTrue(self.bufmond.is_bufmon_runtime_read())
+        self.assertEqual(self.peak(), '1 device/data/NONE/NONE 9')
+        self.assertEqual(self.peak(), '')
+
+    def test_cap_mode_peak_true(self):
+        # The hardware peaks are used, the bufmon table is not read.
+        self.bufmond.bufmon_info = {'cap_mode_peak': True}
+        self.bufmond.bufmon_peak_reset(2)
+        self.bufmond.bufmon_peak_update(1, 3, 0)
+
+        self.assertIsNone(self.bufmond.peak_values)
+        self.assertFalse(self.bufmond.is_bufmon_runtime_read())
+        self.assertTrue(self.peak().startswith('error: '))
+
+        self.bufmond.BUFMON_SOFT_PEAK = self.bufmond.SOFT_PEAK_ON
+        self.bufmond.bufmon_peak_reset(2)
+        self.assertTrue(self.bufmond.is_bufmon_runtime_read())
+
+
+class HistoryFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'bufmond.history')
+        self.bufmond = load_bufmond()
+        self.bufmond.BUFMON_HISTORY_FILE = self.path
+        self.bufmond.BUFMON_HISTORY_BUCKETS = 4
+        self.bufmond.BUFMON_HISTORY_BUCKET_MSEC = 1000
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE'),
+                                     (1, 'device/data/NONE/NONE')])
+        self.reader = imp.load_source(
+            'bufmon_history_reader',
+            os.path.join(REPO_DIR, 'bufmon-history-reader.py'))
+
+    def tearDown(self):
+        self.bufmond.close_bufmon_history_file()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, **kwargs):
+        history, keys, starts = self.reader.open_history(self.path)
+        return list(self.reader.read_history(history, keys, starts,
+                                             **kwargs))
+
+    def append(self, wall_msec, counter_id, value):
+        self.bufmond.sample_wall_msec = wall_msec
+        self.bufmond.bufmon_history_file_append(counter_id, value,
+                                                ovs.timeval.msec())
+
+    def test_wall_clock_buckets(self):
+        self.bufmond.bufmon_history_file_reset(2)
+        self.append(1445212800500, 0, 5)
+        self.append(1445212800900, 0, 3)
+        self.append(1445212801200, 1, 7)
+
+        self.assertEqual(self.read(),
+                         [(1445212800000, '0', 'device/data/NONE/NONE', 5),
+                          (1445212801000, '1', 'device/data/NONE/NONE', 7)])
+        self.assertEqual(self.read(since=1445212801000),
+                         [(1445212801000, '1', 'device/data/NONE/NONE', 7)])
+
+    def test_reused_after_restart(self):
+        # A bucket written before the restart keeps its place in time.
+        self.bufmond.bufmon_history_file_reset(2)
+        self.append(1445212803000, 0, 9)
+        self.bufmond.close_bufmon_history_file()
+
+        self.bufmond.bufmon_history_file_reset(2)
+        self.append(1445212804000, 0, 1)
+        self.assertEqual([sample[0] for sample in self.read()],
+                         [1445212803000, 1445212804000])
+        self.assertFalse(os.path.exists(self.path + '.old'))
+
+    def test_counters_change_moves_file(self):
+        self.bufmond.bufmon_history_file_reset(2)
+        self.bufmond.close_bufmon_history_file()
+
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE')])
+        self.bufmond.bufmon_history_file_reset(1)
+        self.assertTrue(os.path.exists(self.path + '.old'))
+        self.assertEqual(self.read(), [])
+
+    def test_aligned_records(self):
+        # The stamps and records start on 8 bytes boundaries.
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE')])
+        self.bufmond.bufmon_history_file_reset(1)
+
+        self.assertEqual(self.bufmond.HISTORY_FILE_HEADER.size, 32)
+        self.assertEqual(self.bufmond.history_file_stamps % 8, 0)
+        self.assertEqual(self.bufmond.history_file_records % 8, 0)
+
+
+class TriggerTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+
+    def report(self, crossed, rate_limit, now):
+        self.bufmond.bufmon_trigger_report(crossed, rate_limit, now)
+        return sorted(self.bufmond.trigger_pending)
+
+    def test_rate_limited(self):
+        # 120 per minute: a burst of 2, then 2 per second.
+        self.assertEqual(self.report([0, 1, 2, 3, 4], 120, 1000), [0, 1])
+        self.assertEqual(self.bufmond.trigger_suppressed, 3)
+
+        # Already waiting counters are not reported twice.
+        self.assertEqual(self.report([0, 1], 120, 1000), [0, 1])
+        self.assertEqual(self.bufmond.trigger_suppressed, 3)
+
+        self.assertEqual(self.report([2, 3], 120, 1500), [0, 1, 2])
+        self.assertEqual(self.bufmond.trigger_suppressed, 4)
+
+        # The bucket does not fill over its capacity.
+        self.assertEqual(self.report([3, 4, 5], 120, 60000), [0, 1, 2, 3, 4])
+        self.assertEqual(self.bufmond.trigger_suppressed, 5)
+
+    def test_low_rate(self):
+        # Below one per second the bucket still holds one report.
+        self.assertEqual(self.report([0, 1], 6, 1000), [0])
+        self.assertEqual(self.report([1], 6, 6000), [0])
+        self.assertEqual(self.report([1], 6, 11000), [0, 1])
+
+    def test_zero_rate(self):
+        # Nothing goes through, the crossings are counted as limited.
+        self.assertEqual(self.report([0, 1], 0, 1000), [])
+        self.assertEqual(self.report([0], 0, 61000), [])
+        self.assertEqual(self.bufmond.trigger_suppressed, 3)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        self.bufmond.BUFMON_SNAPSHOTS = 2
+        init_idl(self.bufmond)
+        keys = [(0, 'egress-uc-queue/uc-buffer-count/%d/NONE' % queue)
+                for queue in range(1, 5)]
+        for hw_unit_id, name in keys[:3]:
+            add_bufmon_row(self.bufmond, hw_unit_id, name,
+                           counter_value=[100])
+        load_counters(self.bufmond, keys)
+        self.bufmond.bufmon_snapshot_reset(len(keys))
+
+    def trigger(self, counter_id):
+        self.bufmond.snapshot_triggered.append(counter_id)
+        self.bufmond.bufmon_snapshot_run()
+
+    def test_seeded_from_rows(self):
+        # Counters not updated since the load are part of the snapshot.
+        self.bufmond.bufmon_snapshot_update(1, 500, 0)
+        self.trigger(1)
+
+        self.assertEqual(list(self.bufmond.get_bufmon_snapshot(1)),
+                         [100, 500, 100, -1])
+
+    def test_oldest_folded(self):
+        for value in [200, 300, 400]:
+            self.bufmond.bufmon_snapshot_update(0, value, 0)
+            self.trigger(0)
+
+        self.assertIsNone(self.bufmond.get_bufmon_snapshot(1))
+        self.assertEqual(list(self.bufmond.get_bufmon_snapshot(2)),
+                         [300, 100, 100, -1])
+        self.assertEqual(list(self.bufmond.get_bufmon_snapshot(3)),
+                         [400, 100, 100, -1])
+
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+
+    def stats(self):
+        conn = FakeConnection()
+        self.bufmond.unixctl_bufmon_stats(conn, [], None)
+        return conn.replies[0].split('\n')
+
+    def test_loop_buckets(self):
+        # The bucket of a bound holds the iterations below it.
+        for elapsed in (0.0005, 0.001, 0.0019, 0.012, 5.0, 7.5):
+            self.bufmond.bufmon_stats_loop(elapsed)
+
+        self.assertEqual(self.bufmond.stats_loop_histogram,
+                         [1, 2, 0, 0, 1, 0, 0, 0, 0, 0, 0, 2])
+        self.assertEqual(self.bufmond.stats_loop_max, 7500)
+
+    def test_reply(self):
+        self.bufmond.stats_phases['parse'] = 0.0125
+        self.bufmond.stats_counters['rows-inserted'] = 33
+        self.bufmond.bufmon_stats_loop(0.003)
+
+        lines = self.stats()
+        self.assertEqual(lines[:3], ['wait-system: -', 'parse: 12.5 ms',
+                                     'reconcile: 0.0 ms'])
+        self.assertIn('rows-inserted: 33', lines)
+        self.assertIn('loop: 1 iterations, max 3.0 ms', lines)
+        self.assertIn('loop <5 ms: 1', lines)
+        self.assertEqual(lines[-1], 'loop >=5000 ms: 0')
+
+    def test_profile(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.bufmond.BUFMON_PROFILE = os.path.join(tmp_dir, 'bufmond.prof')
+        self.bufmond.profiler = cProfile.Profile()
+        self.bufmond.profiler.enable()
+        self.bufmond.get_counter_key({'name': 'device/data/NONE/NONE'})
+
+        # Written once, at the end of the startup path.
+        self.bufmond.bufmond_profile_stop()
+        self.assertIsNone(self.bufmond.profiler)
+        stats = pstats.Stats(self.bufmond.BUFMON_PROFILE)
+        self.assertIn('get_counter_key',
+                      [name for unused_file, unused_line, name
+                       in stats.stats])
+        os.unlink(self.bufmond.BUFMON_PROFILE)
+        self.bufmond.bufmond_profile_stop()
+        self.assertFalse(os.path.exists(self.bufmond.BUFMON_PROFILE))
+
+
+class MetricsTest(unittest.TestCase):
+    SERIES = ('bufmon_counter_value{realm="device",stat="data",unit="%d"} '
+              '%d\n')
+
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        init_idl(self.bufmond)
+        add_bufmon_row(self.bufmond, 0, 'device/data/NONE/NONE',
+                       counter_value=[1234])
+        add_bufmon_row(self.bufmond, 1, 'device/data/NONE/NONE',
+                       counter_value=[])
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE'),
+                                     (1, 'device/data/NONE/NONE')])
+        self.bufmond.bufmon_metrics_reset(2)
+
+    def scrape(self, method='GET'):
+        return self.bufmond.get_bufmon_metrics_response(
+            '%s /metrics HTTP/1.1\r\n\r\n' % method)
+
+    def test_seeded_from_rows(self):
+        # A counter keeping its value since the load is exported.
+        response = self.scrape()
+        self.assertIn(self.SERIES % (0, 1234), response)
+        self.assertNotIn('unit="1"', response)
+        self.assertTrue(response.endswith('# EOF\n'))
+
+    def test_cached_response(self):
+        response = self.scrape()
+        self.assertIs(self.scrape(), response)
+
+        self.bufmond.bufmon_metrics_update(1, 7, 0)
+        updated = self.scrape()
+        self.assertIsNot(updated, response)
+        self.assertIn(self.SERIES % (1, 7), updated)
+
+        head, body = updated.split('\r\n\r\n', 1)
+        self.assertIn('Content-Length: %d\r\n' % len(body), head)
+        self.assertEqual(self.scrape('HEAD'), head + '\r\n\r\n')
+
+    def test_errors(self):
+        self.assertTrue(self.scrape('POST').startswith(
+            'HTTP/1.0 405 Method Not Allowed'))
+        self.bufmond.metrics_prefixes = None
+        self.assertTrue(self.scrape().startswith(
+            'HTTP/1.0 503 Service Unavailable'))
+
+    def test_local_pstream(self):
+        for name in ['punix:/var/run/bufmond.metrics', 'ptcp:127.0.0.1:9100',
+                     'ptcp:localhost:9100']:
+            self.assertTrue(self.bufmond.is_local_pstream(name), name)
+        for name in ['ptcp:0.0.0.0:9100', 'ptcp:10.0.0.1:9100', 'ptcp:9100',
+                     'tcp:127.0.0.1:9100']:
+            self.assertFalse(self.bufmond.is_local_pstream(name), name)
+
+
+class FakeStream(object):
+    def __init__(self, name, data=None):
+        self.name = name
+        self.data = data
+        self.sent = ''
+        self.closed = False
+
+    def recv(self, unused_n):
+        data, self.data = self.data, None
+        if data is None:
+            return errno.EAGAIN, ''
+        return 0, data
+
+    def send(self, buf):
+        self.sent += buf.tobytes()
+        return len(buf)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePassiveStream(object):
+    def __init__(self):
+        self.streams = []
+
+    def accept(self):
+        if not self.streams:
+            return errno.EAGAIN, None
+        return 0, self.streams.pop(0)
+
+
+class SubscribeTest(unittest.TestCase):
+    def setUp(self):
+        self.bufmond = load_bufmond()
+        load_counters(self.bufmond, [(0, 'device/data/NONE/NONE'),
+                                     (0, 'ingress-service-pool/um-buffer-'
+                                         'count/0/NONE')])
+        self.bufmond.subscribe_pstream = FakePassiveStream()
+
+    def connect(self, data=None):
+        stream = FakeStream('punix:test', data)
+        self.bufmond.subscribe_pstream.streams.append(stream)
+        self.bufmond.bufmon_subscribe_run()
+        return stream
+
+    def test_updates(self):
+        stream = self.connect('device/\n')
+        self.bufmond.bufmon_subscribe_update(0, 42, 0)
+        self.bufmond.bufmon_subscribe_update(1, 7, 0)
+        self.bufmond.bufmon_subscribe_run()
+
+        line = json.loads(stream.sent)
+        self.assertEqual(line['counters'],
+                         [[0, 'device/data/NONE/NONE', 42]])
+
+    def test_idle_dropped(self):
+        # A subscriber sending no prefix does not keep its slot.
+        stream = self.connect()
+        self.assertFalse(stream.closed)
+        self.bufmond.subscribe_clients[0]['deadline'] = 0
+        self.bufmond.bufmon_subscribe_run()
+
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.bufmond.subscribe_clients, [])
+
+
+if __name__ == '__main__':
+    unittest.main()